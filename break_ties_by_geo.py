@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 import sys
 
-from geotaxsel import parse_geo, min_dist_between_sp
+import numpy as np
+
+from geotaxsel import parse_geo, pairwise_dists
 
 
 def error(msg):
@@ -71,11 +73,18 @@ def main(cut_branches_fp, chosen_tax_fp, centroid_fp):
         choice_set = sp_to_set[first_choice]
         dist_ch_list = [(-1, first_choice)]
         fsp = sp_by_name[first_choice]
-        for el in choice_set:
-            if el != first_choice:
-                el_sp = sp_by_name[el]
-                md = min_dist_between_sp(fsp, el_sp)
-                dist_ch_list.append((md, el))
+        others = [el for el in choice_set if el != first_choice]
+        # The distances from the first choice to every location of the
+        #   others, in one call; then the minimum for each of the others.
+        locs, owner = [], []
+        for idx, el in enumerate(others):
+            el_locs = list(sp_by_name[el].locations)
+            locs.extend(el_locs)
+            owner.extend([idx] * len(el_locs))
+        min_by_loc = pairwise_dists(list(fsp.locations), locs).min(axis=0)
+        md = np.full(len(others), np.inf)
+        np.minimum.at(md, np.array(owner, dtype=np.int64), min_by_loc)
+        dist_ch_list.extend((float(d), el) for d, el in zip(md, others))
         dist_ch_list.sort()
         ranked = [i[1] for i in dist_ch_list]
         assert ranked[0] == first_choice
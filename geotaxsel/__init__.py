@@ -3,16 +3,48 @@ __version__ = "0.0.1a"  # sync with setup.py
 from .logs import set_verbose, info, debug
 from .taxonomy import CladeDef, Ranks, read_taxonomy_stream
 from .geo_tree_parser import parse_geo_and_tree, parse_geo
+from .geo_dist import (
+    coords_array,
+    dists_from,
+    pairwise_dists,
+    SPHERICAL,
+    ELLIPSOIDAL,
+)
 from .greedy_mmd import (
     min_dist_between_sp,
     ultrametric_greedy_mmd,
+    ultrametric_split_order,
+    write_split_order,
+    SplitOrder,
     greedy_mmd,
     output_chosen_anc,
     calc_dist,
 )
-from .tree_cleaning import prune_taxa_without_sp_data
+from .array_tree import ArrayTree
+from .newick import parse_newick, read_newick
+from .lca_index import LCAIndex
+from .tree_cleaning import (
+    compile_clades,
+    CompiledClades,
+    find_clades,
+    label_internals,
+    prune_plan_for,
+    prune_taxa_without_sp_data,
+    PrunePlan,
+)
 from .multi_tree_set_sel import (
     choose_most_common,
     PROB_FN,
+    MERGED_DP_FN,
+    DEFAULT_IN_PROCESS_MAX_SUBSETS,
+    DEFAULT_MAX_NUM_GREEDY,
+    load_merged_dp,
     serialize_problems_for_most_common_choice,
 )
+from .solver_cache import SolverCache, component_key
+from .taxon_index import TaxonIndex, iter_bits, popcount
+from .partition_engine import PartitionEngine
+from .laminar import LaminarSolver
+from .subproblem_cache import SubproblemCache
+from .reductions import reduce_components, ReductionReport
+from .canonical import canonical_form
@@ -0,0 +1,242 @@
+#! /usr/bin/env python3
+import dendropy
+from dendropy.utility.error import UltrametricityError
+import numpy as np
+
+
+class ArrayTree(object):
+    """Struct-of-arrays copy of a rooted tree.
+
+    Nodes are numbered in preorder (the root is 0), so the leaves below any
+    node form a contiguous run of `leaf_nodes`: node `i` subtends the leaves
+    `leaf_nodes[leaf_lo[i]:leaf_hi[i]]`. The children of node `i`, in order,
+    are `child_idx[child_lo[i]:child_lo[i + 1]]`. Missing edge lengths are
+    stored as 0.0. `node_labels`, if given, holds the label of each node
+    (None for leaves and unlabelled nodes). `is_rooted` is None unless the
+    source says whether the tree is rooted. `age` is set by calc_ages.
+    """
+
+    def __init__(self, parent, edge_len, leaf_labels, node_labels=None):
+        parent = np.asarray(parent, dtype=np.int64)
+        self.parent = parent
+        self.edge_len = np.asarray(edge_len, dtype=float)
+        num_nodes = len(parent)
+        assert parent[0] < 0
+        assert (parent[1:] < np.arange(1, num_nodes)).all(), "not in preorder"
+        # A stable sort keeps siblings in preorder.
+        self.child_idx = np.argsort(parent[1:], kind="stable") + 1
+        self.num_children = np.bincount(parent[1:], minlength=num_nodes)
+        self.child_lo = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(self.num_children, out=self.child_lo[1:])
+        self.depth = self._calc_depth(parent)
+        # Nodes grouped by depth, for passes that go a level at a time.
+        by_depth = np.argsort(self.depth, kind="stable")
+        level_ends = np.cumsum(np.bincount(self.depth))
+        self._levels = np.split(by_depth, level_ends[:-1])
+        is_leaf = self.num_children == 0
+        self.leaf_nodes = np.flatnonzero(is_leaf)
+        self.leaf_lo = np.cumsum(is_leaf) - is_leaf
+        num_below = is_leaf.astype(np.int64)
+        for level in reversed(self._levels[1:]):
+            np.add.at(num_below, parent[level], num_below[level])
+        self.leaf_hi = self.leaf_lo + num_below
+        self.leaf_labels = list(leaf_labels)
+        assert len(self.leaf_labels) == len(self.leaf_nodes)
+        self.node_labels = node_labels
+        self.is_rooted = None
+        self.age = None
+        self._children = None
+
+    @staticmethod
+    def _calc_depth(parent):
+        """Returns the depth of each node, by pointer doubling."""
+        depth = (parent >= 0).astype(np.int64)
+        anc = parent.copy()
+        while True:
+            idx = np.flatnonzero(anc >= 0)
+            if not len(idx):
+                return depth
+            depth[idx] += depth[anc[idx]]
+            anc[idx] = anc[anc[idx]]
+
+    @property
+    def num_nodes(self):
+        return len(self.parent)
+
+    @property
+    def num_leaves(self):
+        return len(self.leaf_nodes)
+
+    @property
+    def children(self):
+        """List of the list of children of each node."""
+        if self._children is None:
+            lo = self.child_lo.tolist()
+            ci = self.child_idx.tolist()
+            self._children = [ci[lo[i] : lo[i + 1]] for i in range(self.num_nodes)]
+        return self._children
+
+    def children_of(self, nd):
+        return self.child_idx[self.child_lo[nd] : self.child_lo[nd + 1]].tolist()
+
+    def leaf_labels_below(self, nd):
+        return self.leaf_labels[self.leaf_lo[nd] : self.leaf_hi[nd]]
+
+    def calc_ages(self, ultrametric_tol=None):
+        """Sets and returns `age`, the distance from each node to its tips.
+
+        As in dendropy's calc_node_ages, a node's age is its first child's
+        age plus that child's edge length. If `ultrametric_tol` is not None
+        or negative, an UltrametricityError is raised when the other children
+        give an age that differs by more than that.
+        """
+        age = np.zeros(self.num_nodes)
+        edge_len, num_children = self.edge_len, self.num_children
+        for level in reversed(self._levels):
+            internal = level[num_children[level] > 0]
+            if len(internal):
+                first = self.child_idx[self.child_lo[internal]]
+                age[internal] = age[first] + edge_len[first]
+        self.age = age
+        if ultrametric_tol is not None and ultrametric_tol >= 0:
+            dev = np.abs(age[self.parent[1:]] - (age[1:] + edge_len[1:]))
+            bad = np.flatnonzero(dev > ultrametric_tol)
+            if len(bad):
+                nd = int(bad[0]) + 1
+                raise UltrametricityError(
+                    f"Tree is not ultrametric within threshold of {ultrametric_tol}: {dev[bad[0]]}. Encountered in the children of node {self.parent[nd]} (in preorder)"
+                )
+        return age
+
+    def prune(self, keep_leaf, leaf_labels=None):
+        """Returns a new ArrayTree with only the leaves where `keep_leaf` is True.
+
+        `keep_leaf` is a boolean array in leaf order. `leaf_labels`, if given,
+        are the labels of the kept leaves (in leaf order); by default they
+        keep their labels. As in dendropy's prune_taxa, nodes with no kept
+        leaf below them are removed, and nodes left with one child are
+        suppressed, with their edge length added to the child's.
+        """
+        keep_leaf = np.asarray(keep_leaf, dtype=bool)
+        if not keep_leaf.any():
+            raise ValueError("Pruning would remove every leaf")
+        parent = self.parent
+        cum = np.zeros(self.num_leaves + 1, dtype=np.int64)
+        np.cumsum(keep_leaf, out=cum[1:])
+        kept = cum[self.leaf_hi] > cum[self.leaf_lo]
+        num_kept_children = np.bincount(parent[1:][kept[1:]], minlength=self.num_nodes)
+        retained = kept & (num_kept_children != 1)
+        # Walk each retained node up past suppressed ancestors, adding their
+        #   edge lengths in the order that dendropy does (nearest first).
+        edge_len = self.edge_len.copy()
+        anc = parent.copy()
+        moving = np.flatnonzero(retained & (anc >= 0))
+        while len(moving):
+            par = anc[moving]
+            up = moving[~retained[par]]
+            if not len(up):
+                break
+            edge_len[up] += self.edge_len[anc[up]]
+            anc[up] = parent[anc[up]]
+            moving = up[anc[up] >= 0]
+        new_idx = np.cumsum(retained) - 1
+        old_nodes = np.flatnonzero(retained)
+        old_par = anc[old_nodes]
+        new_parent = np.where(old_par >= 0, new_idx[np.maximum(old_par, 0)], -1)
+        if leaf_labels is None:
+            leaf_labels = [lab for lab, k in zip(self.leaf_labels, keep_leaf) if k]
+        node_labels = None
+        if self.node_labels is not None:
+            node_labels = [self.node_labels[i] for i in old_nodes.tolist()]
+        pruned = ArrayTree(new_parent, edge_len[old_nodes], leaf_labels, node_labels)
+        pruned.is_rooted = self.is_rooted
+        return pruned
+
+    def collapse_basal_bifurcation(self):
+        """Returns a copy with a two-child root turned into a multifurcation.
+
+        This is what dendropy's encode_bipartitions does to a tree that is
+        not known to be rooted: the second child is removed if it has two or
+        more children (otherwise the first child is, if it has), its children
+        take its place under the root, and its edge length is added to the
+        other child's. As missing edge lengths are stored as 0.0, a kept
+        child with no edge length gets the removed one's, where dendropy
+        leaves it missing. The copy has `is_rooted` False. If neither child
+        can be removed, or the root does not have two children, `self` is
+        returned.
+        """
+        if self.num_children[0] != 2:
+            return self
+        kids = self.children_of(0)
+        internal = [c for c in kids if self.num_children[c] >= 2]
+        if not internal:
+            return self
+        to_del = internal[-1]
+        to_keep = kids[0] if to_del == kids[1] else kids[1]
+        edge_len = self.edge_len.copy()
+        edge_len[to_keep] += edge_len[to_del]
+        parent = self.parent.copy()
+        parent[parent == to_del] = 0
+        parent[parent > to_del] -= 1
+        keep = np.ones(self.num_nodes, dtype=bool)
+        keep[to_del] = False
+        node_labels = None
+        if self.node_labels is not None:
+            node_labels = [lab for i, lab in enumerate(self.node_labels) if i != to_del]
+        collapsed = ArrayTree(
+            parent[keep], edge_len[keep], self.leaf_labels, node_labels
+        )
+        collapsed.is_rooted = False
+        return collapsed
+
+    @classmethod
+    def from_dendropy(cls, tree):
+        """Returns (ArrayTree, list of dendropy nodes in preorder)."""
+        nodes, parent, edge_len, leaf_labels = [], [], [], []
+        stack = [(tree.seed_node, -1)]
+        while stack:
+            nd, par = stack.pop()
+            idx = len(nodes)
+            nodes.append(nd)
+            parent.append(par)
+            el = nd.edge.length
+            edge_len.append(0.0 if el is None else el)
+            children = nd.child_nodes()
+            if children:
+                stack.extend((c, idx) for c in reversed(children))
+            else:
+                leaf_labels.append(nd.taxon.label)
+        return cls(parent, edge_len, leaf_labels), nodes
+
+    def to_dendropy(self, taxon_namespace=None):
+        """Returns a dendropy.Tree with the same nodes, in the same order.
+
+        Each leaf gets a new Taxon in `taxon_namespace` (or in a new
+        namespace). Edge lengths that were missing are 0.0, except that
+        the root has no edge length unless it is non-zero.
+        """
+        if taxon_namespace is None:
+            taxon_namespace = dendropy.TaxonNamespace()
+        tree = dendropy.Tree(taxon_namespace=taxon_namespace)
+        tree.is_rooted = self.is_rooted
+        nodes = [tree.seed_node]
+        parent, num_children = self.parent.tolist(), self.num_children.tolist()
+        edge_len = self.edge_len.tolist()
+        node_labels = self.node_labels
+        leaf_labels = iter(self.leaf_labels)
+        for nd in range(self.num_nodes):
+            if nd > 0:
+                dnd = dendropy.Node(edge_length=edge_len[nd])
+                nodes[parent[nd]].add_child(dnd)
+                nodes.append(dnd)
+            else:
+                dnd = nodes[0]
+                if edge_len[0]:
+                    dnd.edge.length = edge_len[0]
+            if not num_children[nd]:
+                label = next(leaf_labels)
+                if label is not None:
+                    dnd.taxon = taxon_namespace.new_taxon(label)
+            elif node_labels is not None:
+                dnd.label = node_labels[nd]
+        return tree
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Canonical forms of components, so that copies that differ only in their
+labels are solved once.
+
+Labels are numbered by colour refinement on the graph joining each label
+to the subsets that hold it: a label starts with the weights of its
+subsets, and label and subset colours are refined from each other's until
+they stop splitting. Ties left after that are broken by singling out one
+label of the first tied class and refining again.
+
+The canonical form is the component with its labels renamed by that
+numbering and its subsets sorted. It is always a relabelling of the
+component, so two components with the same form are the same problem. Two
+copies of a problem get the same form unless a tie is broken between labels
+that are not symmetric, which can only cause a copy to be solved again.
+"""
+
+from .taxon_index import iter_bits
+
+
+def _ranks(signatures):
+    """Replaces each signature by its rank among the distinct signatures."""
+    rank_of = {sig: idx for idx, sig in enumerate(sorted(set(signatures)))}
+    return [rank_of[sig] for sig in signatures]
+
+
+def _refine(label_col, sub_labels, label_subs, sub_wt):
+    """Returns the stable label colours reached from `label_col`."""
+    num_classes = len(set(label_col))
+    while True:
+        sub_col = _ranks(
+            [
+                (wt, tuple(sorted(label_col[j] for j in labels)))
+                for wt, labels in zip(sub_wt, sub_labels)
+            ]
+        )
+        new_col = _ranks(
+            [
+                (label_col[j], tuple(sorted(sub_col[i] for i in subs)))
+                for j, subs in enumerate(label_subs)
+            ]
+        )
+        new_num = len(set(new_col))
+        label_col = new_col
+        if new_num == num_classes:
+            return label_col
+        num_classes = new_num
+
+
+def canonical_form(subset_wts):
+    """Returns (form, order) for a dict of label mask -> weight.
+
+    `form` is a tuple of (weight, tuple of canonical label numbers) rows in
+    sorted order, and order[i] is the bit of the label numbered i.
+    """
+    masks = list(subset_wts.keys())
+    bits = sorted({b for m in masks for b in iter_bits(m)})
+    pos = {b: j for j, b in enumerate(bits)}
+    sub_labels = [[pos[b] for b in iter_bits(m)] for m in masks]
+    sub_wt = [subset_wts[m] for m in masks]
+    label_subs = [[] for b in bits]
+    for i, labels in enumerate(sub_labels):
+        for j in labels:
+            label_subs[j].append(i)
+    label_col = _ranks([tuple(sorted(sub_wt[i] for i in subs)) for subs in label_subs])
+    label_col = _refine(label_col, sub_labels, label_subs, sub_wt)
+    num_labels = len(bits)
+    while len(set(label_col)) < num_labels:
+        seen, tied = set(), None
+        for col in sorted(label_col):
+            if col in seen:
+                tied = col
+                break
+            seen.add(col)
+        chosen = label_col.index(tied)
+        # Single out `chosen` by giving it a colour of its own, just below
+        #   its class, and refine.
+        label_col = [2 * c + (0 if j == chosen else 1) for j, c in enumerate(label_col)]
+        label_col = _refine(_ranks(label_col), sub_labels, label_subs, sub_wt)
+    order = [None] * num_labels
+    for j, col in enumerate(label_col):
+        order[col] = bits[j]
+    form = tuple(
+        sorted(
+            (wt, tuple(sorted(label_col[j] for j in labels)))
+            for wt, labels in zip(sub_wt, sub_labels)
+        )
+    )
+    return form, order
@@ -0,0 +1,159 @@
+#! /usr/bin/env python3
+"""Vectorized great-circle and geodesic distances (in km).
+
+`calc_dist` in greedy_mmd builds one geopy `geodesic` object per pair of
+locations. The functions here take arrays of locations and return every
+distance from one call.
+
+Two modes are offered:
+  * SPHERICAL uses the haversine formula on a sphere with geopy's mean
+    earth radius. It is the fastest mode, but differs from geopy's
+    `geodesic` by up to about 0.6%.
+  * ELLIPSOIDAL (the default) solves Vincenty's inverse problem on the
+    WGS-84 ellipsoid (the geopy default). For pairs that converge this
+    agrees with geopy's `geodesic` (Karney's algorithm) to within
+    ELLIPSOIDAL_TOL_KM. The rare nearly-antipodal pairs for which
+    Vincenty's iteration does not converge are handed to geopy, so the
+    tolerance holds for every pair.
+
+Locations can be given as objects with a `coords` attribute holding
+(latitude, longitude) in degrees (`Loc` and `NamedLoc` do), or as an
+N x 2 array of (latitude, longitude) rows.
+"""
+
+import numpy as np
+from geopy.distance import EARTH_RADIUS, ELLIPSOIDS, geodesic
+
+SPHERICAL = "spherical"
+ELLIPSOIDAL = "ellipsoidal"
+ELLIPSOIDAL_TOL_KM = 1.0e-6
+
+_WGS84_A, _WGS84_B, _WGS84_F = ELLIPSOIDS["WGS-84"]
+_MAX_VINCENTY_ITER = 200
+_VINCENTY_CONVERGENCE = 1.0e-12
+
+
+def coords_array(locs):
+    """Returns an N x 2 float array of (latitude, longitude) for `locs`."""
+    if isinstance(locs, np.ndarray):
+        arr = locs.astype(float, copy=False)
+    else:
+        arr = np.array([i.coords for i in locs], dtype=float)
+    return arr.reshape(-1, 2)
+
+
+def _spherical(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    sin_dlat = np.sin((lat2 - lat1) / 2.0)
+    sin_dlon = np.sin((lon2 - lon1) / 2.0)
+    h = sin_dlat * sin_dlat + np.cos(lat1) * np.cos(lat2) * sin_dlon * sin_dlon
+    return 2.0 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+def _ellipsoidal(lat1, lon1, lat2, lon2):
+    a, b, f = _WGS84_A, _WGS84_B, _WGS84_F
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(lat1, lon1, lat2, lon2)
+    shape = lat1.shape
+    lat1, lon1, lat2, lon2 = [np.ravel(i) for i in (lat1, lon1, lat2, lon2)]
+    u1 = np.arctan((1.0 - f) * np.tan(np.radians(lat1)))
+    u2 = np.arctan((1.0 - f) * np.tan(np.radians(lat2)))
+    ell = np.radians(lon2 - lon1)
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+    lam = ell.copy()
+    active = np.ones(lam.shape, dtype=bool)
+    sin_sigma = np.zeros(lam.shape)
+    cos_sigma = np.ones(lam.shape)
+    sigma = np.zeros(lam.shape)
+    cos_sq_alpha = np.ones(lam.shape)
+    cos_2sm = np.zeros(lam.shape)
+    for _ in range(_MAX_VINCENTY_ITER):
+        if not active.any():
+            break
+        idx = np.nonzero(active)[0]
+        sin_lam, cos_lam = np.sin(lam[idx]), np.cos(lam[idx])
+        s_u1, c_u1, s_u2, c_u2 = sin_u1[idx], cos_u1[idx], sin_u2[idx], cos_u2[idx]
+        ss = np.hypot(c_u2 * sin_lam, c_u1 * s_u2 - s_u1 * c_u2 * cos_lam)
+        cs = s_u1 * s_u2 + c_u1 * c_u2 * cos_lam
+        sg = np.arctan2(ss, cs)
+        coincident = ss == 0.0
+        safe_ss = np.where(coincident, 1.0, ss)
+        sin_alpha = np.where(coincident, 0.0, c_u1 * c_u2 * sin_lam / safe_ss)
+        csa = 1.0 - sin_alpha * sin_alpha
+        # cos_2sm is undefined (and taken as 0) for equatorial lines.
+        safe_csa = np.where(csa == 0.0, 1.0, csa)
+        c2sm = np.where(csa == 0.0, 0.0, cs - 2.0 * s_u1 * s_u2 / safe_csa)
+        c = f / 16.0 * csa * (4.0 + f * (4.0 - 3.0 * csa))
+        lam_prev = lam[idx]
+        lam_new = ell[idx] + (1.0 - c) * f * sin_alpha * (
+            sg + c * ss * (c2sm + c * cs * (-1.0 + 2.0 * c2sm * c2sm))
+        )
+        lam[idx] = lam_new
+        sin_sigma[idx], cos_sigma[idx], sigma[idx] = ss, cs, sg
+        cos_sq_alpha[idx], cos_2sm[idx] = csa, c2sm
+        done = coincident | (np.abs(lam_new - lam_prev) <= _VINCENTY_CONVERGENCE)
+        active[idx[done]] = False
+
+    u_sq = cos_sq_alpha * (a * a - b * b) / (b * b)
+    big_a = 1.0 + u_sq / 16384.0 * (
+        4096.0 + u_sq * (-768.0 + u_sq * (320.0 - 175.0 * u_sq))
+    )
+    big_b = u_sq / 1024.0 * (256.0 + u_sq * (-128.0 + u_sq * (74.0 - 47.0 * u_sq)))
+    delta_sigma = (
+        big_b
+        * sin_sigma
+        * (
+            cos_2sm
+            + big_b
+            / 4.0
+            * (
+                cos_sigma * (-1.0 + 2.0 * cos_2sm * cos_2sm)
+                - big_b
+                / 6.0
+                * cos_2sm
+                * (-3.0 + 4.0 * sin_sigma * sin_sigma)
+                * (-3.0 + 4.0 * cos_2sm * cos_2sm)
+            )
+        )
+    )
+    dist = b * big_a * (sigma - delta_sigma)
+    # Nearly antipodal points can fail to converge; Karney's method handles them.
+    for i in np.nonzero(active)[0]:
+        dist[i] = geodesic((lat1[i], lon1[i]), (lat2[i], lon2[i])).km
+    return dist.reshape(shape)
+
+
+_DIST_FNS = {SPHERICAL: _spherical, ELLIPSOIDAL: _ellipsoidal}
+
+
+def _dist_fn(mode):
+    try:
+        return _DIST_FNS[mode]
+    except KeyError:
+        raise ValueError(f"Distance mode {repr(mode)} not recognized.")
+
+
+def dists_from(loc, locs, mode=ELLIPSOIDAL):
+    """Returns a length-N array of distances (km) from `loc` to each of `locs`."""
+    fn = _dist_fn(mode)
+    c = coords_array([loc] if hasattr(loc, "coords") else loc)[0]
+    arr = coords_array(locs)
+    if arr.shape[0] == 0:
+        return np.zeros(0)
+    return fn(c[0], c[1], arr[:, 0], arr[:, 1])
+
+
+def pairwise_dists(locs_a, locs_b, mode=ELLIPSOIDAL):
+    """Returns an N x M array of distances (km) between `locs_a` and `locs_b`."""
+    fn = _dist_fn(mode)
+    arr_a = coords_array(locs_a)
+    arr_b = coords_array(locs_b)
+    if arr_a.shape[0] == 0 or arr_b.shape[0] == 0:
+        return np.zeros((arr_a.shape[0], arr_b.shape[0]))
+    return fn(
+        arr_a[:, 0][:, np.newaxis],
+        arr_a[:, 1][:, np.newaxis],
+        arr_b[:, 0][np.newaxis, :],
+        arr_b[:, 1][np.newaxis, :],
+    )
@@ -1,8 +1,13 @@
 #! /usr/bin/env python3
+import bisect
 from dendropy.calculate.phylogeneticdistance import PhylogeneticDistanceMatrix
 from geopy.distance import geodesic
+import numpy as np
 
 from geotaxsel import debug, info
+from .array_tree import ArrayTree
+from .geo_dist import pairwise_dists
+from .lca_index import LCAIndex
 
 
 def calc_dist(loc_1, loc_2):
@@ -12,47 +17,31 @@ def calc_dist(loc_1, loc_2):
 
 
 def sel_most_geo_div_taxon(label_ind_pairs, loc_list, sp_by_name):
-    md = None
-    md_loc = None
-    md_sp_ind = None
+    cand_locs, cand_inds = [], []
     for label, ind in label_ind_pairs:
         sp = sp_by_name[label]
         for l1 in sp.locations:
-            sum_sq_dist = 0.0
-            for l2 in loc_list:
-                try:
-                    sum_sq_dist += calc_dist(l1, l2)
-                except:
-                    raise
-            if md is None or sum_sq_dist > md:
-                md = sum_sq_dist
-                md_loc = l1
-                md_sp_ind = ind
-    assert md_sp_ind is not None
-    return md_sp_ind, md_loc
+            cand_locs.append(l1)
+            cand_inds.append(ind)
+    assert cand_locs
+    sum_dist = pairwise_dists(cand_locs, loc_list).sum(axis=1)
+    best = int(np.argmax(sum_dist))
+    return cand_inds[best], cand_locs[best]
 
 
 def most_divergent_locs(tax_1, tax_2, sp_by_name):
     sp1, sp2 = sp_by_name[tax_1], sp_by_name[tax_2]
-    md = None
-    md_pair = None
-    for loc1 in sp1.locations:
-        for loc2 in sp2.locations:
-            d = calc_dist(loc1, loc2)
-            if md is None or d > md:
-                md = d
-                md_pair = (loc1, loc2)
-    return md_pair
+    locs1, locs2 = list(sp1.locations), list(sp2.locations)
+    dists = pairwise_dists(locs1, locs2)
+    r, c = np.unravel_index(np.argmax(dists), dists.shape)
+    return locs1[r], locs2[c]
 
 
 def min_dist_between_sp(sp_1, sp_2):
-    md = None
-    for loc1 in sp_1.locations:
-        for loc2 in sp_2.locations:
-            d = calc_dist(loc1, loc2)
-            if md is None or d < md:
-                md = d
-    return md
+    dists = pairwise_dists(list(sp_1.locations), list(sp_2.locations))
+    if dists.size == 0:
+        return None
+    return float(dists.min())
 
 
 def tip_to_root_dist(nd, root):
@@ -64,34 +53,154 @@ def tip_to_root_dist(nd, root):
     return t
 
 
-def ultrametric_greedy_mmd(tree, num_taxa, sp_by_name, ultrametric_tol=5e-5):
+class SplitOrder(object):
+    """Record of one descending-age sweep of a tree.
+
+    `split_nodes[i]` is the (i+1)-th internal node to be split and
+    `num_after[i]` is the number of lineages after splitting it
+    (`num_after[0]` is 1 for the root lineage before any split). The cut
+    for any number of taxa can be rebuilt from a prefix of `split_nodes`.
+
+    Nodes are dendropy nodes, or node indices for a sweep of an ArrayTree,
+    in which case `atree` is that tree. age_of, num_leaves_below and name_of
+    describe a node of either kind.
+    """
+
+    def __init__(self, root, split_nodes, num_after, hit_leaf, atree=None):
+        self.root = root
+        self.split_nodes = split_nodes
+        self.num_after = num_after
+        self.hit_leaf = hit_leaf
+        self.atree = atree
+
+    @property
+    def max_num_taxa(self):
+        return self.num_after[-1]
+
+    def reachable_sizes(self):
+        return list(self.num_after)
+
+    def age_of(self, nd):
+        if self.atree is None:
+            return nd.age
+        return float(self.atree.age[nd])
+
+    def num_leaves_below(self, nd):
+        if self.atree is None:
+            return len(nd.leaf_nodes())
+        return int(self.atree.leaf_hi[nd] - self.atree.leaf_lo[nd])
+
+    def name_of(self, nd, clade_names=None):
+        """Returns subtree_name of the node.
+
+        For an ArrayTree, `clade_names` optionally maps a node index to the
+        list of names of the clades found there (see find_clades).
+        """
+        if self.atree is None:
+            return subtree_name(nd)
+        return _array_subtree_name(self.atree, nd, clade_names or {})
+
+    def cut(self, num_taxa):
+        """Returns the set of nodes in the cut with `num_taxa` lineages in O(num_taxa)."""
+        num_splits = bisect.bisect_left(self.num_after, num_taxa)
+        if num_splits == len(self.num_after):
+            if self.hit_leaf:
+                raise NotImplementedError(
+                    "num_taxa is greater than the number of internal nodes. Not implemented yet."
+                )
+            raise ValueError(
+                f"num_taxa={num_taxa} exceeds the {self.max_num_taxa} lineages of the sweep"
+            )
+        if self.num_after[num_splits] != num_taxa:
+            raise NotImplementedError(
+                "Polytomy caused num_taxa to be exceeded need to check last_added and remove some..."
+            )
+        if num_splits == 0:
+            return {self.root}
+        split_set = set(self.split_nodes[:num_splits])
+        chosen_ancs = set()
+        for nd in self.split_nodes[:num_splits]:
+            if self.atree is None:
+                children = nd.child_nodes()
+            else:
+                children = self.atree.children_of(nd)
+            for child in children:
+                if child not in split_set:
+                    chosen_ancs.add(child)
+        return chosen_ancs
+
+
+def ultrametric_split_order(tree, max_num_taxa, ultrametric_tol=5e-5):
+    """Splits nodes in order of descending age until `max_num_taxa` lineages exist.
+
+    Returns a SplitOrder from which the cut for every number of taxa up to
+    `max_num_taxa` can be read. `tree` is a dendropy.Tree or an ArrayTree.
+    """
+    if isinstance(tree, ArrayTree):
+        return _array_split_order(tree, max_num_taxa, ultrametric_tol)
     tree.calc_node_ages(ultrametricity_precision=ultrametric_tol)
-    # for nd in tree.ageorder_node_iter(descending=True):
-    #     if nd.is_leaf():
-    #         print(f"{nd.taxon.label} -> root = ", tip_to_root_dist(nd, tree.seed_node))
-    #     else:
-    #         print(
-    #             f"internal node at age {nd.age} and tip to root =",
-    #             tip_to_root_dist(nd, tree.seed_node),
-    #         )
-    last_added = {tree.seed_node}
-    chosen_ancs = set(last_added)
+    num_lineages = 1
+    split_nodes, num_after = [], [num_lineages]
+    hit_leaf = False
     for nd in tree.ageorder_node_iter(descending=True):
-        if len(chosen_ancs) >= num_taxa:
+        if num_lineages >= max_num_taxa:
             break
         if nd.is_leaf():
-            raise NotImplementedError(
-                "num_taxa is greater than the number of internal nodes. Not implemented yet."
-            )
-        assert nd in chosen_ancs
-        chosen_ancs.remove(nd)
-        last_added = set(nd.child_nodes())
-        chosen_ancs.update(last_added)
-    if len(chosen_ancs) != num_taxa:
-        raise NotImplementedError(
-            "Polytomy caused num_taxa to be exceeded need to check last_added and remove some..."
-        )
-    return chosen_ancs
+            hit_leaf = True
+            break
+        num_lineages += len(nd.child_nodes()) - 1
+        split_nodes.append(nd)
+        num_after.append(num_lineages)
+    return SplitOrder(tree.seed_node, split_nodes, num_after, hit_leaf)
+
+
+def _array_split_order(atree, max_num_taxa, ultrametric_tol):
+    """ultrametric_split_order for an ArrayTree, with the sweep done on arrays.
+
+    Nodes are visited in the same order as by dendropy's ageorder_node_iter:
+    by descending age, and in preorder among nodes of equal age.
+    """
+    age = atree.calc_ages(ultrametric_tol=ultrametric_tol)
+    order = np.argsort(-age, kind="stable")
+    num_children = atree.num_children[order]
+    is_leaf = num_children == 0
+    first_leaf = int(np.argmax(is_leaf)) if is_leaf.any() else len(order)
+    num_after = np.ones(first_leaf + 1, dtype=np.int64)
+    np.cumsum(num_children[:first_leaf] - 1, out=num_after[1:])
+    num_after[1:] += 1
+    # Splitting stops once there are max_num_taxa lineages, or at a leaf.
+    num_splits = int(np.searchsorted(num_after, max_num_taxa))
+    hit_leaf = num_splits > first_leaf and first_leaf < len(order)
+    num_splits = min(num_splits, first_leaf)
+    return SplitOrder(
+        0,
+        order[:num_splits].tolist(),
+        num_after[: num_splits + 1].tolist(),
+        hit_leaf,
+        atree=atree,
+    )
+
+
+def ultrametric_greedy_mmd(tree, num_taxa, sp_by_name, ultrametric_tol=5e-5):
+    split_order = ultrametric_split_order(
+        tree, num_taxa, ultrametric_tol=ultrametric_tol
+    )
+    return split_order.cut(num_taxa)
+
+
+def write_split_order(split_order, split_order_fp, clade_names=None):
+    """Writes one line per split: lineages after the split, and the node split.
+
+    `clade_names` is passed to SplitOrder.name_of.
+    """
+    header = "num-lineages\tage\tnum-leaves\tname-or-mrca\n"
+    so = split_order
+    with open(split_order_fp, "w") as outp:
+        outp.write(header)
+        for nd, num_after in zip(so.split_nodes, so.num_after[1:]):
+            age, nl = so.age_of(nd), so.num_leaves_below(nd)
+            nm = so.name_of(nd, clade_names)
+            outp.write(f"{num_after}\t{age}\t{nl}\t{nm}\n")
 
 
 def subtree_name(nd, mrca_notation=True):
@@ -110,6 +219,24 @@ def subtree_name(nd, mrca_notation=True):
         return shortest
 
 
+def _array_subtree_name(atree, nd, clade_names, mrca_notation=True):
+    """subtree_name for node `nd` of an ArrayTree."""
+    if nd in clade_names:
+        return clade_names[nd][-1]
+    children = atree.children_of(nd)
+    if not children:
+        return atree.leaf_labels[atree.leaf_lo[nd]]
+    assert len(children) > 1
+    shortest, sec_shortest = [
+        _array_subtree_name(atree, i, clade_names, mrca_notation=False)
+        for i in children[:2]
+    ]
+    if mrca_notation:
+        return f"MRCA({shortest} + {sec_shortest})"
+    else:
+        return shortest
+
+
 def anc_name(nd):
     par = nd.parent_node
     if par is None:
@@ -119,19 +246,184 @@ def anc_name(nd):
     return anc_name(par)
 
 
-def greedy_mmd(tree, num_taxa, sp_by_name):
+class _TipDistRows(object):
+    """Rows of the tip-to-tip patristic distance matrix, computed on demand.
+
+    Each row takes O(n) time. The additions are done in the same order as
+    in dendropy's PhylogeneticDistanceMatrix, so the distances (and hence
+    ties between them) are identical to the full matrix. Memory is the sum
+    of the tip depths rather than n^2.
+    """
+
+    def __init__(self, tree):
+        lca_index = LCAIndex.from_dendropy(tree)[0]
+        atree = lca_index.atree
+        self.lca_index = lca_index
+        self.atree = atree
+        parent = atree.parent.tolist()
+        edge_len = atree.edge_len.tolist()
+        leaf_depth = atree.depth[atree.leaf_nodes]
+        self.leaf_depth = leaf_depth
+        self.offsets = np.zeros(atree.num_leaves + 1, dtype=np.int64)
+        np.cumsum(leaf_depth + 1, out=self.offsets[1:])
+        # For each tip: its ancestors (tip first) and the path length to each,
+        #   summed from the tip upwards.
+        anc, up_len = [], []
+        for leaf in atree.leaf_nodes.tolist():
+            nd, h = leaf, 0.0
+            anc.append(nd)
+            up_len.append(h)
+            while parent[nd] >= 0:
+                h = h + edge_len[nd]
+                nd = parent[nd]
+                anc.append(nd)
+                up_len.append(h)
+        self.anc = np.array(anc, dtype=np.int64)
+        self.up_len = np.array(up_len, dtype=float)
+        self.anc_edge_len = atree.edge_len[self.anc]
+        # Longest path from each node down to one of its tips.
+        max_down = [float("-inf")] * atree.num_nodes
+        for nd in range(atree.num_nodes - 1, -1, -1):
+            if not atree.children[nd]:
+                max_down[nd] = 0.0
+            par = parent[nd]
+            if par >= 0:
+                max_down[par] = max(max_down[par], max_down[nd] + edge_len[nd])
+        self.max_down = max_down
+
+    def _path_from_root(self, leaf_pos):
+        o = self.offsets[leaf_pos]
+        return self.anc[o : o + 1 + self.leaf_depth[leaf_pos]][::-1].tolist()
+
+    def row(self, leaf_pos):
+        """Returns the distances from tip `leaf_pos` to every tip (in leaf order)."""
+        at = self.atree
+        depth_t = int(self.leaf_depth[leaf_pos])
+        tip = np.full(at.num_leaves, at.leaf_nodes[leaf_pos])
+        lca_depth = at.depth[self.lca_index.lca_batch(tip, at.leaf_nodes)]
+        # tips to the left of this one are in an earlier child of their MRCA
+        before = np.arange(at.num_leaves) < leaf_pos
+        v_at_mrca = self.offsets[:-1] + self.leaf_depth - lca_depth
+        t_at_mrca = self.offsets[leaf_pos] + depth_t - lca_depth
+        v_to_mrca = self.up_len[v_at_mrca]
+        v_to_child = self.up_len[v_at_mrca - 1]
+        v_child_len = self.anc_edge_len[v_at_mrca - 1]
+        t_to_mrca = self.up_len[t_at_mrca]
+        t_to_child = self.up_len[t_at_mrca - 1]
+        t_child_len = self.anc_edge_len[t_at_mrca - 1]
+        dists = np.where(
+            before,
+            (v_to_mrca + t_to_child) + t_child_len,
+            (t_to_mrca + v_to_child) + v_child_len,
+        )
+        dists[leaf_pos] = 0.0
+        return dists
+
+    def _row_max(self, leaf_pos):
+        at = self.atree
+        md, edge_len = self.max_down, at.edge_len
+        depth_t = int(self.leaf_depth[leaf_pos])
+        o = self.offsets[leaf_pos]
+        path = self._path_from_root(leaf_pos)
+        row_max = 0.0
+        for d in range(depth_t):
+            m, ci = path[d], path[d + 1]
+            t_to_m = self.up_len[o + depth_t - d]
+            t_to_ci = self.up_len[o + depth_t - d - 1]
+            for cj in at.children[m]:
+                if cj < ci:
+                    v = ((md[cj] + edge_len[cj]) + t_to_ci) + edge_len[ci]
+                elif cj > ci:
+                    v = (t_to_m + md[cj]) + edge_len[cj]
+                else:
+                    continue
+                if v > row_max:
+                    row_max = v
+        return row_max
+
+    def first_max_pair(self):
+        """Returns (max_dist, row, col) for the first maximal cell in row-major order."""
+        at = self.atree
+        md, edge_len = self.max_down, at.edge_len
+        max_dist = 0.0
+        for ch in at.children:
+            prefix = float("-inf")
+            for idx, c in enumerate(ch):
+                if idx > 0:
+                    v = (prefix + md[c]) + edge_len[c]
+                    if v > max_dist:
+                        max_dist = v
+                prefix = max(prefix, md[c] + edge_len[c])
+        for leaf_pos in range(at.num_leaves):
+            if self._row_max(leaf_pos) == max_dist:
+                row = self.row(leaf_pos)
+                col = int(np.flatnonzero(row == max_dist)[0])
+                return max_dist, leaf_pos, col
+        assert False
+
+
+def greedy_mmd(tree, num_taxa, sp_by_name, full_matrix=False):
     """Selects `num_taxa` from the tips of `tree`.
 
     `sp_by_name` should be a dict mapping a name to Species object.
     Every tip label in the tree must be in sp_by_name
+
+    By default the min distance from each tip to the selected set is kept
+    as a running vector that is updated with one O(n) row of patristic
+    distances per selected tip. `full_matrix=True` uses the older approach
+    of building the full patristic distance matrix; both select the same
+    tips.
     """
-    # not efficiently updating min dist yet
     taxa_list = [i.taxon for i in tree.leaf_nodes()]
     taxa_label_list = [i.label for i in taxa_list]
     if num_taxa == len(taxa_label_list):
         return taxa_label_list
     if num_taxa > len(taxa_label_list):
         raise ValueError("num_taxa exceeds the number of taxa in the tree")
+    if full_matrix:
+        return _greedy_mmd_full_matrix(tree, num_taxa, sp_by_name, taxa_list)
+    dist_rows = _TipDistRows(tree)
+    max_dist, row_ind, col_ind = dist_rows.first_max_pair()
+    sel_tax_labels = [taxa_label_list[row_ind], taxa_label_list[col_ind]]
+    sel_inds = {row_ind, col_ind}
+    debug(f'Most divergent 2 taxa are "{sel_tax_labels}" with dist= {max_dist}')
+    loc1, loc2 = most_divergent_locs(sel_tax_labels[0], sel_tax_labels[1], sp_by_name)
+
+    TOL = 1.0e-5
+    curr_locs = [loc1, loc2]
+    min_dist = np.minimum(dist_rows.row(row_ind), dist_rows.row(col_ind))
+    selected = np.zeros(len(taxa_list), dtype=bool)
+    selected[list(sel_inds)] = True
+    while len(sel_inds) < num_taxa:
+        debug(f"Finding taxon {1 + len(sel_inds)}...")
+        cand = np.flatnonzero(~selected)
+        cand_min_dist = min_dist[cand]
+        # Same tie set as a scan in index order that restarts the set
+        #   whenever a strictly larger value is found.
+        first = int(np.argmax(cand_min_dist))
+        max_min_dist = float(cand_min_dist[first])
+        mmd_ind_set = set()
+        mmd_ind_set.add(int(cand[first]))
+        trailing = cand_min_dist[first + 1 :]
+        for row_ind in cand[first + 1 :][np.abs(trailing - max_min_dist) < TOL]:
+            mmd_ind_set.add(int(row_ind))
+        tied_tax = [(taxa_label_list[i], i) for i in mmd_ind_set]
+        mmd_ind, sel_loc = sel_most_geo_div_taxon(tied_tax, curr_locs, sp_by_name)
+        ntl = taxa_label_list[mmd_ind]
+        debug(
+            f'    taxon {1 + len(sel_inds)} = "{ntl}" with MD = {max_min_dist} set = {mmd_ind_set}'
+        )
+        sel_tax_labels.append(ntl)
+        sel_inds.add(mmd_ind)
+        selected[mmd_ind] = True
+        np.minimum(min_dist, dist_rows.row(mmd_ind), out=min_dist)
+        curr_locs.append(sel_loc)
+    debug("Taxa selected, cleaning up...")
+    return sel_tax_labels
+
+
+def _greedy_mmd_full_matrix(tree, num_taxa, sp_by_name, taxa_list):
+    taxa_label_list = [i.label for i in taxa_list]
     debug(f"Calculating patristic distance matrix")
     pdmc = PhylogeneticDistanceMatrix.from_tree(tree)
     # Making a shallow copy of the distance matrix here. just being lazy...
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 import sys
 import os
+import time
 from .logs import info
+from .laminar import LaminarSolver
+from .subproblem_cache import SubproblemCache
+from .taxon_index import iter_bits, popcount
 
 
 class CCResolution(object):
@@ -18,7 +22,65 @@ class CCResolution(object):
         return self._score
 
 
-def cc_for_subset(leaves, possible_sets, par_cc):
+class _LabelIndex(object):
+    """Number of subsets holding each label, over a collection of subsets.
+
+    An index built from the subsets themselves also holds, in by_label, the
+    positions (in `subsets`) of the subsets holding each label. Building it
+    takes time linear in the total size of the subsets.
+    """
+
+    def __init__(self, subsets):
+        self.subsets = subsets
+        by_label = {}
+        for idx, subset in enumerate(subsets):
+            for label in subset:
+                by_label.setdefault(label, []).append(idx)
+        self.by_label = by_label
+        self.counts = {label: len(ids) for label, ids in by_label.items()}
+
+    @classmethod
+    def derived(cls, parent, kept, removed, labels):
+        """Returns the counts over `kept` for the labels in `labels`.
+
+        `kept` and `removed` split parent.subsets. The counts are updated
+        from the parent's by removing the subsets in `removed`, unless it is
+        cheaper to count the kept ones, so this takes O(len(labels)) plus the
+        total size of the smaller of `removed` and `kept`.
+        """
+        if len(removed) >= len(kept):
+            return cls(kept)
+        index = cls.__new__(cls)
+        index.subsets = kept
+        index.by_label = None
+        pc = parent.counts
+        counts = {label: pc.get(label, 0) for label in labels}
+        for subset in removed:
+            for label in subset:
+                if label in counts:
+                    counts[label] -= 1
+        index.counts = counts
+        return index
+
+    def least_frequent(self, labels):
+        """Returns the first of `labels` with the lowest count, in O(len(labels))."""
+        counts = self.counts
+        return min(labels, key=lambda label: counts.get(label, 0))
+
+    def most_frequent(self, labels):
+        """Returns the first of `labels` with the highest count, in O(len(labels))."""
+        counts = self.counts
+        return max(labels, key=lambda label: counts.get(label, 0))
+
+
+def cc_for_subset(leaves, possible_sets, par_cc, removed):
+    """Returns a table of (num_subsets, score, subsets) rows for the best
+    resolutions of `leaves` using `possible_sets`, or None if they cannot
+    cover `leaves`.
+
+    `removed` holds the subsets indexed by par_cc.label_index that are not
+    in `possible_sets`; the counts of the sub-problem are derived from it.
+    """
     assert possible_sets
     assert par_cc is not None
     psl = set()
@@ -33,44 +95,46 @@ def cc_for_subset(leaves, possible_sets, par_cc):
     if cache_hit is not None:
         # info(f"Cache hit for {len(leaves)} leaves and {len(possible_sets)} sets!")
         return cache_hit
+    start = time.perf_counter()
     nsw = {}
     for ps in possible_sets:
         nsw[ps] = par_cc.subset_wts[ps]
-    cc_cc = par_cc.compat_cache
     sub_cc = ConnectedComponent(leaves=leaves, subset_wts=nsw, top_cc=par_cc.top_cc)
     sub_cc.indent = "  " + par_cc.indent
-    sub_cc.fill_resolutions()
-    cache[leaves] = sub_cc
-    return sub_cc
+    if par_cc.label_index is not None:
+        sub_cc.label_index = _LabelIndex.derived(
+            par_cc.label_index, list(nsw.keys()), removed, leaves
+        )
+    sub_cc.fill_resolutions(use_bitsets=False)
+    table = tuple(
+        (num_subs, res.score, tuple(res.subsets))
+        for num_subs, res in sub_cc.resolutions.items()
+    )
+    cache.put(leaves, table, time.perf_counter() - start)
+    return table
 
 
 def simplify_and_solve(cc):
     assert cc.top_cc is cc  # just intended for top-level
-    to_check = set(cc.leaves)
+    # Labels held by exactly the same subsets are replaced by one new label.
+    index = _LabelIndex(list(cc.subset_wts.keys()))
+    by_occurrence = {}
+    for label in cc.leaves:
+        key = tuple(index.by_label.get(label, ()))
+        by_occurrence.setdefault(key, []).append(label)
     nlabel_set = set(cc.leaves)
     fmap = {}
     rmap = {}
-    while to_check:
-        el = next(iter(to_check))
-        all_poss = set(to_check)
-        all_poss.remove(el)
-        for k in cc.subset_wts.keys():
-            if el in k:
-                all_poss.intersection_update(k)
-                if not all_poss:
-                    break
-        if all_poss:
-            all_poss.add(el)
-            new_name = f"_lg_repl_name{len(fmap)}"
-            assert new_name not in cc.leaves
-            fsap = frozenset(all_poss)
-            fmap[fsap] = new_name
-            rmap[new_name] = fsap
-            to_check = to_check.difference(fsap)
-            nlabel_set = nlabel_set.difference(fsap)
-            nlabel_set.add(new_name)
-        else:
-            to_check.remove(el)
+    for group in by_occurrence.values():
+        if len(group) < 2:
+            continue
+        new_name = f"_lg_repl_name{len(fmap)}"
+        assert new_name not in cc.leaves
+        fsap = frozenset(group)
+        fmap[fsap] = new_name
+        rmap[new_name] = fsap
+        nlabel_set = nlabel_set.difference(fsap)
+        nlabel_set.add(new_name)
     new_subset_wts = {}
     for k, sc in cc.subset_wts.items():
         y = set(k)
@@ -80,7 +144,12 @@ def simplify_and_solve(cc):
             y = y.difference(fk)
             y.add(nv)
         new_subset_wts[frozenset(y)] = sc
-    scc = ConnectedComponent(leaves=frozenset(nlabel_set), subset_wts=new_subset_wts)
+    scc = ConnectedComponent(
+        leaves=frozenset(nlabel_set),
+        subset_wts=new_subset_wts,
+        cache_max_entries=cc.cache_max_entries,
+        cache_max_bytes=cc.cache_max_bytes,
+    )
     scc.simplified = True
     return scc, rmap
 
@@ -94,22 +163,43 @@ def expand_subset_trans(subset, rmap):
     return frozenset(ms)
 
 
+# Default memory budget of the sub-problem cache of the frozenset search.
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
 class ConnectedComponent(object):
     def __init__(
-        self, label_set=None, freq=None, leaves=None, subset_wts=None, top_cc=None
+        self,
+        label_set=None,
+        freq=None,
+        leaves=None,
+        subset_wts=None,
+        top_cc=None,
+        cache_max_entries=None,
+        cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+        memo_max_bytes=None,
     ):
         self.leaves = set()
         self.resolutions = {}
         self.min_num_subs = None
         self.max_num_subs = None
         self.indent = ""
+        self.label_index = None
         if top_cc is None:
             self.top_cc = self
-            self.cache = {}
+            self.cache_max_entries = cache_max_entries
+            self.cache_max_bytes = cache_max_bytes
+            self.memo_max_bytes = memo_max_bytes
+            self.cache = SubproblemCache(
+                max_entries=cache_max_entries, max_bytes=cache_max_bytes
+            )
             self.compat_cache = {}
             self.simplified = False
         else:
             self.top_cc = top_cc
+            self.cache_max_entries = top_cc.cache_max_entries
+            self.cache_max_bytes = top_cc.cache_max_bytes
+            self.memo_max_bytes = top_cc.memo_max_bytes
             self.cache = top_cc.cache
             self.compat_cache = top_cc.compat_cache
             self.simplified = True
@@ -177,25 +267,33 @@ class ConnectedComponent(object):
     def _choose_one_possible_label(self, in_leaves, possible):
         assert len(possible) > 0
         labels_left = self.leaves.difference(in_leaves)
+        if self.label_index is None or self.label_index.subsets is not possible:
+            self.label_index = _LabelIndex(possible)
         USE_MOST_FREQ = False
         if USE_MOST_FREQ:
-            most_freq_label, most_freq_count = None, 0
-            for label in labels_left:
-                reps = sum([1 for i in possible if label in i])
-                if reps > most_freq_count:
-                    most_freq_label, most_freq_count = label, reps
-            return most_freq_label
-        least_freq_label, least_freq_count = None, 1 + len(possible)
-        for label in labels_left:
-            reps = sum([1 for i in possible if label in i])
-            if reps < least_freq_count:
-                least_freq_label, least_freq_count = label, reps
-        return least_freq_label
-
-    def fill_resolutions(self):
+            return self.label_index.most_frequent(labels_left)
+        return self.label_index.least_frequent(labels_left)
+
+    def fill_resolutions(self, use_bitsets=True):
+        """Fills self.resolutions with the best resolution of each size.
+
+        By default the bitset LaminarSolver (which hands crossing blocks to
+        PartitionEngine) is used; use_bitsets=False runs the original
+        frozenset search. With the bitset solvers, the memo of PartitionEngine
+        is bounded by `memo_max_bytes` (given to the constructor), as the
+        frozenset search's cache is by `cache_max_bytes`.
+        """
+        if use_bitsets:
+            self.resolutions = {}
+            solver = LaminarSolver(self.subset_wts, memo_max_bytes=self.memo_max_bytes)
+            for num_subs, el in solver.solve().items():
+                score, subsets = el
+                self.add_resolution(CCResolution(subsets=subsets, sum_score=score))
+            return
         if not self.simplified:
             scc, trans_obj = simplify_and_solve(self)
-            scc.fill_resolutions()
+            scc.fill_resolutions(use_bitsets=False)
+            scc.cache.log_stats()
             # scc.write(sys.stdout)
             self.resolutions = scc.resolutions
             for res in self.resolutions.values():
@@ -204,7 +302,9 @@ class ConnectedComponent(object):
             self.max_num_subs = scc.max_num_subs
             return
         if self.cache is None:
-            self.cache = {}
+            self.cache = SubproblemCache(
+                max_entries=self.cache_max_entries, max_bytes=self.cache_max_bytes
+            )
             assert self.compat_cache is None
             self.compat_cache = {}
         self.resolutions = {}
@@ -223,7 +323,11 @@ class ConnectedComponent(object):
             res = CCResolution(subsets=forced, sum_score=sum_sc)
             self.add_resolution(res)
             return
-        possible = [i for i in all_subsets if force_inc_leaves.isdisjoint(i)]
+        if not forced and self.label_index is not None:
+            # counts passed down by cc_for_subset are over all of the subsets
+            possible = self.label_index.subsets
+        else:
+            possible = [i for i in all_subsets if force_inc_leaves.isdisjoint(i)]
         try:
             self._rec_fill_res(forced, force_inc_leaves, possible, sum_sc)
         except AssertionError:
@@ -268,12 +372,14 @@ class ConnectedComponent(object):
                 continue
             if not po_list:
                 continue
-            sub_cc = cc_for_subset(leaves_needed, po_list, self)
-            if sub_cc is None:
+            # Everything in `possible` that holds the label or meets `i`
+            removed = alternatives + list(others.difference(po_list))
+            sub_table = cc_for_subset(leaves_needed, po_list, self, removed)
+            if sub_table is None:
                 continue
-            for num_subs, res in sub_cc.resolutions.items():
+            for num_subs, sub_sc, sub_subsets in sub_table:
                 bigger_res = CCResolution(
-                    in_sets + [i] + res.subsets, i_sc + sum_sc + res.score
+                    in_sets + [i] + list(sub_subsets), i_sc + sum_sc + sub_sc
                 )
                 self.add_resolution(bigger_res)
 
@@ -374,45 +480,98 @@ class ConnectedComponent(object):
         return self.leaves == other.leaves and self.subset_wts == other.subset_wts
 
 
+class MaskComponent(object):
+    """Connected component of a LabelGraph, with label sets as TaxonIndex masks."""
+
+    def __init__(self, mask, freq):
+        self.leaves = mask
+        self.subset_wts = {mask: freq}
+
+    def add_set(self, mask, freq):
+        self.leaves |= mask
+        self.subset_wts[mask] = freq
+
+    def to_connected_component(self, taxon_index):
+        fs = taxon_index.frozenset_of
+        return ConnectedComponent(
+            leaves=fs(self.leaves),
+            subset_wts={fs(k): v for k, v in self.subset_wts.items()},
+        )
+
+
 class LabelGraph(object):
-    def __init__(self):
-        self.full_label_set = set()
+    """Groups label sets (TaxonIndex masks) into components that share labels.
+
+    Labels that share a set are joined in a union-find (with path halving and
+    union by size) over their TaxonIndex bits. The components themselves are
+    only built, from the sets added so far, when they are asked for.
+    """
+
+    def __init__(self, taxon_index):
+        self.taxon_index = taxon_index
+        self.full_label_set = 0
         self.by_freq = []
-        self.leaf_to_comp = {}
-        self.components = set()
+        self.subset_wts = {}
+        self._parent = {}
+        self._size = {}
+        self._components = None
+
+    def _find(self, el):
+        parent = self._parent
+        while parent[el] != el:
+            parent[el] = parent[parent[el]]
+            el = parent[el]
+        return el
+
+    def _union(self, a, b):
+        ra, rb = self._find(a), self._find(b)
+        if ra == rb:
+            return ra
+        if self._size[ra] < self._size[rb]:
+            ra, rb = rb, ra
+        self._parent[rb] = ra
+        self._size[ra] += self._size.pop(rb)
+        return ra
 
     def add_set(self, ls, freq):
-        self.full_label_set.update(ls)
+        self.full_label_set |= ls
         self.by_freq.append((freq, ls))
-        comp_set = set()
-        for el in ls:
-            component = self.leaf_to_comp.get(el)
-            if component is not None:
-                comp_set.add(component)
-        if comp_set:
-            comp_list = list(comp_set)
-            first_comp = comp_list[0]
-            for c in comp_list[1:]:
-                self.merge_comps(first_comp, c)
-            first_comp.add_set(ls, freq)
-        else:
-            first_comp = ConnectedComponent(label_set=ls, freq=freq)
-            self.components.add(first_comp)
-            # debug(f"Adding comp {first_comp}")
-        for el in ls:
-            self.leaf_to_comp[el] = first_comp
-
-    def merge_comps(self, first_comp, other):
-        first_comp.leaves.update(other.leaves)
-        first_comp.subset_wts.update(other.subset_wts)
-        # debug(f"Removing comp {other} after merge with {first_comp}")
-        self.components.remove(other)
-        for el in other.leaves:
-            self.leaf_to_comp[el] = first_comp
+        self.subset_wts[ls] = freq
+        self._components = None
+        parent, size = self._parent, self._size
+        root = None
+        for el in iter_bits(ls):
+            if el not in parent:
+                # a new label joins the set's component directly
+                if root is None:
+                    root = el
+                    size[el] = 0
+                parent[el] = root
+                size[root] += 1
+            elif root is None:
+                root = self._find(el)
+            elif parent[el] != root:
+                root = self._union(root, el)
+
+    @property
+    def components(self):
+        """The MaskComponents of the sets added so far."""
+        if self._components is None:
+            by_root = {}
+            for ls, freq in self.subset_wts.items():
+                root = self._find((ls & -ls).bit_length() - 1)
+                comp = by_root.get(root)
+                if comp is None:
+                    by_root[root] = MaskComponent(ls, freq)
+                else:
+                    comp.add_set(ls, freq)
+            self._components = list(by_root.values())
+        return self._components
 
     def _get_sortable_comp_info(self):
         sortable = [
-            (len(i.leaves), len(i.subset_wts), i.leaves, i) for i in self.components
+            (popcount(i.leaves), len(i.subset_wts), i.leaves, i)
+            for i in self.components
         ]
         sortable.sort()
         return sortable
@@ -422,24 +581,23 @@ class LabelGraph(object):
         out.write(f"{len(sortable)} components:\n")
         for ind, el in enumerate(sortable):
             out.write(f"Component #{1 + ind}: ")
-            el[-1].write(out)
+            el[-1].to_connected_component(self.taxon_index).write(out)
 
     def write_components(self, fprefix):
         files_created = []
         for ind, el in enumerate(self._get_sortable_comp_info()):
             fp = f"{fprefix}-{1+ind}.csv"
             files_created.append(fp)
-            _serialize_component(fp, el[-1])
+            _serialize_component(fp, el[-1], self.taxon_index)
         return files_created
 
     def write_components_writer(self, fprefix):
         for ind, el in enumerate(self._get_sortable_comp_info()):
             fp = f"{fprefix}-{1+ind}.py"
-            comp = el[-1]
+            comp = el[-1].to_connected_component(self.taxon_index)
             with open(fp, "w") as outp:
                 info(f"Serializing component #{1 + ind} to {fp} ...")
-                outp.write(
-                    f"""#!/bin/env python
+                outp.write(f"""#!/bin/env python
 from geotaxsel.label_graph import ConnectedComponent
 import sys
 
@@ -447,16 +605,14 @@ cc_{1+ind} = ConnectedComponent(leaves={repr(comp.leaves)},
                                subset_wts={repr(comp.subset_wts)}
                                )
 cc_{1+ind}.write(sys.stdout)
-"""
-                )
+""")
 
 
-def _serialize_component(fp, comp):
+def _serialize_component(fp, comp, taxon_index):
     """Writes 1 component as csv as expected by max-weight-partition"""
     with open(fp, "w") as outp:
         outp.write(f"{len(comp.subset_wts)}\n")
         for tax_set, wt in comp.subset_wts.items():
-            sl = list(tax_set)
-            sl.sort()
-            strf = ",".join(sl)
+            # labels_of returns the labels in sorted order
+            strf = ",".join(taxon_index.labels_of(tax_set))
             outp.write(f"{wt},{strf}\n")
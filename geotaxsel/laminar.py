@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""Max-weight partition by dynamic programming over nested subsets.
+
+The subsets of a component come from clades cut out of trees, so most
+pairs of them are either nested or disjoint. Two subsets "cross" if they
+overlap without either holding the other. Subsets that are linked by
+chains of crossing pairs form a crossing block, and a block is treated as
+a single node whose label set is the union of its members. Any subset
+outside a block either holds that union, is disjoint from it, or lies
+inside one of the block's members. So the nodes form a laminar family,
+which is arranged as a containment forest.
+
+The best score for each number of subsets is then found bottom-up:
+  * a subset node can be chosen itself (1 subset), or replaced by a
+    partition of its labels into the nodes below it, if they cover all
+    of its labels (the max-plus convolution of their frontiers);
+  * a crossing block, together with every subset below it, is solved by
+    the general search in PartitionEngine;
+  * the roots of the forest are combined by convolution.
+Only the crossing blocks need exponential time.
+"""
+
+from .logs import debug
+from .partition_engine import PartitionEngine
+from .taxon_index import iter_bits, popcount
+
+
+def _convolve(first, second):
+    """Max-plus convolution of two {size: (score, resolution)} frontiers."""
+    ret = {}
+    for size_a, el_a in first.items():
+        for size_b, el_b in second.items():
+            sc = el_a[0] + el_b[0]
+            size = size_a + size_b
+            prev = ret.get(size)
+            if prev is None or sc > prev[0]:
+                ret[size] = (sc, (el_a[1], el_b[1]))
+    return ret
+
+
+def _flatten(res):
+    """Returns the subset indices in a nested resolution."""
+    ret = []
+    stack = [res]
+    while stack:
+        el = stack.pop()
+        if isinstance(el, tuple):
+            stack.extend(el)
+        elif isinstance(el, list):
+            ret.extend(el)
+        else:
+            ret.append(el)
+    return ret
+
+
+class LaminarSolver(object):
+    def __init__(self, subset_wts, memo_max_bytes=None):
+        self.subset_wts = subset_wts
+        # passed to each PartitionEngine
+        self.memo_max_bytes = memo_max_bytes
+        self.subsets = list(subset_wts.keys())
+        self.weights = [subset_wts[i] for i in self.subsets]
+        labels = set()
+        for subset in self.subsets:
+            labels.update(subset)
+        label_bit = {label: idx for idx, label in enumerate(sorted(labels))}
+        self.masks = []
+        for subset in self.subsets:
+            m = 0
+            for label in subset:
+                m |= 1 << label_bit[label]
+            self.masks.append(m)
+        self.all_labels = (1 << len(label_bit)) - 1
+        self.blocks = self._crossing_blocks()
+
+    def _crossing_blocks(self):
+        """Returns a list of lists of subset indices; one list per crossing block."""
+        masks = self.masks
+        by_label = {}
+        for sub_idx, mask in enumerate(masks):
+            for label_idx in iter_bits(mask):
+                by_label.setdefault(label_idx, []).append(sub_idx)
+        par = list(range(len(masks)))
+
+        def find(x):
+            while par[x] != x:
+                par[x] = par[par[x]]
+                x = par[x]
+            return x
+
+        for sub_idx, mask in enumerate(masks):
+            seen = set()
+            for label_idx in iter_bits(mask):
+                for other in by_label[label_idx]:
+                    if other <= sub_idx or other in seen:
+                        continue
+                    seen.add(other)
+                    common = mask & masks[other]
+                    if common != mask and common != masks[other]:
+                        ra, rb = find(sub_idx), find(other)
+                        if ra != rb:
+                            par[rb] = ra
+        blocks = {}
+        for sub_idx in range(len(masks)):
+            blocks.setdefault(find(sub_idx), []).append(sub_idx)
+        return list(blocks.values())
+
+    def _build_forest(self):
+        """Returns (nodes, children, roots).
+
+        Each node is (label mask, list of subset indices); nodes with more
+        than one subset are crossing blocks.
+        """
+        nodes = []
+        for members in self.blocks:
+            union = 0
+            for sub_idx in members:
+                union |= self.masks[sub_idx]
+            nodes.append((union, members))
+        # Larger nodes first; a subset equal to a block's union holds the block.
+        nodes.sort(key=lambda x: (-popcount(x[0]), len(x[1])))
+        children = [[] for i in nodes]
+        roots = []
+        owner = {}
+        for node_idx, node in enumerate(nodes):
+            union = node[0]
+            par_idx = owner.get((union & -union).bit_length() - 1)
+            if par_idx is None:
+                roots.append(node_idx)
+            else:
+                children[par_idx].append(node_idx)
+            for label_idx in iter_bits(union):
+                owner[label_idx] = node_idx
+        return nodes, children, roots
+
+    @staticmethod
+    def _subtree_subsets(node_idx, children, nodes):
+        """Returns the subset indices of a node and of every node below it."""
+        in_block = []
+        stack = [node_idx]
+        while stack:
+            nd = stack.pop()
+            in_block.extend(nodes[nd][1])
+            stack.extend(children[nd])
+        return in_block
+
+    @staticmethod
+    def _absorbed(nodes, children):
+        """Returns a list of flags for the nodes that lie below a crossing block."""
+        absorbed = [False] * len(nodes)
+        for node_idx, node in enumerate(nodes):
+            if absorbed[node_idx] or len(node[1]) > 1:
+                for child_idx in children[node_idx]:
+                    absorbed[child_idx] = True
+        return absorbed
+
+    def block_problem_sizes(self):
+        """Returns the number of subsets in each problem given to PartitionEngine.
+
+        Each crossing block is solved together with every subset below it,
+        and that search is the only part of solve() that takes exponential
+        time.
+        """
+        if len(self.blocks) == 1 and len(self.blocks[0]) > 1:
+            return [len(self.subsets)]
+        nodes, children, roots = self._build_forest()
+        absorbed = self._absorbed(nodes, children)
+        return [
+            len(self._subtree_subsets(node_idx, children, nodes))
+            for node_idx, node in enumerate(nodes)
+            if len(node[1]) > 1 and not absorbed[node_idx]
+        ]
+
+    def _block_frontier(self, node_idx, nodes, children):
+        """Solves a crossing block and everything below it with PartitionEngine."""
+        in_block = self._subtree_subsets(node_idx, children, nodes)
+        sub_wts = {self.subsets[i]: self.weights[i] for i in in_block}
+        sub_idx_of = {self.subsets[i]: i for i in in_block}
+        frontier = {}
+        engine = PartitionEngine(sub_wts, memo_max_bytes=self.memo_max_bytes)
+        for size, el in engine.solve().items():
+            score, subsets = el
+            frontier[size] = (score, [sub_idx_of[i] for i in subsets])
+        debug(
+            f"LaminarSolver: crossing block of {len(nodes[node_idx][1])} subsets and {len(in_block)} in all"
+        )
+        return frontier
+
+    def solve(self):
+        """Returns a dict of size -> (best score, list of subsets).
+
+        The result is the same as PartitionEngine(subset_wts).solve().
+        """
+        if not self.subsets:
+            return {}
+        if len(self.blocks) == 1 and len(self.blocks[0]) > 1:
+            engine = PartitionEngine(
+                self.subset_wts, memo_max_bytes=self.memo_max_bytes
+            )
+            return engine.solve()
+        nodes, children, roots = self._build_forest()
+        # Nodes below a crossing block are solved along with the block.
+        absorbed = self._absorbed(nodes, children)
+        frontiers = [None] * len(nodes)
+        # Children are placed after their parents, so go in reverse.
+        for node_idx in range(len(nodes) - 1, -1, -1):
+            if absorbed[node_idx]:
+                continue
+            union, members = nodes[node_idx]
+            if len(members) > 1:
+                frontiers[node_idx] = self._block_frontier(node_idx, nodes, children)
+                continue
+            sub_idx = members[0]
+            frontier = None
+            covered = 0
+            for child_idx in children[node_idx]:
+                covered |= nodes[child_idx][0]
+                child_f = frontiers[child_idx]
+                frontier = child_f if frontier is None else _convolve(frontier, child_f)
+            if frontier is None or covered != union:
+                frontier = {}
+            prev = frontier.get(1)
+            if prev is None or self.weights[sub_idx] >= prev[0]:
+                frontier[1] = (self.weights[sub_idx], sub_idx)
+            frontiers[node_idx] = frontier
+            for child_idx in children[node_idx]:
+                frontiers[child_idx] = None
+        frontier = None
+        covered = 0
+        for node_idx in roots:
+            covered |= nodes[node_idx][0]
+            root_f = frontiers[node_idx]
+            frontier = root_f if frontier is None else _convolve(frontier, root_f)
+        assert covered == self.all_labels
+        ret = {}
+        for size in sorted(frontier.keys()):
+            score, res = frontier[size]
+            ret[size] = (score, [self.subsets[i] for i in _flatten(res)])
+        return ret
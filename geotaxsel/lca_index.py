@@ -0,0 +1,101 @@
+#! /usr/bin/env python3
+import numpy as np
+
+from .array_tree import ArrayTree
+
+
+class LCAIndex(object):
+    """Constant-time most-recent-common-ancestor and patristic distance queries.
+
+    Built once per tree in O(n log n) time and memory from an Euler tour of
+    the tree and a sparse table of range-minimum depths over that tour.
+    Nodes are referred to by their preorder index in the ArrayTree.
+    """
+
+    def __init__(self, atree):
+        self.atree = atree
+        num_nodes = atree.num_nodes
+        parent = atree.parent
+        root_dist = np.zeros(num_nodes)
+        edge_len = atree.edge_len
+        # parents precede their children in preorder
+        for nd in range(1, num_nodes):
+            root_dist[nd] = root_dist[parent[nd]] + edge_len[nd]
+        self.root_dist = root_dist
+        self.depth = atree.depth
+
+        euler = []
+        first = np.zeros(num_nodes, dtype=np.int64)
+        stack = [(0, 0)]
+        while stack:
+            nd, next_child = stack.pop()
+            if next_child == 0:
+                first[nd] = len(euler)
+            euler.append(nd)
+            children = atree.children[nd]
+            if next_child < len(children):
+                stack.append((nd, next_child + 1))
+                stack.append((children[next_child], 0))
+        self.euler = np.array(euler, dtype=np.int64)
+        self.first = first
+        self._build_sparse_table()
+
+    def _build_sparse_table(self):
+        euler_depth = self.depth[self.euler]
+        n = len(self.euler)
+        num_levels = 1
+        while (1 << num_levels) <= n:
+            num_levels += 1
+        # table[k, i] is the tour position of the shallowest node in
+        #   euler[i : i + 2**k]
+        table = np.zeros((num_levels, n), dtype=np.int64)
+        table[0] = np.arange(n, dtype=np.int64)
+        for k in range(1, num_levels):
+            span = 1 << (k - 1)
+            prev = table[k - 1]
+            left, right = prev[: n - 2 * span + 1], prev[span : n - span + 1]
+            table[k, : n - 2 * span + 1] = np.where(
+                euler_depth[left] <= euler_depth[right], left, right
+            )
+        self._table = table
+        self._euler_depth = euler_depth
+        log2 = np.zeros(n + 1, dtype=np.int64)
+        for i in range(2, n + 1):
+            log2[i] = log2[i // 2] + 1
+        self._log2 = log2
+
+    @classmethod
+    def from_dendropy(cls, tree):
+        """Returns (LCAIndex, list of dendropy nodes in preorder)."""
+        atree, nodes = ArrayTree.from_dendropy(tree)
+        return cls(atree), nodes
+
+    def lca(self, a, b):
+        return int(self.lca_batch(a, b))
+
+    def patristic(self, a, b):
+        rd = self.root_dist
+        return float(rd[a] + rd[b] - 2.0 * rd[self.lca(a, b)])
+
+    def lca_batch(self, a, b):
+        """Returns the MRCA of each pair in the node index arrays `a` and `b`."""
+        fa, fb = self.first[a], self.first[b]
+        lo, hi = np.minimum(fa, fb), np.maximum(fa, fb)
+        k = self._log2[hi - lo + 1]
+        left = self._table[k, lo]
+        right = self._table[k, hi - (1 << k) + 1]
+        ed = self._euler_depth
+        return self.euler[np.where(ed[left] <= ed[right], left, right)]
+
+    def patristic_batch(self, a, b):
+        """Returns the patristic distance for each pair in `a` and `b`."""
+        a, b = np.asarray(a), np.asarray(b)
+        rd = self.root_dist
+        return rd[a] + rd[b] - 2.0 * rd[self.lca_batch(a, b)]
+
+    def pairwise_patristic(self, nodes):
+        """Returns the matrix of patristic distances among `nodes`."""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        a = np.repeat(nodes, len(nodes))
+        b = np.tile(nodes, len(nodes))
+        return self.patristic_batch(a, b).reshape(len(nodes), len(nodes))
@@ -1,19 +1,48 @@
 #!/usr/bin/env python
+import hashlib
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tempfile import mkdtemp
 import os
 import subprocess
+import threading
+import time
 from .logs import info
-from .label_graph import LabelGraph
+from .canonical import canonical_form
+from .label_graph import LabelGraph, MaskComponent, _serialize_component
+from .laminar import LaminarSolver
+from .reductions import reduce_components
+from .solver_cache import component_key
+from .taxon_index import TaxonIndex, popcount
 import json
+import numpy as np
 
 
 class ResolutionWrapper(object):
-    def __init__(self, res_list):
+    """Best score for each size of one component, or of several merged ones.
+
+    `scores[i]` is the best score with `min_num + i` subsets (-inf if there
+    is none). A wrapper read from a solver file keeps the subsets (as
+    TaxonIndex masks) of each size in `by_size`. After absorb, the wrapper
+    only holds the merged scores and, in `split`, the size taken from the
+    first of the two merged wrappers; the subsets are rebuilt by
+    subsets_for.
+    """
+
+    def __init__(self, res_list, taxon_index, label_groups=None):
+        """`label_groups` maps a label that stands for a group of labels
+        (see reduce_components) to the list of labels in the group. For a
+        copy of a component, it maps the labels of the component that was
+        solved to those of the copy.
+        """
         assert isinstance(res_list, list)
         self.min_num = None
         self.max_num = None
         self.by_size = {}
+        self.parts = None
+        self.split = None
+        self.source_fp = None
+        self.copy_idx = None
         for res in res_list:
             score = float(res["score"])
             assert isinstance(score, float)
@@ -23,12 +52,17 @@ class ResolutionWrapper(object):
             fz_list = []
             for i in subsets_list:
                 assert isinstance(i, list)
-                fz_list.append(frozenset(i))
+                if label_groups:
+                    i = [x for label in i for x in label_groups.get(label, (label,))]
+                fz_list.append(taxon_index.mask(i))
             if self.min_num is None or size < self.min_num:
                 self.min_num = size
             if self.max_num is None or size > self.max_num:
                 self.max_num = size
             self.by_size[size] = (score, fz_list)
+        self.scores = np.full(self.size_width, -np.inf)
+        for size, el in self.by_size.items():
+            self.scores[size - self.min_num] = el[0]
 
     @property
     def size_width(self):
@@ -36,75 +70,176 @@ class ResolutionWrapper(object):
 
     def pre_cond_check(self):
         try:
-            assert self.min_num == min(self.by_size.keys())
-            assert self.max_num == max(self.by_size.keys())
+            assert len(self.scores) == self.size_width
+            assert np.isfinite(self.scores[0])
+            assert np.isfinite(self.scores[-1])
         except:
             print(f"self.min_num = {self.min_num}")
             print(f"self.max_num = {self.max_num}")
-            print(f"self.by_size = {self.by_size}")
+            print(f"self.scores = {self.scores}")
             raise
 
-    def absorb(self, other, final_n, min_num_after):
-        # print(
-        #     f" enter absorb [{self.min_num}, {self.max_num}], [{other.min_num}, {other.max_num}], {final_n}, {min_num_after}"
-        # )
+    def _detach(self):
+        """Returns a wrapper that takes over the current contents of self."""
+        other = ResolutionWrapper.__new__(ResolutionWrapper)
+        other.__dict__.update(self.__dict__)
+        return other
+
+    def absorb(self, other, final_n, min_num_after, max_num_after=None):
+        """Merges `other` into self, keeping only sizes that can still add
+        up to `final_n` when the wrappers not yet merged contribute between
+        `min_num_after` and `max_num_after` subsets.
+
+        If `final_n` is None, every size is kept.
+        """
         self.pre_cond_check()
         other.pre_cond_check()
         nmin = self.min_num + other.min_num
         nmax = self.max_num + other.max_num
-        cropped_nmax = min(nmax, final_n - min_num_after)
-
-        o_min = other.min_num
-        o_max = other.max_num
-        nbs = {}
-        for tot in range(nmin, 1 + cropped_nmax):
-            best_score = float("-inf")
-            best_pair_lists = None
-            for this_idx in range(self.min_num, 1 + self.max_num):
-                other_idx = tot - this_idx
-                if other_idx < o_min:
-                    break
-                if other_idx > o_max:
-                    continue
-                s_el = self.by_size.get(this_idx)
-                if s_el is None:
-                    continue
-                o_el = other.by_size.get(other_idx)
-                if o_el is None:
-                    continue
-                s_score, s_subsets = s_el
-                o_score, o_subsets = o_el
-                curr_score = s_score + o_score
-                if curr_score > best_score:
-                    best_score = curr_score
-                    best_pair_lists = (s_subsets, o_subsets)
-            if best_pair_lists is not None:
-                nbs[tot] = (best_score, best_pair_lists[0] + best_pair_lists[1])
-            else:
-                info(f" No size combo added to {tot} !!")
-        self.by_size = nbs
-        self.min_num = nmin
-        self.max_num = cropped_nmax
+        cropped_nmin, cropped_nmax = nmin, nmax
+        if final_n is not None:
+            cropped_nmax = min(nmax, final_n - min_num_after)
+            if max_num_after is not None:
+                cropped_nmin = max(nmin, final_n - max_num_after)
+
+        # Max-plus convolution: row i of `combos` holds the scores of
+        #   self's (min_num + i) subsets plus each of other's sizes, shifted
+        #   so that column t is the total size nmin + t.
+        s_scores, o_scores = self.scores, other.scores
+        rows = np.arange(len(s_scores))[:, np.newaxis]
+        cols = rows + np.arange(len(o_scores))[np.newaxis, :]
+        combos = np.full((len(s_scores), nmax - nmin + 1), -np.inf)
+        combos[rows, cols] = s_scores[:, np.newaxis] + o_scores[np.newaxis, :]
+        lo, hi = cropped_nmin - nmin, cropped_nmax - nmin + 1
+        combos = combos[:, lo:hi]
+        # argmax picks the smallest size of self among ties
+        best_row = combos.argmax(axis=0)
+        scores = combos[best_row, np.arange(combos.shape[1])]
+        for tot in np.nonzero(np.isinf(scores))[0]:
+            info(f" No size combo added to {cropped_nmin + tot} !!")
+        # Drop sizes at either end that cannot be made
+        finite = np.nonzero(np.isfinite(scores))[0]
+        if len(finite) == 0:
+            raise RuntimeError(f"No combination of solutions selects {final_n}")
+        first, last = finite[0], finite[-1]
+
+        self.parts = (self._detach(), other)
+        self.by_size = None
+        self.split = best_row[first : last + 1] + self.min_num
+        self.scores = scores[first : last + 1]
+        self.min_num = cropped_nmin + int(first)
+        self.max_num = cropped_nmin + int(last)
         self.pre_cond_check()
-        # print(f" exit absorb [{self.min_num}, {self.max_num}] by_size len={len(self.by_size)}")
+
+    def score_for(self, size):
+        """Returns the best score for `size` subsets, or None."""
+        if size < self.min_num or size > self.max_num:
+            return None
+        sc = self.scores[size - self.min_num]
+        return None if np.isinf(sc) else float(sc)
+
+    def subsets_for(self, size):
+        """Returns the list of subset masks of the best resolution of `size`."""
+        ret = []
+        stack = [(self, size)]
+        while stack:
+            wrapper, size = stack.pop()
+            if wrapper.parts is None:
+                ret.extend(wrapper.by_size[size][1])
+                continue
+            first_size = int(wrapper.split[size - wrapper.min_num])
+            first, second = wrapper.parts
+            stack.append((second, size - first_size))
+            stack.append((first, first_size))
+        return ret
+
+    def leaf_wrappers(self):
+        """Returns the wrappers read from solver files, in merge order."""
+        ret = []
+        stack = [self]
+        while stack:
+            wrapper = stack.pop()
+            if wrapper.parts is None:
+                ret.append(wrapper)
+            else:
+                stack.append(wrapper.parts[1])
+                stack.append(wrapper.parts[0])
+        return ret
+
+    def to_json_obj(self, leaf_idx):
+        """Returns the merge tree as a JSON-able object.
+
+        Wrappers read from solver files are referred to by their index in
+        `leaf_idx`, a dict of id(wrapper) -> index.
+        """
+        if self.parts is None:
+            return {"leaf": leaf_idx[id(self)]}
+        return {
+            "min_num": self.min_num,
+            "scores": [None if np.isinf(i) else float(i) for i in self.scores],
+            "split": [int(i) for i in self.split],
+            "parts": [i.to_json_obj(leaf_idx) for i in self.parts],
+        }
+
+    @classmethod
+    def from_json_obj(cls, obj, leaves):
+        if "leaf" in obj:
+            return leaves[obj["leaf"]]
+        wrapper = cls.__new__(cls)
+        wrapper.by_size = None
+        wrapper.source_fp = None
+        wrapper.copy_idx = None
+        wrapper.parts = tuple(cls.from_json_obj(i, leaves) for i in obj["parts"])
+        wrapper.scores = np.array(
+            [-np.inf if i is None else i for i in obj["scores"]], dtype=float
+        )
+        wrapper.split = np.array(obj["split"], dtype=np.int64)
+        wrapper.min_num = obj["min_num"]
+        wrapper.max_num = wrapper.min_num + len(wrapper.scores) - 1
+        return wrapper
 
 
 PROB_FN = "problems.csv"
+# Saved merge of all of the components' solutions, for every total size.
+MERGED_DP_FN = "merged-dp.json"
+# Labels that stand for groups of labels in the reduced components.
+LABEL_GROUPS_FN = "label-groups.json"
+REDUCTIONS_FN = "reductions.tsv"
+# Label maps of the components that were not written because they are copies
+#   of another component.
+COPIES_FN = "copies.json"
 
 
-def serialize_problems_for_most_common_choice(rep_selections, temp_dir=None):
+def serialize_problems_for_most_common_choice(
+    rep_selections, taxon_index, temp_dir=None, reduce=True, dedup=True
+):
+    """Writes the components of `rep_selections` (TaxonIndex mask -> count).
+
+    Unless `reduce` is False, the components are first shrunk and split by
+    reduce_components. Unless `dedup` is False, components that are the same
+    problem up to their labels (see canonical_form) are written once, and
+    the label maps of the other copies are written to COPIES_FN.
+    """
     if temp_dir is None:
         temp_dir = mkdtemp(prefix="taxsel-scratch-", dir=os.curdir)
 
     with open(os.path.join(temp_dir, "TEMP_REP_SELS.py"), "w") as outp:
         outp.write("x = ")
-        outp.write(repr(rep_selections))
+        as_labels = {taxon_index.frozenset_of(k): v for k, v in rep_selections.items()}
+        outp.write(repr(as_labels))
         outp.write("\n")
-    lg = LabelGraph()
+    lg = LabelGraph(taxon_index)
     for k, v in rep_selections.items():
         lg.add_set(k, v)
     pref = os.path.join(temp_dir, "comp")
-    written = lg.write_components(pref)
+    fixed = None
+    if reduce:
+        components, fixed = _reduce_components(lg, taxon_index, temp_dir)
+    else:
+        components = lg.components
+    written = _write_components(components, pref, taxon_index, temp_dir, dedup)
+    if fixed:
+        written.append(_write_fixed(fixed, pref, taxon_index))
     tmp_loc = os.path.join(temp_dir, f".{PROB_FN}")
     with open(tmp_loc, "w") as flagf:
         for line in written:
@@ -114,75 +249,673 @@ def serialize_problems_for_most_common_choice(rep_selections, temp_dir=None):
     return temp_dir
 
 
-def _run_solver(inp_fp, out_fp, max_secs_per_run, num_greedy=0):
-    hide_out = out_fp + ".HIDE"
-    err_fp = out_fp + "-err.txt"
+def _reduce_components(lg, taxon_index, temp_dir):
+    """Returns (reduced components, fixed subsets) and writes the reports."""
+    reduced, fixed, label_groups, report = reduce_components(lg.components)
+    report.log()
+    with open(os.path.join(temp_dir, REDUCTIONS_FN), "w") as outp:
+        for line in report.lines():
+            outp.write(f"{line}\n")
+    if label_groups:
+        as_labels = {
+            taxon_index.labels[rep]: taxon_index.labels_of(group)
+            for rep, group in label_groups.items()
+        }
+        with open(os.path.join(temp_dir, LABEL_GROUPS_FN), "w") as outp:
+            json.dump(as_labels, outp, sort_keys=True)
+    return reduced, fixed
+
+
+def _write_components(components, fprefix, taxon_index, temp_dir, dedup):
+    """Writes one CSV per component (or per distinct form, if `dedup`).
+
+    A component with the same canonical form as one already written is not
+    written again. Its labels are recorded in COPIES_FN instead, as a dict
+    of the written file's labels to its own, under the written file's name.
+    """
+    files_created = []
+    sortable = [
+        (popcount(i.leaves), len(i.subset_wts), i.leaves, i) for i in components
+    ]
+    sortable.sort()
+    first_of_form = {}
+    copies = {}
+    for el in sortable:
+        comp = el[-1]
+        if dedup:
+            form, order = canonical_form(comp.subset_wts)
+            prev = first_of_form.get(form)
+            if prev is not None:
+                fp, first_order = prev
+                label_map = {
+                    taxon_index.labels[a]: taxon_index.labels[b]
+                    for a, b in zip(first_order, order)
+                }
+                copies.setdefault(os.path.basename(fp), []).append(label_map)
+                continue
+        fp = f"{fprefix}-{1 + len(files_created)}.csv"
+        files_created.append(fp)
+        _serialize_component(fp, comp, taxon_index)
+        if dedup:
+            first_of_form[form] = (fp, order)
+    if copies:
+        num_copies = sum(len(i) for i in copies.values())
+        info(
+            f"{num_copies} of {len(components)} components are copies of others and will not be solved again"
+        )
+        with open(os.path.join(temp_dir, COPIES_FN), "w") as outp:
+            json.dump(copies, outp, sort_keys=True)
+    return files_created
+
+
+def _write_fixed(fixed, fprefix, taxon_index):
+    """Writes the fixed subsets with their one resolution, so that the solver
+    is not run on them.
+    """
+    fp = f"{fprefix}-fixed.csv"
+    items = list(fixed.items())
+    fixed_comp = MaskComponent(*items[0])
+    for mask, wt in items[1:]:
+        fixed_comp.add_set(mask, wt)
+    _serialize_component(fp, fixed_comp, taxon_index)
+    res = {
+        "score": sum(fixed.values()),
+        "size": len(fixed),
+        "subsets": [taxon_index.labels_of(i) for i in fixed.keys()],
+    }
+    with open(fp[:-4] + ".json", "w") as outp:
+        json.dump([res], outp)
+    return fp
+
+
+def _read_label_groups(scratch_dir):
+    fp = os.path.join(scratch_dir, LABEL_GROUPS_FN)
+    if not os.path.isfile(fp):
+        return None
+    with open(fp, "r") as inp:
+        return json.load(inp)
+
+
+def _level_fp(out_fp):
+    assert out_fp.endswith(".json")
+    return out_fp[:-5] + ".level"
+
+
+def _read_start_level(out_fp):
+    """Returns the num_greedy level recorded for this component (or 0)."""
+    try:
+        with open(_level_fp(out_fp), "r") as inp:
+            return int(inp.read().strip())
+    except (OSError, ValueError):
+        return 0
+
+
+def _start_level(out_fp, cache=None, key=None):
+    """Returns the num_greedy level to start a solve of a component at.
+
+    This is the highest level recorded for it in the scratch dir (by an
+    earlier run that was stopped while escalating) or, if `cache` is given,
+    in the cache under its component_key `key` (by any earlier run).
+    """
+    level = _read_start_level(out_fp)
+    if cache is not None:
+        level = max(level, cache.get_level(key) or 0)
+    return level
+
+
+def _record_level(out_fp, num_greedy, cache=None, key=None):
+    with open(_level_fp(out_fp), "w") as outp:
+        outp.write(f"{num_greedy}\n")
+    if cache is not None:
+        cache.put_level(key, num_greedy)
+
+
+def _solver_invocation(inp_fp, num_greedy):
     invoc = ["max-weight-partition", inp_fp]
     if num_greedy > 0:
         invoc.append(str(num_greedy))
-    done = False
+    return invoc
+
+
+class _SolverProcs(object):
+    """The max-weight-partition processes started for one set of components.
+
+    stop() kills the ones still running and makes later start() calls
+    raise, so that the other solves end when one of them has failed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.procs = set()
+        self.stopped = False
+
+    def start(self, invoc, **kwargs):
+        with self.lock:
+            if self.stopped:
+                raise RuntimeError(f"Not running {invoc}: the solver runs were stopped")
+            proc = subprocess.Popen(invoc, **kwargs)
+            self.procs.add(proc)
+        return proc
+
+    def finish(self, proc):
+        """Waits for `proc` to exit (after killing it, if it is still running)."""
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        with self.lock:
+            self.procs.discard(proc)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            for proc in self.procs:
+                if proc.poll() is None:
+                    proc.kill()
+
+
+# The num_greedy level above which the solver is not retried.
+DEFAULT_MAX_NUM_GREEDY = 32
+
+
+def _run_solver(
+    inp_fp,
+    out_fp,
+    max_secs_per_run,
+    num_greedy=None,
+    portfolio=1,
+    max_num_greedy=DEFAULT_MAX_NUM_GREEDY,
+    cache=None,
+    key=None,
+    procs=None,
+):
+    """Solves one component, escalating num_greedy after each timeout.
+
+    If `num_greedy` is None, the solve starts at _start_level. With
+    `portfolio` > 1 that many consecutive levels are run at once (see
+    _run_solver_portfolio). Each level reached is recorded by _record_level,
+    so that a later solve of the same component starts there. A
+    RuntimeError is raised if no level up to `max_num_greedy` finishes.
+
+    The solver processes are started through `procs` (a _SolverProcs).
+    """
+    if procs is None:
+        procs = _SolverProcs()
+    if num_greedy is None:
+        num_greedy = _start_level(out_fp, cache, key)
+    while num_greedy <= max_num_greedy:
+        width = min(portfolio, 1 + max_num_greedy - num_greedy)
+        if width > 1:
+            level = _run_solver_portfolio(
+                inp_fp, out_fp, max_secs_per_run, num_greedy, width, procs
+            )
+        else:
+            level = _run_solver_once(
+                inp_fp, out_fp, max_secs_per_run, num_greedy, procs
+            )
+        if level is not None:
+            _record_level(out_fp, level, cache, key)
+            return
+        num_greedy += width
+        if num_greedy <= max_num_greedy:
+            info(
+                f"Solver did not complete on {inp_fp} within {max_secs_per_run}, trying with num_greedy steps set to {num_greedy}"
+            )
+            _record_level(out_fp, num_greedy, cache, key)
+    raise RuntimeError(
+        f"Solver did not complete on {inp_fp} within {max_secs_per_run} seconds with num_greedy up to {max_num_greedy}"
+    )
+
+
+def _run_solver_once(inp_fp, out_fp, max_secs_per_run, num_greedy, procs):
+    """Runs one level. Returns `num_greedy` if it finished in time, else None."""
+    hide_out = out_fp + ".HIDE"
+    err_fp = out_fp + "-err.txt"
+    invoc = _solver_invocation(inp_fp, num_greedy)
     info(f"  Running: {' '.join(invoc)}")
     with open(err_fp, "w") as err_fo:
         with open(hide_out, "w") as out_fo:
-            proc = subprocess.Popen(invoc, stdout=out_fo, stderr=err_fo)
+            proc = procs.start(invoc, stdout=out_fo, stderr=err_fo)
             try:
                 rc = proc.wait(timeout=max_secs_per_run)
             except subprocess.TimeoutExpired:
-                proc.kill()
-            else:
+                return None
+            finally:
+                procs.finish(proc)
+            if rc != 0:
+                raise RuntimeError(f"Invocation of {invoc} failed")
+    os.rename(hide_out, out_fp)
+    return num_greedy
+
+
+_POLL_SECS = 0.05
+
+
+def _run_solver_portfolio(inp_fp, out_fp, max_secs_per_run, num_greedy, width, procs):
+    """Runs num_greedy levels [num_greedy, num_greedy + width) of one component at once.
+
+    The first level to finish wins: its output is moved to `out_fp` and the
+    other solvers are killed. Returns the winning level, or None if none
+    finished within `max_secs_per_run`.
+    """
+    levels = list(range(num_greedy, num_greedy + width))
+    running = []
+    try:
+        for level in levels:
+            hide_out = f"{out_fp}.L{level}.HIDE"
+            err_fp = f"{out_fp}-L{level}-err.txt"
+            invoc = _solver_invocation(inp_fp, level)
+            info(f"  Running: {' '.join(invoc)}")
+            with open(err_fp, "w") as err_fo:
+                with open(hide_out, "w") as out_fo:
+                    proc = procs.start(invoc, stdout=out_fo, stderr=err_fo)
+            running.append((level, proc, hide_out))
+        deadline = time.monotonic() + max_secs_per_run
+        winner = None
+        while winner is None and time.monotonic() < deadline:
+            for level, proc, hide_out in running:
+                rc = proc.poll()
+                if rc is None:
+                    continue
                 if rc != 0:
-                    raise RuntimeError(f"Invocation of {invoc} failed")
-                done = True
-    if done:
-        os.rename(hide_out, out_fp)
-    else:
-        info(
-            f"Solver did not complete on {inp_fp} within {max_secs_per_run}, trying with num_greedy steps set to {1 + num_greedy}"
-        )
-        _run_solver(inp_fp, out_fp, max_secs_per_run, num_greedy=1 + num_greedy)
+                    raise RuntimeError(
+                        f"Invocation of {_solver_invocation(inp_fp, level)} failed"
+                    )
+                winner = (level, hide_out)
+                break
+            else:
+                time.sleep(_POLL_SECS)
+    finally:
+        for level, proc, hide_out in running:
+            procs.finish(proc)
+    for level, proc, hide_out in running:
+        if winner is not None and level == winner[0]:
+            continue
+        os.remove(hide_out)
+        os.remove(f"{out_fp}-L{level}-err.txt")
+    if winner is None:
+        info(f"No solver completed on {inp_fp} within {max_secs_per_run}")
+        return None
+    level, hide_out = winner
+    info(f"Solver with num_greedy={level} finished first on {inp_fp}")
+    os.rename(f"{out_fp}-L{level}-err.txt", out_fp + "-err.txt")
+    os.rename(hide_out, out_fp)
+    return level
+
 
+def _problem_size(inp_fp):
+    """Sort key for scheduling: (number of subsets, file size) of a component CSV."""
+    with open(inp_fp, "r") as inp:
+        num_subsets = int(inp.readline().strip())
+    return num_subsets, os.path.getsize(inp_fp)
 
-def _run_solver_on_all(to_do_list, max_secs_per_run):
-    for inp, outp in to_do_list:
-        _run_solver(inp, outp, max_secs_per_run=max_secs_per_run)
 
+def _run_solver_on_all(
+    to_do_list,
+    max_secs_per_run,
+    num_procs=1,
+    portfolio=1,
+    max_num_greedy=DEFAULT_MAX_NUM_GREEDY,
+    cache=None,
+):
+    """Runs the solver on each (input, output, cache key) with up to `num_procs` at once.
 
-def _ensure_problems_solved(inp_files, max_secs_per_run):
+    The largest problems are started first, so that they do not end up
+    running alone after all of the small problems have finished. If one
+    solve fails, the solver processes of the others are killed.
+    """
+    by_size = [(_problem_size(inp), inp, outp, key) for inp, outp, key in to_do_list]
+    by_size.sort(key=lambda x: x[0], reverse=True)
+    procs = _SolverProcs()
+    kwargs = dict(
+        portfolio=portfolio, max_num_greedy=max_num_greedy, cache=cache, procs=procs
+    )
+    if num_procs <= 1:
+        for sz, inp, outp, key in by_size:
+            _run_solver(inp, outp, max_secs_per_run, key=key, **kwargs)
+        return
+    info(f"Running {len(by_size)} solver jobs, {num_procs} at a time")
+    with ThreadPoolExecutor(max_workers=num_procs) as executor:
+        futures = [
+            executor.submit(_run_solver, inp, outp, max_secs_per_run, key=key, **kwargs)
+            for sz, inp, outp, key in by_size
+        ]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except:
+            for future in futures:
+                future.cancel()
+            procs.stop()
+            raise
+
+
+# Components in which each crossing block (see LaminarSolver), together with
+#   the subsets nested in it, has at most this many subsets are solved
+#   in-process rather than by max-weight-partition.
+DEFAULT_IN_PROCESS_MAX_SUBSETS = 32
+
+
+def _read_component(inp_fp):
+    """Returns the subset_wts of a component CSV written by _serialize_component."""
+    subset_wts = {}
+    with open(inp_fp, "r") as inp:
+        num_subsets = int(inp.readline().strip())
+        for line in inp:
+            line = line.strip()
+            if not line:
+                continue
+            wt, *labels = line.split(",")
+            subset_wts[frozenset(labels)] = int(wt)
+    assert len(subset_wts) == num_subsets
+    return subset_wts
+
+
+def _solve_in_process(inp_fp, out_fp, max_subsets, memo_max_bytes=None):
+    """Solves the component in `inp_fp` if it is simple enough.
+
+    Returns the resolutions in the solver's JSON form (which is also written
+    to `out_fp`), or None if a crossing block of the component, with the
+    subsets nested in it, has more than `max_subsets` subsets.
+    `memo_max_bytes` bounds the memo of each PartitionEngine search.
+    """
+    solver = LaminarSolver(_read_component(inp_fp), memo_max_bytes=memo_max_bytes)
+    if max(solver.block_problem_sizes(), default=0) > max_subsets:
+        return None
+    res_list = []
+    for size, el in solver.solve().items():
+        score, subsets = el
+        res_list.append(
+            {"score": score, "size": size, "subsets": [sorted(i) for i in subsets]}
+        )
+    with open(out_fp + ".HIDE", "w") as outp:
+        json.dump(res_list, outp)
+    os.rename(out_fp + ".HIDE", out_fp)
+    return res_list
+
+
+def _ensure_problems_solved(
+    inp_files,
+    max_secs_per_run,
+    num_procs=1,
+    portfolio=1,
+    cache=None,
+    in_process_max_subsets=DEFAULT_IN_PROCESS_MAX_SUBSETS,
+    max_num_greedy=DEFAULT_MAX_NUM_GREEDY,
+    in_process_memo_max_bytes=None,
+):
+    """Returns (list of solver output files, dict of output file -> resolutions).
+
+    The dict holds the resolutions of the components solved in-process, so
+    that they need not be read back.
+    """
     to_do_list = []
     all_out_files = []
+    solved = {}
     for fs in inp_files:
         assert fs.endswith(".csv")
         stem = fs[:-4]
         expected_out = f"{stem}.json"
         all_out_files.append(expected_out)
-        if not os.path.isfile(expected_out):
-            to_do_list.append((fs, expected_out))
+        if os.path.isfile(expected_out):
+            continue
+        if in_process_max_subsets > 0:
+            res_list = _solve_in_process(
+                fs, expected_out, in_process_max_subsets, in_process_memo_max_bytes
+            )
+            if res_list is not None:
+                solved[expected_out] = res_list
+                continue
+        key = None
+        if cache is not None:
+            key = component_key(fs)
+            level = cache.get(key, expected_out)
+            if level is not None:
+                info(f"Using cached solution of {fs} (num_greedy={level})")
+                _record_level(expected_out, level)
+                continue
+        to_do_list.append((fs, expected_out, key))
 
     if to_do_list:
-        _run_solver_on_all(to_do_list, max_secs_per_run=max_secs_per_run)
-    return all_out_files
+        try:
+            _run_solver_on_all(
+                to_do_list,
+                max_secs_per_run=max_secs_per_run,
+                num_procs=num_procs,
+                portfolio=portfolio,
+                max_num_greedy=max_num_greedy,
+                cache=cache,
+            )
+        finally:
+            # cache whatever was solved, even if another component failed
+            for inp_fp, out_fp, key in to_do_list:
+                if key is not None and os.path.isfile(out_fp):
+                    cache.put(key, out_fp, _read_start_level(out_fp))
+    if solved:
+        info(f"Solved {len(solved)} of {len(inp_files)} components in-process")
+    return all_out_files, solved
+
+
+def _read_copies(scratch_dir):
+    fp = os.path.join(scratch_dir, COPIES_FN)
+    if not os.path.isfile(fp):
+        return None
+    with open(fp, "r") as inp:
+        return json.load(inp)
 
 
-def _process_resolution_files(resolution_files):
-    obj_list = []
+def _with_copies(resolution_files, copies):
+    """Returns a (file, copy index) source for each component.
+
+    The component written to a file has a copy index of None, and its copies
+    (see _write_components) are numbered from 0.
+    """
+    sources = []
     for fp in resolution_files:
-        with open(fp, "r") as inp:
-            jobj = json.load(inp)
-        obj_list.append(ResolutionWrapper(jobj))
-    return obj_list
+        sources.append((fp, None))
+        if copies:
+            stem = os.path.basename(fp)[:-5]
+            for copy_idx in range(len(copies.get(f"{stem}.csv", []))):
+                sources.append((fp, copy_idx))
+    return sources
+
+
+def _process_resolution_files(
+    sources, taxon_index=None, label_groups=None, preloaded=None, copies=None
+):
+    """Returns (a ResolutionWrapper per source, taxon_index).
+
+    `sources` is a list of (solver output file, copy index) pairs, as from
+    _with_copies. `preloaded` is an optional dict of file -> resolutions
+    already in memory.
+    """
+    jobj_by_fp = {}
+    label_maps = []
+    for fp, copy_idx in sources:
+        if fp not in jobj_by_fp:
+            jobj = None if preloaded is None else preloaded.get(fp)
+            if jobj is None:
+                with open(fp, "r") as inp:
+                    jobj = json.load(inp)
+            jobj_by_fp[fp] = jobj
+        if copy_idx is None:
+            label_maps.append(label_groups)
+            continue
+        stem = os.path.basename(fp)[:-5]
+        copy_labels = copies[f"{stem}.csv"][copy_idx]
+        groups = label_groups or {}
+        label_maps.append({k: groups.get(v, (v,)) for k, v in copy_labels.items()})
+    if taxon_index is None:
+        labels = set()
+        for jobj in jobj_by_fp.values():
+            for res in jobj:
+                for subset in res["subsets"]:
+                    labels.update(subset)
+        for label_map in label_maps:
+            if label_map:
+                for group in label_map.values():
+                    labels.update(group)
+        taxon_index = TaxonIndex(labels)
+    wrappers = []
+    for source, label_map in zip(sources, label_maps):
+        wrapper = ResolutionWrapper(jobj_by_fp[source[0]], taxon_index, label_map)
+        wrapper.source_fp, wrapper.copy_idx = source
+        wrappers.append(wrapper)
+    return wrappers, taxon_index
+
+
+def _outputs_key(scratch_dir, inp_files):
+    """Returns a sha256 hex digest of the solver outputs of the components `inp_files`.
+
+    The files that map their labels back (LABEL_GROUPS_FN and COPIES_FN)
+    are included. Returns None if an output is missing.
+    """
+    h = hashlib.sha256()
+    out_files = [f"{fs[:-4]}.json" for fs in inp_files]
+    map_files = [os.path.join(scratch_dir, fn) for fn in (LABEL_GROUPS_FN, COPIES_FN)]
+    for fp in out_files + map_files:
+        try:
+            with open(fp, "rb") as inp:
+                content = inp.read()
+        except FileNotFoundError:
+            if fp in map_files:
+                content = None
+            else:
+                return None
+        size = -1 if content is None else len(content)
+        h.update(f"{os.path.basename(fp)}\t{size}\n".encode("utf-8"))
+        if content:
+            h.update(content)
+    return h.hexdigest()
+
+
+def save_merged_dp(dp_fp, final, outputs_key=None):
+    """Writes the merge tree of `final` (with every size kept) to `dp_fp`.
 
+    `outputs_key` (from _outputs_key) is saved with it, to tell whether the
+    components have been solved again since.
+    """
+    dp_dir = os.path.dirname(os.path.abspath(dp_fp))
+    leaves = final.leaf_wrappers()
+    leaf_idx = {id(w): idx for idx, w in enumerate(leaves)}
+    obj = {
+        "resolution_files": [os.path.relpath(w.source_fp, dp_dir) for w in leaves],
+        "copies": [w.copy_idx for w in leaves],
+        "tree": final.to_json_obj(leaf_idx),
+        "outputs_key": outputs_key,
+    }
+    tmp_fp = dp_fp + ".HIDE"
+    with open(tmp_fp, "w") as outp:
+        json.dump(obj, outp)
+    os.rename(tmp_fp, dp_fp)
+
+
+def load_merged_dp(dp_fp, taxon_index=None, outputs_key=None):
+    """Returns (merged ResolutionWrapper, taxon_index) from a save_merged_dp file.
+
+    If `outputs_key` is given and is not the one saved in the file, the
+    merge is out of date and (None, taxon_index) is returned.
+    """
+    dp_dir = os.path.dirname(os.path.abspath(dp_fp))
+    with open(dp_fp, "r") as inp:
+        obj = json.load(inp)
+    if outputs_key is not None and obj.get("outputs_key") != outputs_key:
+        return None, taxon_index
+    files = [os.path.join(dp_dir, i) for i in obj["resolution_files"]]
+    copy_ids = obj.get("copies", [None] * len(files))
+    leaves, taxon_index = _process_resolution_files(
+        list(zip(files, copy_ids)),
+        taxon_index,
+        _read_label_groups(dp_dir),
+        copies=_read_copies(dp_dir),
+    )
+    return ResolutionWrapper.from_json_obj(obj["tree"], leaves), taxon_index
 
-def choose_most_common(num_to_select, scratch_dir, max_secs_per_run=6000):
+
+def write_frontier(frontier_fp, final):
+    """Writes the best score for each number of lineages that can be selected."""
+    with open(frontier_fp, "w") as outp:
+        outp.write("num-selected\tscore\n")
+        for idx, sc in enumerate(final.scores):
+            if not np.isinf(sc):
+                outp.write(f"{final.min_num + idx}\t{sc}\n")
+
+
+def _select_from_final(final, num_to_select, taxon_index):
+    score = final.score_for(num_to_select)
+    if score is None:
+        raise RuntimeError(f"No combination of solutions selects {num_to_select}")
+    subsets = final.subsets_for(num_to_select)
+    return score, [taxon_index.frozenset_of(i) for i in subsets]
+
+
+def choose_most_common(
+    num_to_select,
+    scratch_dir,
+    max_secs_per_run=6000,
+    solver_procs=1,
+    solver_portfolio=1,
+    solver_cache=None,
+    taxon_index=None,
+    frontier_fp=None,
+    in_process_max_subsets=DEFAULT_IN_PROCESS_MAX_SUBSETS,
+    solver_max_num_greedy=DEFAULT_MAX_NUM_GREEDY,
+    in_process_memo_max_bytes=None,
+):
+    """Returns the best (score, list of label frozensets) of size `num_to_select`.
+
+    Components in which every crossing block, with the subsets nested in
+    it, has at most `in_process_max_subsets` subsets are solved in-process
+    (0 sends every component to max-weight-partition), with the memo of
+    each search bounded by `in_process_memo_max_bytes` if it is given.
+
+    If `taxon_index` is None, one is built from the labels in the solutions.
+
+    If `frontier_fp` is given, every total size is kept while merging the
+    components, the best score of each size is written to `frontier_fp`,
+    and the merge is saved as MERGED_DP_FN in `scratch_dir`. A later call
+    on the same `scratch_dir` selects from that file for any size, without
+    solving or merging the components again, as long as the solver outputs
+    of the components are the ones that were merged.
+    """
     prob_list_fp = os.path.join(scratch_dir, PROB_FN)
 
     with open(prob_list_fp, "r") as inp:
         inp_files = [i.strip() for i in inp]
 
-    resolution_files = _ensure_problems_solved(
-        inp_files, max_secs_per_run=max_secs_per_run
+    dp_fp = os.path.join(scratch_dir, MERGED_DP_FN)
+    if os.path.isfile(dp_fp):
+        outputs_key = _outputs_key(scratch_dir, inp_files)
+        final = None
+        if outputs_key is not None:
+            final, taxon_index = load_merged_dp(dp_fp, taxon_index, outputs_key)
+        if final is not None:
+            info(f"Using the merged solutions in {dp_fp}")
+            if frontier_fp is not None:
+                write_frontier(frontier_fp, final)
+            return _select_from_final(final, num_to_select, taxon_index)
+        info(
+            f"Not using {dp_fp}: the component solutions have changed since it was saved"
+        )
+
+    resolution_files, solved = _ensure_problems_solved(
+        inp_files,
+        max_secs_per_run=max_secs_per_run,
+        num_procs=solver_procs,
+        portfolio=solver_portfolio,
+        cache=solver_cache,
+        in_process_max_subsets=in_process_max_subsets,
+        max_num_greedy=solver_max_num_greedy,
+        in_process_memo_max_bytes=in_process_memo_max_bytes,
     )
 
-    res_wrap_list = _process_resolution_files(resolution_files)
+    copies = _read_copies(scratch_dir)
+    res_wrap_list, taxon_index = _process_resolution_files(
+        _with_copies(resolution_files, copies),
+        taxon_index,
+        _read_label_groups(scratch_dir),
+        solved,
+        copies,
+    )
     # Sort by the ones with the smallest variation in size first
     sortable = [(i.size_width, i.min_num, id(i), i) for i in res_wrap_list]
     sortable.sort()
@@ -200,20 +933,30 @@ def choose_most_common(num_to_select, scratch_dir, max_secs_per_run=6000):
             f"Cannot select {num_to_select} lineages solutions range in [{total_min}, {total_max}]"
         )
 
-    num_subproblems = len(in_order)
-    min_size_after = [0] * num_subproblems
-    cum_min = 0
-    for idx, res in enumerate(reversed(in_order)):
-        if idx > 0:
-            neg_idx = -(1 + idx)
-            min_size_after[neg_idx] = cum_min
-        cum_min += res.min_num
-
+    # Merge the components as a balanced tree: pair up neighbours (in the
+    #   order above) until one wrapper is left.
+    keep_all = frontier_fp is not None
+    remaining_min, remaining_max = total_min, total_max
+    while len(in_order) > 1:
+        merged = []
+        for idx in range(0, len(in_order) - 1, 2):
+            first, second = in_order[idx], in_order[idx + 1]
+            remaining_min -= first.min_num + second.min_num
+            remaining_max -= first.max_num + second.max_num
+            first.absorb(
+                second,
+                final_n=None if keep_all else num_to_select,
+                min_num_after=remaining_min,
+                max_num_after=remaining_max,
+            )
+            remaining_min += first.min_num
+            remaining_max += first.max_num
+            merged.append(first)
+        if len(in_order) % 2:
+            merged.append(in_order[-1])
+        in_order = merged
     final = in_order[0]
-    for idx, res in enumerate(in_order):
-        if idx == 0:
-            continue
-        else:
-            assert res is not final
-        final.absorb(res, final_n=num_to_select, min_num_after=min_size_after[idx])
-    return final.by_size[num_to_select]
+    if keep_all:
+        write_frontier(frontier_fp, final)
+        save_merged_dp(dp_fp, final, _outputs_key(scratch_dir, inp_files))
+    return _select_from_final(final, num_to_select, taxon_index)
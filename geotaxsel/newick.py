@@ -0,0 +1,101 @@
+#! /usr/bin/env python3
+"""Reader for the first tree of a Newick file into an ArrayTree.
+
+Labels follow dendropy's Newick conventions, so that trees read here and
+by dendropy.Tree.get(..., schema="newick") have the same labels:
+  * underscores in unquoted labels are read as spaces;
+  * labels in single quotes are kept as they are, with '' read as ';
+  * [comments] are skipped, except for a leading [&R] or [&U], which sets
+    is_rooted.
+Labels of leaves are the leaf labels of the ArrayTree; labels of internal
+nodes are kept in its node_labels.
+"""
+
+import re
+
+from .array_tree import ArrayTree
+
+# One token per match: a comment, a quoted label, an edge length, other
+#   punctuation, an unquoted label, or (last) any character that cannot
+#   start a token.
+_TOKEN_PAT = re.compile(
+    r"\s*(?:\[[^\]]*\]\s*)*(?:('(?:[^']|'')*')|:\s*([^\s()\[\],:;']+)|([(),;])"
+    r"|([^\s()\[\],:;']+)|(\S))"
+)
+_ROOTING_PAT = re.compile(r"\s*\[&([RrUu])\]")
+
+
+def parse_newick(text):
+    """Returns an ArrayTree for the first tree in the Newick string `text`."""
+    parent, edge_len, num_children, labels = [], [], [], []
+    open_nodes = []
+    curr = None  # the node that a label or edge length applies to
+
+    def new_node():
+        nd = len(parent)
+        par = open_nodes[-1] if open_nodes else -1
+        if par < 0 and nd > 0:
+            raise ValueError("Newick string has more than one root")
+        parent.append(par)
+        edge_len.append(0.0)
+        num_children.append(0)
+        labels.append(None)
+        if par >= 0:
+            num_children[par] += 1
+        return nd
+
+    for m in _TOKEN_PAT.finditer(text):
+        quoted, length, punct, word, bad = m.groups()
+        if bad is not None:
+            raise ValueError(f"Unexpected {bad!r} at offset {m.start(5)} of Newick")
+        if length is not None:
+            if curr is None:
+                # a node with no label, e.g. "(:1,A:1)"
+                curr = new_node()
+            edge_len[curr] = float(length)
+            continue
+        if punct is None:
+            if curr is None:
+                curr = new_node()
+            elif labels[curr] is not None:
+                raise ValueError(f"Second label for a node at offset {m.start()}")
+            if quoted is not None:
+                labels[curr] = quoted[1:-1].replace("''", "'")
+            else:
+                labels[curr] = word.replace("_", " ")
+            continue
+        if punct == "(":
+            if curr is not None:
+                raise ValueError(f"Unexpected '(' at offset {m.start(3)}")
+            open_nodes.append(new_node())
+            continue
+        if curr is None:
+            # a node with no label, e.g. the second leaf in "(A,)"
+            curr = new_node()
+        if punct == ",":
+            if not open_nodes:
+                raise ValueError(f"Unexpected ',' at offset {m.start(3)}")
+            curr = None
+        elif punct == ")":
+            if not open_nodes:
+                raise ValueError(f"Unbalanced ')' at offset {m.start(3)}")
+            curr = open_nodes.pop()
+        else:
+            break
+    if not parent:
+        raise ValueError("No tree found in Newick string")
+    if open_nodes:
+        raise ValueError("Newick string ended before the tree was complete")
+    leaf_labels = [lab for lab, nc in zip(labels, num_children) if not nc]
+    node_labels = [lab if nc else None for lab, nc in zip(labels, num_children)]
+    atree = ArrayTree(parent, edge_len, leaf_labels, node_labels)
+    rooting = _ROOTING_PAT.match(text)
+    if rooting is not None:
+        atree.is_rooted = rooting.group(1) in "Rr"
+    return atree
+
+
+def read_newick(path):
+    """Returns an ArrayTree for the first tree in the Newick file `path`."""
+    with open(path, "r") as inp:
+        return parse_newick(inp.read())
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+"""Exact max-weight partition of a component, using int bitsets.
+
+Given weighted subsets of a set of labels, PartitionEngine finds, for every
+k, the highest total weight of k subsets that partition all of the labels.
+This is the problem solved by ConnectedComponent._rec_fill_res and by the
+external max-weight-partition tool, and the search is the same: branch on
+the subsets that hold the least frequent uncovered label, and memoize the
+best resolutions of each set of uncovered labels.
+
+Everything is an int:
+  * labels are renumbered 0..n-1 within the component, and each subset is
+    a mask over them;
+  * compat[i] is a bitset over subset indices of the subsets disjoint from
+    subset i, and by_label[j] is the bitset of subsets holding label j;
+  * the memo is keyed by the mask of uncovered labels. For each size it
+    holds the best score and a back-pointer (the subset chosen), and the
+    resolutions are rebuilt by following those pointers.
+Labels that are in exactly the same subsets are merged into one label
+before the search.
+
+solve() returns every size. With branch_and_bound on (the
+default), the memoized search skips a branch once it cannot improve the
+sub-problem it is in at any size:
+  * The subsets holding the chosen label are tried heaviest first, and
+    each is searched to completion before the next is looked at, so the
+    best score found so far for each size is known.
+  * Upper bounds are per size. For any lambda, a partition of the labels R
+    into k subsets scores at most
+        k * lambda + sum over j in R of max over s holding j of (w_s - lambda) / |s|
+    because each subset's (w_s - lambda) can be spread over its labels.
+    lambda = 0 gives the "best weight per label" bound, and a grid of
+    lambdas makes the bound tight for sizes far from the best one. The
+    number of subsets in a partition of R is also bounded (by the sums
+    over its labels of the smallest and largest 1 / |s|), which gives the
+    sizes that a branch can reach.
+  * A branch is skipped when, at every size it can reach, its bound does
+    not beat the best score found so far. Since the comparison is with
+    scores found within the same sub-problem, every memo entry is still
+    exact for every size, and entries are shared by all of the paths that
+    reach them.
+If memo_max_bytes is given, the memo of that search is a SubproblemCache
+with that budget, so entries are evicted GreedyDual-Size style (an entry's
+cost is the number of search nodes it took to fill). An evicted entry is
+searched for again when it is needed, while searching or while rebuilding
+the resolutions; this costs time but not exactness.
+"""
+
+import sys
+
+import numpy as np
+
+from .logs import debug
+from .subproblem_cache import SubproblemCache
+from .taxon_index import iter_bits, popcount
+
+_NEG_INF = float("-inf")
+_NUM_LAMBDAS = 25
+# Slack added to upper bounds so that float rounding can never prune an
+#   optimal branch.
+_BOUND_SLACK = 1.0e-9
+# Rough size of each (score, subset) item of a memo entry, for memo_max_bytes.
+_MEMO_ITEM_BYTES = 120
+
+
+class PartitionEngine(object):
+    def __init__(self, subset_wts, branch_and_bound=True, memo_max_bytes=None):
+        self.branch_and_bound = branch_and_bound
+        self.memo_max_bytes = memo_max_bytes
+        self.num_nodes = 0
+        self.num_pruned = 0
+        self.subsets = list(subset_wts.keys())
+        self.weights = [subset_wts[i] for i in self.subsets]
+        labels = set()
+        for subset in self.subsets:
+            labels.update(subset)
+        labels = sorted(labels)
+        label_bit = {label: idx for idx, label in enumerate(labels)}
+        by_label = [0] * len(labels)
+        for sub_idx, subset in enumerate(self.subsets):
+            sub_bit = 1 << sub_idx
+            for label in subset:
+                by_label[label_bit[label]] |= sub_bit
+        # Merge labels that occur in the same subsets.
+        merged = {}
+        for subs in by_label:
+            if subs not in merged:
+                merged[subs] = len(merged)
+        self.by_label = list(merged.keys())
+        self.num_labels = len(self.by_label)
+        self.masks = [0] * len(self.subsets)
+        for label_idx, subs in enumerate(self.by_label):
+            for sub_idx in iter_bits(subs):
+                self.masks[sub_idx] |= 1 << label_idx
+        self.all_labels = (1 << self.num_labels) - 1
+        self.all_subsets = (1 << len(self.subsets)) - 1
+        self.compat = []
+        for mask in self.masks:
+            overlapping = 0
+            for label_idx in iter_bits(mask):
+                overlapping |= self.by_label[label_idx]
+            self.compat.append(self.all_subsets & ~overlapping)
+        self.memo = {}
+        if branch_and_bound:
+            self._init_bounds()
+
+    def _init_bounds(self):
+        weights = np.array(self.weights, dtype=float)
+        top = float(np.abs(weights).max()) if len(weights) else 0.0
+        self.lambdas = np.linspace(-top, top, _NUM_LAMBDAS)
+        # label_bound[j, i] = max over s holding j of (w_s - lambdas[i]) / |s|
+        label_bound = np.full((self.num_labels, _NUM_LAMBDAS), _NEG_INF)
+        for sub_idx, mask in enumerate(self.masks):
+            labels = list(iter_bits(mask))
+            per_label = (weights[sub_idx] - self.lambdas) / len(labels)
+            label_bound[labels] = np.maximum(label_bound[labels], per_label)
+        self.label_bound = label_bound
+        # The number of subsets in a partition of R lies between the sums over
+        #   j in R of min and of max over s holding j of 1 / |s|.
+        size_bound = np.zeros((self.num_labels, 2))
+        size_bound[:, 0] = np.inf
+        for mask in self.masks:
+            labels = list(iter_bits(mask))
+            inv = 1.0 / len(labels)
+            size_bound[labels, 0] = np.minimum(size_bound[labels, 0], inv)
+            size_bound[labels, 1] = np.maximum(size_bound[labels, 1], inv)
+        self.size_bound = size_bound
+        # The bound sums of each subset's labels, so that those of the
+        #   labels left after choosing a subset are found by subtraction.
+        self.sub_label_bound = []
+        self.sub_size_bound = []
+        for mask in self.masks:
+            labels = list(iter_bits(mask))
+            self.sub_label_bound.append(label_bound[labels].sum(axis=0))
+            self.sub_size_bound.append(size_bound[labels].sum(axis=0))
+
+    def _choose_label(self, uncovered, family):
+        """Returns (label, subsets holding it) for the least frequent label."""
+        best_label, best_subs, best_count = None, 0, None
+        by_label = self.by_label
+        for label_idx in iter_bits(uncovered):
+            subs = family & by_label[label_idx]
+            count = popcount(subs)
+            if best_count is None or count < best_count:
+                best_label, best_subs, best_count = label_idx, subs, count
+                if count == 0:
+                    break
+        return best_label, best_subs
+
+    def _fill_memo(self, root, root_family):
+        memo = self.memo
+        masks, weights, compat = self.masks, self.weights, self.compat
+        expanding = {}
+        stack = [(root, root_family)]
+        while stack:
+            uncovered, family = stack[-1]
+            if uncovered in memo:
+                stack.pop()
+                continue
+            alternatives = expanding.get(uncovered)
+            if alternatives is None:
+                self.num_nodes += 1
+                label_idx, alt_subs = self._choose_label(uncovered, family)
+                alternatives = []
+                for sub_idx in iter_bits(alt_subs):
+                    rest = uncovered & ~masks[sub_idx]
+                    alternatives.append((sub_idx, rest))
+                    if rest and rest not in memo:
+                        stack.append((rest, family & compat[sub_idx]))
+                expanding[uncovered] = alternatives
+                continue
+            stack.pop()
+            del expanding[uncovered]
+            by_size = {}
+            for sub_idx, rest in alternatives:
+                wt = weights[sub_idx]
+                if not rest:
+                    prev = by_size.get(1)
+                    if prev is None or wt > prev[0]:
+                        by_size[1] = (wt, sub_idx)
+                    continue
+                for num_subs, rest_el in memo[rest].items():
+                    sc = wt + rest_el[0]
+                    size = 1 + num_subs
+                    prev = by_size.get(size)
+                    if prev is None or sc > prev[0]:
+                        by_size[size] = (sc, sub_idx)
+            memo[uncovered] = by_size
+
+    def _can_improve(self, by_size, wt, bound_sums, size_sums):
+        """Returns False if `wt` plus a partition of the labels with these
+        bound sums cannot beat `by_size` (the best so far) at any size.
+        """
+        lo = int(np.ceil(size_sums[0] - 1.0e-6))
+        hi = int(np.floor(size_sums[1] + 1.0e-6))
+        if lo > hi:
+            return False
+        best = []
+        for num_subs in range(lo + 1, hi + 2):
+            prev = by_size.get(num_subs)
+            if prev is None:
+                return True
+            best.append(prev[0])
+        sizes = np.arange(lo, hi + 1, dtype=float)
+        ub = (sizes[:, np.newaxis] * self.lambdas + bound_sums).min(axis=1)
+        ub += _BOUND_SLACK * (1.0 + np.abs(ub))
+        return bool((wt + ub > np.array(best)).any())
+
+    def _fill_memo_pruned(self, root):
+        """Fills the memo as _fill_memo does, skipping hopeless branches.
+
+        `root` may be any set of labels. Returns its memo entry.
+        """
+        memo = self.memo
+        bounded = isinstance(memo, SubproblemCache)
+        masks, weights, compat = self.masks, self.weights, self.compat
+        sub_label_bound, sub_size_bound = self.sub_label_bound, self.sub_size_bound
+
+        def new_frame(uncovered, family, bound_sums, size_sums):
+            self.num_nodes += 1
+            label_idx, alt_subs = self._choose_label(uncovered, family)
+            alternatives = [(weights[i], i) for i in iter_bits(alt_subs)]
+            # Subsets that leave a solved sub-problem first (they cost
+            #   nothing), then heavy ones, so that good scores are found early.
+            alternatives.sort(
+                key=lambda x: (uncovered & ~masks[x[1]] not in memo, -x[0])
+            )
+            # uncovered, family, bound sums, size sums, alternatives,
+            #   next alternative, best (score, subset) by size, pending child,
+            #   num_nodes when started
+            return [
+                uncovered,
+                family,
+                bound_sums,
+                size_sums,
+                alternatives,
+                0,
+                {},
+                None,
+                self.num_nodes,
+            ]
+
+        # The subsets that can be used are the ones inside `root`.
+        family = 0
+        for sub_idx, mask in enumerate(masks):
+            if not mask & ~root:
+                family |= 1 << sub_idx
+        labels = list(iter_bits(root))
+        stack = [
+            new_frame(
+                root,
+                family,
+                self.label_bound[labels].sum(axis=0),
+                self.size_bound[labels].sum(axis=0),
+            )
+        ]
+        # The entry of the frame popped last (a bounded memo may have
+        #   evicted it already).
+        done = None
+        while stack:
+            frame = stack[-1]
+            uncovered, family, bound_sums, size_sums, alternatives = frame[:5]
+            by_size = frame[6]
+            # (weight, subset, memo entry of the rest) to add to by_size
+            to_absorb = None
+            if frame[7] is not None:
+                wt, sub_idx, rest = frame[7]
+                to_absorb = (wt, sub_idx, done)
+                frame[7] = None
+            alt_idx = frame[5]
+            child = None
+            while True:
+                if to_absorb is not None:
+                    wt, sub_idx, rest_by_size = to_absorb
+                    to_absorb = None
+                    for num_subs, rest_el in rest_by_size.items():
+                        sc = wt + rest_el[0]
+                        size = 1 + num_subs
+                        prev = by_size.get(size)
+                        if prev is None or sc > prev[0]:
+                            by_size[size] = (sc, sub_idx)
+                if alt_idx == len(alternatives):
+                    break
+                wt, sub_idx = alternatives[alt_idx]
+                alt_idx += 1
+                rest = uncovered & ~masks[sub_idx]
+                if not rest:
+                    prev = by_size.get(1)
+                    if prev is None or wt > prev[0]:
+                        by_size[1] = (wt, sub_idx)
+                    continue
+                rest_by_size = memo.get(rest)
+                if rest_by_size is not None:
+                    to_absorb = (wt, sub_idx, rest_by_size)
+                    continue
+                rest_bound = bound_sums - sub_label_bound[sub_idx]
+                rest_size = size_sums - sub_size_bound[sub_idx]
+                if not self._can_improve(by_size, wt, rest_bound, rest_size):
+                    self.num_pruned += 1
+                    continue
+                frame[7] = (wt, sub_idx, rest)
+                child = new_frame(rest, family & compat[sub_idx], rest_bound, rest_size)
+                break
+            frame[5] = alt_idx
+            if child is not None:
+                stack.append(child)
+                continue
+            stack.pop()
+            if bounded:
+                num_bytes = sys.getsizeof(by_size) + sys.getsizeof(uncovered)
+                num_bytes += _MEMO_ITEM_BYTES * len(by_size)
+                memo.put(uncovered, by_size, self.num_nodes - frame[8], num_bytes)
+            else:
+                memo[uncovered] = by_size
+            done = by_size
+        return done
+
+    def _subsets_for(self, uncovered, num_subs, entry=None):
+        """Follows the back-pointers from `uncovered` (whose memo entry may be passed)."""
+        chosen = []
+        while uncovered:
+            if entry is None:
+                entry = self.memo.get(uncovered)
+            if entry is None:
+                # evicted from a bounded memo
+                entry = self._fill_memo_pruned(uncovered)
+            sub_idx = entry[num_subs][1]
+            entry = None
+            chosen.append(sub_idx)
+            uncovered &= ~self.masks[sub_idx]
+            num_subs -= 1
+        assert num_subs == 0
+        return chosen
+
+    def solve(self):
+        """Returns a dict of size -> (best score, list of subsets)."""
+        if not self.subsets:
+            return {}
+        root = self.all_labels
+        self.memo = {}
+        if self.branch_and_bound:
+            if self.memo_max_bytes is not None:
+                self.memo = SubproblemCache(max_bytes=self.memo_max_bytes)
+            root_entry = self._fill_memo_pruned(root)
+        else:
+            self._fill_memo(root, self.all_subsets)
+            root_entry = self.memo[root]
+        by_size = {}
+        for num_subs in root_entry:
+            by_size[num_subs] = self._subsets_for(root, num_subs, root_entry)
+        if isinstance(self.memo, SubproblemCache):
+            self.memo.log_stats("PartitionEngine memo")
+        debug(
+            f"PartitionEngine: {self.num_nodes} nodes ({self.num_pruned} branches pruned) for {self.num_labels} labels and {len(self.subsets)} subsets"
+        )
+        ret = {}
+        for num_subs in sorted(by_size.keys()):
+            sub_list = by_size[num_subs]
+            score = sum(self.weights[i] for i in sub_list)
+            ret[num_subs] = (score, [self.subsets[i] for i in sub_list])
+        return ret
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""Exact reductions of LabelGraph components before they are written out.
+
+Each rule keeps the best score of every number of subsets unchanged (up to
+a constant size and score for the subsets it fixes), so the solver output
+for the reduced components can be merged as usual:
+  * single-subset: a component with one subset is solved; the subset is
+    fixed.
+  * forced: a label held by only one subset forces that subset. It is
+    fixed, and the subsets that overlap it are dropped.
+  * infeasible: a subset whose choice would leave some other label with no
+    disjoint subset to cover it is in no partition, and is dropped.
+  * split: after subsets are fixed or dropped, what is left of a component
+    may fall into several parts, which are solved separately. (A component
+    held together by one "bridge" subset cannot be split this way: its best
+    scores are the better of two different combinations of the sides.)
+  * merged-labels: labels held by exactly the same subsets are replaced by
+    one of them. The groups are returned so that solutions can be expanded.
+Rules are applied to each component until none applies, and the parts a
+component falls into are reduced in turn.
+
+The fixed subsets make up one more component, which has just one
+resolution and does not need the solver.
+"""
+
+from .label_graph import LabelGraph, MaskComponent
+from .logs import info
+from .taxon_index import iter_bits, popcount
+
+RULES = ("single-subset", "forced", "infeasible", "split", "merged-labels")
+
+
+class ReductionReport(object):
+    """Number of times each rule applied, and the labels and subsets it removed.
+
+    For "split", the labels are those outside the largest part.
+    """
+
+    def __init__(self, components):
+        self.applied = {rule: 0 for rule in RULES}
+        self.labels = {rule: 0 for rule in RULES}
+        self.subsets = {rule: 0 for rule in RULES}
+        self.before = self._totals(components)
+        self.after = None
+
+    @staticmethod
+    def _totals(components):
+        num_labels = sum(popcount(i.leaves) for i in components)
+        num_subsets = sum(len(i.subset_wts) for i in components)
+        largest = max([len(i.subset_wts) for i in components], default=0)
+        return len(components), num_labels, num_subsets, largest
+
+    def record(self, rule, labels=0, subsets=0):
+        self.applied[rule] += 1
+        self.labels[rule] += labels
+        self.subsets[rule] += subsets
+
+    def lines(self):
+        """Returns the report as lines of tab-separated text."""
+        ret = ["rule\tapplied\tlabels-removed\tsubsets-removed"]
+        for rule in RULES:
+            ret.append(
+                f"{rule}\t{self.applied[rule]}\t{self.labels[rule]}\t{self.subsets[rule]}"
+            )
+        for name, tot in (("before", self.before), ("after", self.after)):
+            ret.append(
+                f"# {name}: {tot[0]} components, {tot[1]} labels, {tot[2]} subsets, largest component {tot[3]} subsets"
+            )
+        return ret
+
+    def log(self):
+        for line in self.lines():
+            info(line)
+
+
+def _component_of(subset_wts):
+    comp = None
+    for mask, wt in subset_wts.items():
+        if comp is None:
+            comp = MaskComponent(mask, wt)
+        else:
+            comp.add_set(mask, wt)
+    return comp
+
+
+def _connected_parts(subset_wts):
+    lg = LabelGraph(None)
+    for mask, wt in subset_wts.items():
+        lg.add_set(mask, wt)
+    return list(lg.components)
+
+
+def _subset_ids_by_label(subsets):
+    by_label = {}
+    for sub_idx, mask in enumerate(subsets):
+        sub_bit = 1 << sub_idx
+        for label_idx in iter_bits(mask):
+            by_label[label_idx] = by_label.get(label_idx, 0) | sub_bit
+    return by_label
+
+
+def _overlapping(mask, by_label):
+    """Returns the bitset of subset ids that share a label with `mask`."""
+    overl = 0
+    for label_idx in iter_bits(mask):
+        overl |= by_label[label_idx]
+    return overl
+
+
+def _apply_forced(comp, fixed, report):
+    """Returns the parts left after fixing forced subsets, or None."""
+    subsets = list(comp.subset_wts.keys())
+    by_label = _subset_ids_by_label(subsets)
+    forced_ids = 0
+    for label_idx, ids in by_label.items():
+        if popcount(ids) == 1:
+            forced_ids |= ids
+    if not forced_ids:
+        return None
+    forced_labels = 0
+    for sub_idx in iter_bits(forced_ids):
+        mask = subsets[sub_idx]
+        if mask & forced_labels:
+            raise RuntimeError("A component has overlapping forced subsets")
+        forced_labels |= mask
+    rest = {}
+    for mask, wt in comp.subset_wts.items():
+        if not (mask & forced_labels):
+            rest[mask] = wt
+    covered = 0
+    for mask in rest:
+        covered |= mask
+    if covered != comp.leaves & ~forced_labels:
+        raise RuntimeError("A component cannot be partitioned")
+    for sub_idx in iter_bits(forced_ids):
+        mask = subsets[sub_idx]
+        fixed[mask] = comp.subset_wts[mask]
+    report.record(
+        "forced",
+        labels=popcount(forced_labels),
+        subsets=len(comp.subset_wts) - len(rest),
+    )
+    return _connected_parts(rest)
+
+
+def _drop_infeasible(comp, report):
+    """Returns the parts left after dropping subsets in no partition, or None."""
+    subsets = list(comp.subset_wts.keys())
+    by_label = _subset_ids_by_label(subsets)
+    dropped = []
+    for sub_idx, mask in enumerate(subsets):
+        overl = _overlapping(mask, by_label)
+        # only labels in an overlapping subset can lose all of their cover
+        near = 0
+        for other in iter_bits(overl):
+            near |= subsets[other]
+        for label_idx in iter_bits(near & ~mask):
+            if not (by_label[label_idx] & ~overl):
+                dropped.append(mask)
+                break
+    if not dropped:
+        return None
+    rest = dict(comp.subset_wts)
+    for mask in dropped:
+        del rest[mask]
+    covered = 0
+    for mask in rest:
+        covered |= mask
+    if covered != comp.leaves:
+        raise RuntimeError("A component cannot be partitioned")
+    report.record("infeasible", subsets=len(dropped))
+    return _connected_parts(rest)
+
+
+def _merge_labels(comp, label_groups, report):
+    """Returns `comp` with labels held by the same subsets replaced by one."""
+    subsets = list(comp.subset_wts.keys())
+    by_label = _subset_ids_by_label(subsets)
+    by_occurrence = {}
+    for label_idx, ids in by_label.items():
+        by_occurrence[ids] = by_occurrence.get(ids, 0) | (1 << label_idx)
+    drop = 0
+    for group in by_occurrence.values():
+        if group & (group - 1):
+            rep = group & -group
+            label_groups[rep.bit_length() - 1] = group
+            drop |= group & ~rep
+            report.record("merged-labels", labels=popcount(group) - 1)
+    if not drop:
+        return comp
+    return _component_of({m & ~drop: wt for m, wt in comp.subset_wts.items()})
+
+
+def reduce_components(components):
+    """Applies the reduction rules to MaskComponents.
+
+    Returns (reduced components, fixed subsets as a dict of mask -> weight,
+    label groups as a dict of representative bit -> mask of the group,
+    ReductionReport).
+    """
+    report = ReductionReport(components)
+    fixed = {}
+    label_groups = {}
+    reduced = []
+    queue = list(components)
+    while queue:
+        comp = queue.pop()
+        if len(comp.subset_wts) == 1:
+            mask, wt = next(iter(comp.subset_wts.items()))
+            fixed[mask] = wt
+            report.record("single-subset", labels=popcount(mask), subsets=1)
+            continue
+        parts = _apply_forced(comp, fixed, report)
+        if parts is None:
+            parts = _drop_infeasible(comp, report)
+        if parts is None:
+            reduced.append(_merge_labels(comp, label_groups, report))
+            continue
+        if len(parts) > 1:
+            sizes = sorted(popcount(i.leaves) for i in parts)
+            report.record("split", labels=sum(sizes[:-1]))
+        queue.extend(parts)
+    report.after = ReductionReport._totals(reduced)
+    return reduced, fixed, label_groups, report
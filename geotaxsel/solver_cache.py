@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Persistent cache of max-weight-partition results, shared between runs.
+
+Entries are keyed by a hash of the canonical form of a component's
+`subset_wts` (one "weight,label,label,..." line per subset, with the labels
+sorted and then the lines sorted), so a component that is identical to one
+solved in an earlier run is found regardless of where it was written or
+what its comp-N number was.
+
+Each entry is a `<key>.json` file holding the solver output and a
+`<key>.level` file holding the num_greedy level that produced it (or, while
+the component has not been solved, the level reached so far). When the
+cache holds more than `max_bytes`, the least recently used entries are
+removed (use is tracked by file modification times).
+"""
+
+import hashlib
+import os
+import shutil
+from tempfile import mkstemp
+from .logs import info
+
+
+def component_key(inp_fp):
+    """Returns the sha256 hex digest of the canonical form of a component CSV."""
+    with open(inp_fp, "r") as inp:
+        num_subsets = int(inp.readline().strip())
+        lines = []
+        for line in inp:
+            line = line.strip()
+            if not line:
+                continue
+            wt, *labels = line.split(",")
+            labels.sort()
+            lines.append(",".join([wt] + labels))
+    assert len(lines) == num_subsets
+    lines.sort()
+    h = hashlib.sha256()
+    h.update(f"{num_subsets}\n".encode("utf-8"))
+    for line in lines:
+        h.update(f"{line}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+class SolverCache(object):
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.evict()
+
+    def _entry_fp(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _level_fp(self, key):
+        return os.path.join(self.cache_dir, f"{key}.level")
+
+    def get(self, key, out_fp):
+        """Copies the cached result for `key` to `out_fp`.
+
+        Returns the num_greedy level of the cached result, or None on a miss.
+        """
+        entry_fp = self._entry_fp(key)
+        try:
+            with open(self._level_fp(key), "r") as inp:
+                level = int(inp.read().strip())
+            shutil.copyfile(entry_fp, out_fp + ".HIDE")
+        except (OSError, ValueError):
+            return None
+        os.rename(out_fp + ".HIDE", out_fp)
+        os.utime(entry_fp)
+        return level
+
+    def get_level(self, key):
+        """Returns the num_greedy level recorded for `key`, or None.
+
+        The level is recorded whether or not the solve reached a result, so
+        that a later solve of the same component can start from it.
+        """
+        try:
+            with open(self._level_fp(key), "r") as inp:
+                return int(inp.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def put_level(self, key, level):
+        """Records the num_greedy level reached by a solve of `key`."""
+        with open(self._level_fp(key), "w") as outp:
+            outp.write(f"{level}\n")
+
+    def put(self, key, result_fp, level):
+        """Stores a copy of the solver output `result_fp` under `key`."""
+        fd, tmp_fp = mkstemp(suffix=".tmp", dir=self.cache_dir)
+        os.close(fd)
+        shutil.copyfile(result_fp, tmp_fp)
+        with open(self._level_fp(key), "w") as outp:
+            outp.write(f"{level}\n")
+        os.replace(tmp_fp, self._entry_fp(key))
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith(".json"):
+                continue
+            fp = os.path.join(self.cache_dir, fn)
+            try:
+                st = os.stat(fp)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fn[:-5]))
+        return entries
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_bytes."""
+        if self.max_bytes is None:
+            return
+        entries = self._entries()
+        total = sum(i[1] for i in entries)
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for mtime, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            for fp in (self._entry_fp(key), self._level_fp(key)):
+                try:
+                    os.remove(fp)
+                except OSError:
+                    pass
+            total -= size
+            info(f"Evicted solver cache entry {key}")
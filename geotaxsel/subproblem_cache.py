@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""Bounded cache of sub-problem resolution tables.
+
+Used by cc_for_subset to avoid re-solving the same set of uncovered labels,
+and (when given a memory budget) as the memo of PartitionEngine. Each entry
+of the former is a compact table of (number of subsets, score, subsets) rows,
+where the subsets are the frozensets already held by the top-level
+component, so an entry costs little more than the tuples that hold it.
+
+The cache can be bounded by a number of entries, an estimated number of
+bytes, or both. Eviction follows the GreedyDual-Size policy: an entry's
+priority is the "inflation" value L at the time of its last use plus
+cost / size, where cost is the time it took to solve. The entry with the
+lowest priority is evicted and L is raised to its priority, so cheap,
+large and long-unused entries go first.
+"""
+
+import heapq
+import itertools
+import sys
+
+from .logs import debug
+
+_TUPLE_SIZE = sys.getsizeof(())
+_PTR_SIZE = 8
+# Rough per-entry overhead of the dict slot, key and heap item.
+_ENTRY_OVERHEAD = 200
+
+
+def table_num_bytes(table):
+    """Returns an estimate of the memory used by a resolution table."""
+    n = _TUPLE_SIZE + _PTR_SIZE * len(table)
+    for row in table:
+        n += 2 * _TUPLE_SIZE + _PTR_SIZE * (3 + len(row[2])) + 24
+    return n
+
+
+class SubproblemCache(object):
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> [table, cost, num_bytes, priority, seq]; seq identifies the
+        #   entry's current item in the heap, so that older items are skipped.
+        self._entries = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._inflation = 0.0
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Returns the table for `key` or None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._push(key, entry, self._inflation + entry[1] / entry[2])
+        return entry[0]
+
+    def put(self, key, table, cost, num_bytes=None):
+        """Stores `table` under `key`; `cost` is the time it took to compute.
+
+        If `num_bytes` is None, `table` is a resolution table and its size is
+        estimated by table_num_bytes. Otherwise it is stored as it is.
+        """
+        if num_bytes is None:
+            table = tuple(table)
+            num_bytes = table_num_bytes(table)
+        num_bytes += _ENTRY_OVERHEAD
+        prev = self._entries.pop(key, None)
+        if prev is not None:
+            self.num_bytes -= prev[2]
+        entry = [table, cost, num_bytes, None, None]
+        self._entries[key] = entry
+        self.num_bytes += num_bytes
+        self._push(key, entry, self._inflation + cost / num_bytes)
+        self._evict()
+
+    def _push(self, key, entry, priority):
+        entry[3], entry[4] = priority, next(self._seq)
+        heapq.heappush(self._heap, (priority, entry[4], key))
+
+    def _over_budget(self):
+        if self.max_entries is not None and len(self._entries) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.num_bytes > self.max_bytes
+
+    def _evict(self):
+        heap, entries = self._heap, self._entries
+        while self._over_budget() and heap:
+            priority, seq, key = heapq.heappop(heap)
+            entry = entries.get(key)
+            if entry is None or entry[4] != seq:
+                continue  # stale heap item
+            del entries[key]
+            self.num_bytes -= entry[2]
+            self._inflation = priority
+            self.evictions += 1
+        if len(heap) > 4 * len(entries) + 64:
+            self._heap = [(e[3], e[4], k) for k, e in entries.items()]
+            heapq.heapify(self._heap)
+
+    def clear(self):
+        self._entries.clear()
+        self._heap = []
+        self.num_bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.num_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def log_stats(self, prefix="Sub-problem cache"):
+        st = self.stats()
+        debug(
+            f"{prefix}: {st['hits']} hits, {st['misses']} misses, {st['evictions']} evictions, {st['entries']} entries (~{st['bytes']} bytes)"
+        )
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Compact integer representation of sets of taxon labels.
+
+A TaxonIndex numbers a fixed collection of labels in sorted order, so that
+a set of labels (for example, the tips below a clade chosen in one tree)
+can be stored as a Python int with bit i set for the i-th label. Such masks
+are small to store and pickle, cheap to hash, and support set operations
+as bitwise operators. Masks are converted back to labels only when they
+are written out.
+"""
+
+
+def iter_bits(mask):
+    """Yields the indices of the set bits of `mask` in increasing order."""
+    # Shifting the mask down as bits are found keeps the operations on
+    #   small ints, even for a few labels with high indices.
+    offset = 0
+    while mask:
+        low = (mask & -mask).bit_length() - 1
+        offset += low
+        yield offset
+        mask >>= low + 1
+        offset += 1
+
+
+try:
+    popcount = int.bit_count
+except AttributeError:  # Python < 3.10
+
+    def popcount(mask):
+        return bin(mask).count("1")
+
+
+class TaxonIndex(object):
+    def __init__(self, labels):
+        self.labels = sorted(set(labels))
+        self.bit_of = {label: idx for idx, label in enumerate(self.labels)}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getstate__(self):
+        return {"labels": self.labels}
+
+    def __setstate__(self, state):
+        self.__init__(state["labels"])
+
+    def mask(self, labels):
+        """Returns the int mask for an iterable of labels."""
+        bit_of = self.bit_of
+        m = 0
+        for label in labels:
+            m |= 1 << bit_of[label]
+        return m
+
+    def labels_of(self, mask):
+        """Returns the labels in `mask` as a sorted list."""
+        labels = self.labels
+        return [labels[i] for i in iter_bits(mask)]
+
+    def frozenset_of(self, mask):
+        return frozenset(self.labels_of(mask))
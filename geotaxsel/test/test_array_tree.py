@@ -0,0 +1,173 @@
+#! /usr/bin/env python3
+"""Checks read_newick, ArrayTree.prune and the ultrametric cut against dendropy."""
+
+import os
+import random
+import tempfile
+import unittest
+
+import dendropy
+
+from geotaxsel import (
+    ArrayTree,
+    parse_newick,
+    read_newick,
+    set_verbose,
+    ultrametric_split_order,
+)
+
+_LABEL_CHARS = "abcXYZ_09."
+
+
+def _random_label(rng, idx):
+    """Returns an unquoted or quoted Newick label that is unique by `idx`."""
+    base = "".join(rng.choice(_LABEL_CHARS) for _ in range(rng.randint(0, 4)))
+    if rng.random() < 0.2:
+        return f"'q {idx}''{base}'"
+    return f"T{idx}{base}"
+
+
+def _random_newick(rng, num_tips, ultrametric=False, missing_lengths=True):
+    """Returns a random Newick string, with polytomies and internal labels.
+
+    If `ultrametric`, every tip is at the same (integer) distance from the
+    root, so that nodes of equal age are common. Otherwise, unless
+    `missing_lengths` is False, some edges have no length.
+    """
+    # Each entry is (newick, height).
+    nodes = [(_random_label(rng, i), 0) for i in range(num_tips)]
+    internal_idx = 0
+    while len(nodes) > 1:
+        k = rng.choice([2, 2, 2, 3]) if len(nodes) > 2 else 2
+        picked = sorted(rng.sample(range(len(nodes)), k), reverse=True)
+        children = [nodes[i] for i in picked]
+        for i in picked:
+            del nodes[i]
+        height = max(h for _, h in children) + rng.randint(1, 2)
+        parts = []
+        for text, h in children:
+            if ultrametric:
+                parts.append(f"{text}:{height - h}")
+            elif missing_lengths and rng.random() < 0.1:
+                parts.append(text)
+            else:
+                parts.append(f"{text}:{round(rng.random() + 0.01, 3)}")
+        text = "(" + ",".join(parts) + ")"
+        if rng.random() < 0.3:
+            text += f"N{internal_idx}"
+            internal_idx += 1
+        nodes.append((text, height))
+    prefix = rng.choice(["", "[&R] ", "[&U] ", "[a comment] "])
+    return prefix + nodes[0][0] + ";"
+
+
+def _dendropy_tree(newick):
+    return dendropy.Tree.get(
+        data=newick, schema="newick", preserve_underscores=False, rooting=None
+    )
+
+
+def _as_lists(atree):
+    return atree.parent.tolist(), atree.edge_len.tolist(), list(atree.leaf_labels)
+
+
+class ArrayTreeTest(unittest.TestCase):
+    NUM_SEEDS = 60
+
+    def setUp(self):
+        set_verbose(False)
+
+    def assertSameTree(self, atree, dtree, msg=None):
+        expected, nodes = ArrayTree.from_dendropy(dtree)
+        self.assertEqual(_as_lists(atree), _as_lists(expected), msg)
+        if atree.node_labels is not None:
+            internal = [nd.label for nd in nodes if nd.child_nodes()]
+            got = [
+                lab
+                for lab, nc in zip(atree.node_labels, atree.num_children.tolist())
+                if nc
+            ]
+            self.assertEqual(got, internal, msg)
+
+    def test_parse_newick(self):
+        for seed in range(self.NUM_SEEDS):
+            rng = random.Random(seed)
+            newick = _random_newick(rng, rng.randint(1, 30))
+            atree = parse_newick(newick)
+            dtree = _dendropy_tree(newick)
+            self.assertSameTree(atree, dtree, newick)
+            self.assertEqual(atree.is_rooted, dtree.is_rooted, newick)
+
+    def test_read_newick(self):
+        rng = random.Random(0)
+        newick = _random_newick(rng, 20)
+        with tempfile.TemporaryDirectory() as td:
+            fp = os.path.join(td, "tree.tre")
+            with open(fp, "w") as outp:
+                outp.write(newick)
+                outp.write("\n")
+            atree = read_newick(fp)
+            dtree = dendropy.Tree.get(path=fp, schema="newick")
+        self.assertSameTree(atree, dtree, newick)
+
+    def test_prune(self):
+        for seed in range(self.NUM_SEEDS):
+            rng = random.Random(seed)
+            newick = _random_newick(rng, rng.randint(2, 30))
+            atree = parse_newick(newick)
+            keep = [rng.random() < 0.6 for _ in range(atree.num_leaves)]
+            if not any(keep):
+                keep[rng.randrange(len(keep))] = True
+            pruned = atree.prune(keep)
+            dtree = _dendropy_tree(newick)
+            drop = {lab for lab, k in zip(atree.leaf_labels, keep) if not k}
+            dtree.prune_taxa([t for t in dtree.taxon_namespace if t.label in drop])
+            self.assertSameTree(pruned, dtree, (newick, keep))
+
+    def test_prune_everything(self):
+        atree = parse_newick("((a:1,b:1):1,c:2);")
+        with self.assertRaises(ValueError):
+            atree.prune([False, False, False])
+
+    def test_collapse_basal_bifurcation(self):
+        for seed in range(self.NUM_SEEDS):
+            rng = random.Random(seed)
+            # ArrayTree does not tell a missing edge length from 0.0, which
+            #   dendropy's collapse treats differently.
+            newick = _random_newick(rng, rng.randint(2, 30), missing_lengths=False)
+            atree = parse_newick(newick).collapse_basal_bifurcation()
+            dtree = _dendropy_tree(newick)
+            dtree.is_rooted = False
+            dtree.encode_bipartitions(collapse_unrooted_basal_bifurcation=True)
+            self.assertSameTree(atree, dtree, newick)
+
+    def test_ultrametric_cut(self):
+        for seed in range(self.NUM_SEEDS):
+            rng = random.Random(seed)
+            num_tips = rng.randint(2, 30)
+            newick = _random_newick(rng, num_tips, ultrametric=True)
+            atree = parse_newick(newick)
+            dtree = _dendropy_tree(newick)
+            a_order = ultrametric_split_order(atree, num_tips, 1e-6)
+            d_order = ultrametric_split_order(dtree, num_tips, 1e-6)
+            self.assertEqual(a_order.num_after, d_order.num_after, newick)
+            self.assertEqual(a_order.hit_leaf, d_order.hit_leaf, newick)
+            for num_taxa in a_order.reachable_sizes():
+                a_cut = {
+                    frozenset(atree.leaf_labels_below(nd))
+                    for nd in a_order.cut(num_taxa)
+                }
+                d_cut = {
+                    frozenset(i.taxon.label for i in nd.leaf_nodes())
+                    for nd in d_order.cut(num_taxa)
+                }
+                self.assertEqual(a_cut, d_cut, (newick, num_taxa))
+                for nd in a_order.cut(num_taxa):
+                    self.assertEqual(
+                        a_order.num_leaves_below(nd),
+                        len(atree.leaf_labels_below(nd)),
+                    )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+#! /usr/bin/env python3
+"""Checks the vectorized distances against geopy."""
+
+import random
+import unittest
+
+import numpy as np
+from geopy.distance import geodesic, great_circle
+
+from geotaxsel import ELLIPSOIDAL, SPHERICAL, dists_from, pairwise_dists
+from geotaxsel.geo_dist import ELLIPSOIDAL_TOL_KM
+from geotaxsel.geo_tree_parser import Loc
+
+# Pairs on the equator, 0.3 to 1 degree short of antipodal, for which
+#   Vincenty's iteration does not converge.
+_ANTIPODAL = [
+    ((0.0, 0.0), (0.5, 179.7)),
+    ((0.0, 0.0), (-0.3, 179.4)),
+    ((0.1, 10.0), (-0.2, -170.5)),
+]
+
+
+def _random_coords(rng, num):
+    return [(rng.uniform(-90.0, 90.0), rng.uniform(-180.0, 180.0)) for _ in range(num)]
+
+
+def _near_antipodal(rng, num):
+    """Returns pairs that are within a degree of being antipodal."""
+    pairs = []
+    for _ in range(num):
+        lat, lon = rng.uniform(-89.0, 89.0), rng.uniform(-180.0, 180.0)
+        other_lon = lon + 180.0 + rng.uniform(-1.0, 1.0)
+        if other_lon > 180.0:
+            other_lon -= 360.0
+        pairs.append(((lat, lon), (-lat + rng.uniform(-1.0, 1.0), other_lon)))
+    return pairs
+
+
+class GeoDistTest(unittest.TestCase):
+    def check_pairs(self, pairs):
+        for mode, ref_fn, tol in (
+            (ELLIPSOIDAL, geodesic, ELLIPSOIDAL_TOL_KM),
+            (SPHERICAL, great_circle, ELLIPSOIDAL_TOL_KM),
+        ):
+            got = pairwise_dists(
+                np.array([p[0] for p in pairs]), np.array([p[1] for p in pairs]), mode
+            ).diagonal()
+            for (c1, c2), d in zip(pairs, got):
+                self.assertAlmostEqual(
+                    d, ref_fn(c1, c2).km, delta=tol, msg=(mode, c1, c2)
+                )
+
+    def test_random_pairs(self):
+        rng = random.Random(0)
+        coords = _random_coords(rng, 400)
+        self.check_pairs(list(zip(coords[::2], coords[1::2])))
+
+    def test_near_antipodal(self):
+        rng = random.Random(1)
+        self.check_pairs(_ANTIPODAL + _near_antipodal(rng, 200))
+
+    def test_special_cases(self):
+        self.check_pairs(
+            [
+                ((10.0, 20.0), (10.0, 20.0)),
+                ((0.0, 0.0), (0.0, 90.0)),
+                ((90.0, 0.0), (-90.0, 0.0)),
+                ((45.0, 179.9), (45.0, -179.9)),
+            ]
+        )
+
+    def test_spherical_vs_geodesic(self):
+        """SPHERICAL is within about 0.6% of geodesic."""
+        rng = random.Random(2)
+        coords = _random_coords(rng, 200)
+        got = pairwise_dists(coords_to_locs(coords), coords_to_locs(coords), SPHERICAL)
+        for i, c1 in enumerate(coords):
+            for j, c2 in enumerate(coords[:20]):
+                ref = geodesic(c1, c2).km
+                self.assertLessEqual(abs(got[i, j] - ref), 0.006 * ref + 1.0e-9)
+
+    def test_dists_from(self):
+        rng = random.Random(3)
+        coords = _random_coords(rng, 50)
+        locs = coords_to_locs(coords)
+        for mode in (ELLIPSOIDAL, SPHERICAL):
+            full = pairwise_dists(locs, locs, mode)
+            for idx, loc in enumerate(locs):
+                self.assertEqual(
+                    dists_from(loc, locs, mode).tolist(), full[idx].tolist()
+                )
+        self.assertEqual(dists_from(locs[0], []).shape, (0,))
+        self.assertEqual(pairwise_dists(locs, []).shape, (50, 0))
+        with self.assertRaises(ValueError):
+            dists_from(locs[0], locs, mode="flat")
+
+
+def coords_to_locs(coords):
+    return [Loc(lat, lon) for lat, lon in coords]
+
+
+if __name__ == "__main__":
+    unittest.main()
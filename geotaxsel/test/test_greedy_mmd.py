@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+"""Checks greedy_mmd against the full patristic distance matrix version."""
+
+import random
+import unittest
+
+import dendropy
+from dendropy.calculate.phylogeneticdistance import PhylogeneticDistanceMatrix
+
+from geotaxsel import greedy_mmd, set_verbose
+from geotaxsel.geo_tree_parser import Loc, Species
+from geotaxsel.greedy_mmd import _TipDistRows
+
+
+def _random_newick(rng, num_tips, int_lengths):
+    """Returns a random Newick string; integer edge lengths give ties."""
+    nodes = [f"T{i}" for i in range(num_tips)]
+    while len(nodes) > 1:
+        i, j = sorted(rng.sample(range(len(nodes)), 2))
+        lens = []
+        for _ in range(2):
+            if int_lengths:
+                lens.append(rng.randint(1, 3))
+            else:
+                lens.append(rng.random() + 0.01)
+        merged = f"({nodes[i]}:{lens[0]},{nodes[j]}:{lens[1]})"
+        del nodes[j]
+        nodes[i] = merged
+    return nodes[0] + ";"
+
+
+def _random_species(rng, num_tips):
+    sp_by_name = {}
+    for i in range(num_tips):
+        sp = Species(f"T{i}", i)
+        for _ in range(rng.randint(1, 3)):
+            sp.add_loc(Loc(rng.uniform(-60.0, 60.0), rng.uniform(-180.0, 180.0)))
+        sp_by_name[sp.name] = sp
+    return sp_by_name
+
+
+class GreedyMMDTest(unittest.TestCase):
+    def setUp(self):
+        set_verbose(False)
+
+    def test_same_as_full_matrix(self):
+        for seed in range(60):
+            rng = random.Random(seed)
+            num_tips = rng.randint(3, 25)
+            newick = _random_newick(rng, num_tips, int_lengths=seed % 2 == 0)
+            sp_by_name = _random_species(rng, num_tips)
+            num_taxa = rng.randint(2, num_tips)
+            tree = dendropy.Tree.get(data=newick, schema="newick")
+            fast = greedy_mmd(tree, num_taxa, sp_by_name)
+            tree = dendropy.Tree.get(data=newick, schema="newick")
+            slow = greedy_mmd(tree, num_taxa, sp_by_name, full_matrix=True)
+            self.assertEqual(fast, slow, newick)
+
+    def test_tip_dist_rows(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            newick = _random_newick(rng, rng.randint(2, 20), int_lengths=False)
+            tree = dendropy.Tree.get(data=newick, schema="newick")
+            pdm = PhylogeneticDistanceMatrix.from_tree(tree)
+            taxa = [i.taxon for i in tree.leaf_nodes()]
+            rows = _TipDistRows(tree)
+            for idx, t1 in enumerate(taxa):
+                expected = [pdm.patristic_distance(t1, t2) for t2 in taxa]
+                self.assertEqual(rows.row(idx).tolist(), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+#! /usr/bin/env python3
+"""Checks the merge of component resolutions against a sequential merge."""
+
+import json
+import os
+import random
+import tempfile
+import unittest
+
+from geotaxsel import (
+    MERGED_DP_FN,
+    PROB_FN,
+    TaxonIndex,
+    choose_most_common,
+    serialize_problems_for_most_common_choice,
+    set_verbose,
+)
+from geotaxsel.multi_tree_set_sel import ResolutionWrapper
+from geotaxsel.test.util import (
+    IN_PROCESS,
+    random_rep_selections,
+    read_frontier,
+    reference_frontier,
+    sequential_merge,
+)
+
+
+def _random_res_list(rng, labels):
+    """Returns solver output for `labels`, with some sizes missing."""
+    res_list = []
+    num_sizes = rng.randint(1, len(labels))
+    for size in sorted(rng.sample(range(1, len(labels) + 1), num_sizes)):
+        cuts = sorted(rng.sample(range(1, len(labels)), size - 1))
+        subsets, prev = [], 0
+        for cut in cuts + [len(labels)]:
+            subsets.append(labels[prev:cut])
+            prev = cut
+        res_list.append({"score": rng.randint(0, 40), "size": size, "subsets": subsets})
+    return res_list
+
+
+class AbsorbTest(unittest.TestCase):
+    def setUp(self):
+        set_verbose(False)
+
+    def test_absorb(self):
+        for seed in range(100):
+            rng = random.Random(seed)
+            res_lists, all_labels = [], []
+            for comp in range(rng.randint(1, 6)):
+                labels = [f"C{comp}L{i}" for i in range(rng.randint(1, 6))]
+                all_labels.extend(labels)
+                res_lists.append(_random_res_list(rng, labels))
+            taxon_index = TaxonIndex(all_labels)
+            expected = sequential_merge(
+                [{r["size"]: float(r["score"]) for r in i} for i in res_lists]
+            )
+            subset_scores = {}
+            for res_list in res_lists:
+                for res in res_list:
+                    for subset in res["subsets"]:
+                        subset_scores[taxon_index.mask(subset)] = None
+            wrappers = [ResolutionWrapper(i, taxon_index) for i in res_lists]
+            final = wrappers[0]
+            for other in wrappers[1:]:
+                final.absorb(other, final_n=None, min_num_after=0)
+            for size in range(final.min_num, final.max_num + 1):
+                self.assertEqual(final.score_for(size), expected.get(size))
+            self.assertEqual(final.min_num, min(expected))
+            self.assertEqual(final.max_num, max(expected))
+            for size in expected:
+                subsets = final.subsets_for(size)
+                self.assertEqual(len(subsets), size)
+                covered = 0
+                for mask in subsets:
+                    self.assertIn(mask, subset_scores)
+                    self.assertFalse(covered & mask)
+                    covered |= mask
+                self.assertEqual(covered, taxon_index.mask(all_labels))
+
+    def test_absorb_final_n(self):
+        for seed in range(100):
+            rng = random.Random(seed)
+            res_lists = []
+            for comp in range(rng.randint(2, 6)):
+                labels = [f"C{comp}L{i}" for i in range(rng.randint(1, 6))]
+                res_lists.append(_random_res_list(rng, labels))
+            taxon_index = TaxonIndex(
+                {x for i in res_lists for r in i for s in r["subsets"] for x in s}
+            )
+            expected = sequential_merge(
+                [{r["size"]: float(r["score"]) for r in i} for i in res_lists]
+            )
+            final_n = rng.choice(sorted(expected))
+            wrappers = [ResolutionWrapper(i, taxon_index) for i in res_lists]
+            min_after = sum(i.min_num for i in wrappers[1:])
+            max_after = sum(i.max_num for i in wrappers[1:])
+            final = wrappers[0]
+            for other in wrappers[1:]:
+                min_after -= other.min_num
+                max_after -= other.max_num
+                final.absorb(other, final_n, min_after, max_after)
+            self.assertEqual(final.score_for(final_n), expected[final_n])
+            self.assertEqual(len(final.subsets_for(final_n)), final_n)
+
+
+class ChooseMostCommonTest(unittest.TestCase):
+    def setUp(self):
+        set_verbose(False)
+
+    def check_selection(self, rep, taxon_index, score, subsets, num_to_select):
+        self.assertEqual(len(subsets), num_to_select)
+        covered = set()
+        for subset in subsets:
+            self.assertTrue(covered.isdisjoint(subset))
+            covered.update(subset)
+        self.assertEqual(covered, set(taxon_index.labels))
+        self.assertEqual(sum(rep[taxon_index.mask(i)] for i in subsets), score)
+
+    def test_against_sequential_merge(self):
+        for seed in range(30):
+            rep, taxon_index = random_rep_selections(seed)
+            expected = reference_frontier(rep, taxon_index)
+            with tempfile.TemporaryDirectory() as td:
+                serialize_problems_for_most_common_choice(
+                    rep, taxon_index, temp_dir=td, reduce=False, dedup=False
+                )
+                for num_to_select, score in expected.items():
+                    sc, subsets = choose_most_common(
+                        num_to_select,
+                        td,
+                        taxon_index=taxon_index,
+                        in_process_max_subsets=IN_PROCESS,
+                    )
+                    self.assertEqual(sc, score)
+                    self.check_selection(rep, taxon_index, sc, subsets, num_to_select)
+
+    def test_saved_merge(self):
+        for seed in range(30):
+            rep, taxon_index = random_rep_selections(seed)
+            expected = reference_frontier(rep, taxon_index)
+            with tempfile.TemporaryDirectory() as td:
+                serialize_problems_for_most_common_choice(rep, taxon_index, temp_dir=td)
+                frontier_fp = os.path.join(td, "frontier.tsv")
+                choose_most_common(
+                    min(expected),
+                    td,
+                    taxon_index=taxon_index,
+                    frontier_fp=frontier_fp,
+                    in_process_max_subsets=IN_PROCESS,
+                )
+                self.assertEqual(read_frontier(frontier_fp), expected)
+                self.assertTrue(os.path.isfile(os.path.join(td, MERGED_DP_FN)))
+                for num_to_select, score in expected.items():
+                    sc, subsets = choose_most_common(num_to_select, td)
+                    self.assertEqual(sc, score)
+                    self.check_selection(rep, taxon_index, sc, subsets, num_to_select)
+
+    def test_stale_saved_merge(self):
+        """A merge saved before a component was solved again is not used."""
+        rep, taxon_index = random_rep_selections(3)
+        expected = reference_frontier(rep, taxon_index)
+        with tempfile.TemporaryDirectory() as td:
+            serialize_problems_for_most_common_choice(
+                rep, taxon_index, temp_dir=td, dedup=False
+            )
+            frontier_fp = os.path.join(td, "frontier.tsv")
+            choose_most_common(
+                min(expected),
+                td,
+                taxon_index=taxon_index,
+                frontier_fp=frontier_fp,
+                in_process_max_subsets=IN_PROCESS,
+            )
+            with open(os.path.join(td, PROB_FN), "r") as inp:
+                out_fp = next(inp).strip()[:-4] + ".json"
+            with open(out_fp, "r") as inp:
+                res_list = json.load(inp)
+            for res in res_list:
+                res["score"] += 1
+            with open(out_fp, "w") as outp:
+                json.dump(res_list, outp)
+            num_to_select = max(expected)
+            sc, subsets = choose_most_common(num_to_select, td, taxon_index=taxon_index)
+            self.assertEqual(sc, expected[num_to_select] + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+"""Checks the bitset solvers against the frozenset search (use_bitsets=False)."""
+
+import random
+import unittest
+from unittest import mock
+
+from geotaxsel import LaminarSolver, PartitionEngine, TaxonIndex, set_verbose
+from geotaxsel.label_graph import ConnectedComponent, LabelGraph, _LabelIndex
+from geotaxsel.test.util import random_subsets
+
+
+def _random_components(seed):
+    rng = random.Random(seed)
+    num_labels = rng.randint(5, 18)
+    labels = [f"L{i:02d}" for i in range(num_labels)]
+    rep = random_subsets(
+        rng, labels, rng.randint(2, 10), rng.randint(2, min(6, num_labels)), 3
+    )
+    taxon_index = TaxonIndex(set().union(*rep.keys()))
+    lg = LabelGraph(taxon_index)
+    for subset, count in rep.items():
+        lg.add_set(taxon_index.mask(subset), count)
+    return [c.to_connected_component(taxon_index) for c in lg.components]
+
+
+def _reference_scores(cc):
+    ref = ConnectedComponent(leaves=cc.leaves, subset_wts=cc.subset_wts)
+    ref.fill_resolutions(use_bitsets=False)
+    return {k: v.score for k, v in ref.resolutions.items()}
+
+
+class PartitionEngineTest(unittest.TestCase):
+    NUM_SEEDS = 40
+
+    def setUp(self):
+        set_verbose(False)
+
+    def check_solution(self, cc, by_size):
+        """Checks that each (score, subsets) partitions the leaves."""
+        for num_subs, (score, subsets) in by_size.items():
+            self.assertEqual(len(subsets), num_subs)
+            covered = set()
+            for subset in subsets:
+                self.assertTrue(covered.isdisjoint(subset))
+                covered.update(subset)
+            self.assertEqual(covered, cc.leaves)
+            self.assertEqual(sum(cc.subset_wts[i] for i in subsets), score)
+
+    def each_component(self):
+        for seed in range(self.NUM_SEEDS):
+            for cc in _random_components(seed):
+                yield cc, _reference_scores(cc)
+
+    def test_partition_engine(self):
+        for cc, expected in self.each_component():
+            for kwargs in (
+                {},
+                {"branch_and_bound": False},
+                {"memo_max_bytes": 4096},
+                {"memo_max_bytes": 0},
+            ):
+                by_size = PartitionEngine(cc.subset_wts, **kwargs).solve()
+                self.check_solution(cc, by_size)
+                scores = {k: v[0] for k, v in by_size.items()}
+                self.assertEqual(scores, expected, kwargs)
+
+    def test_laminar_solver(self):
+        for cc, expected in self.each_component():
+            by_size = LaminarSolver(cc.subset_wts).solve()
+            self.check_solution(cc, by_size)
+            self.assertEqual({k: v[0] for k, v in by_size.items()}, expected)
+
+    def test_fill_resolutions(self):
+        for cc, expected in self.each_component():
+            comp = ConnectedComponent(leaves=cc.leaves, subset_wts=cc.subset_wts)
+            comp.fill_resolutions()
+            self.assertEqual(
+                {k: v.score for k, v in comp.resolutions.items()}, expected
+            )
+            self.assertEqual(comp.min_num_subs, min(expected))
+            self.assertEqual(comp.max_num_subs, max(expected))
+
+
+class LabelIndexTest(unittest.TestCase):
+    def setUp(self):
+        set_verbose(False)
+
+    def test_derived_counts(self):
+        """The counts updated from the removed subsets are those of the kept."""
+        derived = _LabelIndex.derived.__func__
+        num_updated = [0]
+
+        def checked(cls, parent, kept, removed, labels):
+            self.assertEqual(
+                sorted(kept + removed, key=sorted), sorted(parent.subsets, key=sorted)
+            )
+            index = derived(cls, parent, kept, removed, labels)
+            if len(removed) < len(kept):
+                num_updated[0] += 1
+            fresh = _LabelIndex(kept).counts
+            for label in labels:
+                self.assertEqual(index.counts.get(label, 0), fresh.get(label, 0))
+            return index
+
+        with mock.patch.object(_LabelIndex, "derived", classmethod(checked)):
+            for seed in range(PartitionEngineTest.NUM_SEEDS):
+                for cc in _random_components(seed):
+                    _reference_scores(cc)
+        self.assertGreater(num_updated[0], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
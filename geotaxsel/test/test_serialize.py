@@ -0,0 +1,64 @@
+#! /usr/bin/env python3
+"""Checks that reduce_components and the canonical dedup leave the frontier unchanged."""
+
+import os
+import tempfile
+import unittest
+
+from geotaxsel import (
+    choose_most_common,
+    serialize_problems_for_most_common_choice,
+    set_verbose,
+)
+from geotaxsel.multi_tree_set_sel import COPIES_FN
+from geotaxsel.test.util import (
+    IN_PROCESS,
+    random_rep_selections,
+    read_frontier,
+    reference_frontier,
+)
+
+
+class SerializeTest(unittest.TestCase):
+    def setUp(self):
+        set_verbose(False)
+
+    def frontier(self, rep, taxon_index, reduce, dedup, num_to_select):
+        """Returns (frontier, whether any component was written as a copy)."""
+        with tempfile.TemporaryDirectory() as td:
+            serialize_problems_for_most_common_choice(
+                rep, taxon_index, temp_dir=td, reduce=reduce, dedup=dedup
+            )
+            frontier_fp = os.path.join(td, "frontier.tsv")
+            sc, subsets = choose_most_common(
+                num_to_select,
+                td,
+                taxon_index=taxon_index,
+                frontier_fp=frontier_fp,
+                in_process_max_subsets=IN_PROCESS,
+            )
+            self.assertEqual(len(subsets), num_to_select)
+            self.assertEqual(sum(rep[taxon_index.mask(i)] for i in subsets), sc)
+            has_copies = os.path.isfile(os.path.join(td, COPIES_FN))
+            return read_frontier(frontier_fp), has_copies
+
+    def test_same_frontier(self):
+        num_with_copies = 0
+        for seed in range(40):
+            rep, taxon_index = random_rep_selections(seed)
+            expected = reference_frontier(rep, taxon_index)
+            num_to_select = sorted(expected)[len(expected) // 2]
+            for reduce in (False, True):
+                for dedup in (False, True):
+                    frontier, has_copies = self.frontier(
+                        rep, taxon_index, reduce, dedup, num_to_select
+                    )
+                    self.assertEqual(frontier, expected, (seed, reduce, dedup))
+                    if dedup and has_copies:
+                        num_with_copies += 1
+        # Some of the random problems must have exercised the dedup.
+        self.assertGreater(num_with_copies, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+#! /usr/bin/env python3
+"""Checks the content-addressed cache of solver results."""
+
+import os
+import tempfile
+import unittest
+
+from geotaxsel import SolverCache, component_key, set_verbose
+from geotaxsel.multi_tree_set_sel import _ensure_problems_solved
+from geotaxsel.test.test_solver_runs import StubSolverTest
+
+
+def _write_component(fp, lines):
+    with open(fp, "w") as outp:
+        outp.write(f"{len(lines)}\n")
+        for line in lines:
+            outp.write(f"{line}\n")
+
+
+class SolverCacheTest(unittest.TestCase):
+    def setUp(self):
+        set_verbose(False)
+        self._td = tempfile.TemporaryDirectory()
+        self.td = self._td.name
+        self.cache_dir = os.path.join(self.td, "cache")
+
+    def tearDown(self):
+        self._td.cleanup()
+
+    def write_result(self, name, content):
+        fp = os.path.join(self.td, name)
+        with open(fp, "w") as outp:
+            outp.write(content)
+        return fp
+
+    def read(self, fp):
+        with open(fp, "r") as inp:
+            return inp.read()
+
+    def test_component_key(self):
+        a = os.path.join(self.td, "a.csv")
+        b = os.path.join(self.td, "b.csv")
+        c = os.path.join(self.td, "c.csv")
+        _write_component(a, ["3,x,y", "1,z"])
+        # The same subsets, in another order and written elsewhere
+        _write_component(b, ["1,z", "3,y,x"])
+        # A changed weight
+        _write_component(c, ["2,x,y", "1,z"])
+        self.assertEqual(component_key(a), component_key(b))
+        self.assertNotEqual(component_key(a), component_key(c))
+
+    def test_round_trip(self):
+        cache = SolverCache(self.cache_dir)
+        result_fp = self.write_result("r.json", '[{"score": 4}]')
+        out_fp = os.path.join(self.td, "out.json")
+        self.assertIsNone(cache.get("k1", out_fp))
+        self.assertFalse(os.path.exists(out_fp))
+        cache.put("k1", result_fp, 3)
+        self.assertEqual(cache.get("k1", out_fp), 3)
+        self.assertEqual(self.read(out_fp), '[{"score": 4}]')
+        self.assertFalse(os.path.exists(out_fp + ".HIDE"))
+        self.assertIsNone(cache.get("k2", os.path.join(self.td, "other.json")))
+        # A new cache on the same directory (a later run) finds the entry.
+        again = SolverCache(self.cache_dir)
+        out2_fp = os.path.join(self.td, "out2.json")
+        self.assertEqual(again.get("k1", out2_fp), 3)
+        self.assertEqual(self.read(out2_fp), '[{"score": 4}]')
+
+    def test_level_without_result(self):
+        cache = SolverCache(self.cache_dir)
+        self.assertIsNone(cache.get_level("k"))
+        cache.put_level("k", 6)
+        self.assertEqual(cache.get_level("k"), 6)
+        # A level alone is not a result.
+        self.assertIsNone(cache.get("k", os.path.join(self.td, "out.json")))
+
+    def test_eviction(self):
+        cache = SolverCache(self.cache_dir, max_bytes=250)
+        for idx in range(3):
+            fp = self.write_result(f"r{idx}.json", str(idx) * 100)
+            cache.put(f"k{idx}", fp, idx)
+            entry_fp = os.path.join(self.cache_dir, f"k{idx}.json")
+            os.utime(entry_fp, (1000.0 + idx, 1000.0 + idx))
+        # k0 was used least recently, so it was evicted when k2 was put.
+        self.assertIsNone(cache.get_level("k0"))
+        self.assertEqual(
+            sorted(os.listdir(self.cache_dir)),
+            ["k1.json", "k1.level", "k2.json", "k2.level"],
+        )
+        # Using k1 makes k2 the next to go.
+        self.assertEqual(cache.get("k1", os.path.join(self.td, "out.json")), 1)
+        fp = self.write_result("r3.json", "3" * 100)
+        cache.put("k3", fp, 3)
+        self.assertIsNotNone(cache.get_level("k1"))
+        self.assertIsNone(cache.get_level("k2"))
+        self.assertIsNotNone(cache.get_level("k3"))
+
+    def test_eviction_on_open(self):
+        cache = SolverCache(self.cache_dir)
+        for idx in range(3):
+            cache.put(f"k{idx}", self.write_result(f"r{idx}.json", "x" * 100), idx)
+            entry_fp = os.path.join(self.cache_dir, f"k{idx}.json")
+            os.utime(entry_fp, (1000.0 + idx, 1000.0 + idx))
+        SolverCache(self.cache_dir, max_bytes=100)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ["k2.json", "k2.level"])
+
+
+class CacheAcrossRunsTest(StubSolverTest):
+    def scratch(self, name, lines):
+        scratch_dir = os.path.join(self.td, name)
+        os.mkdir(scratch_dir)
+        fp = os.path.join(scratch_dir, "comp-1.csv")
+        _write_component(fp, lines)
+        return fp
+
+    def solve(self, inp_fp, cache):
+        _ensure_problems_solved(
+            [inp_fp], max_secs_per_run=30, cache=cache, in_process_max_subsets=0
+        )
+        return self.read_output(inp_fp[:-4] + ".json")
+
+    def test_across_runs(self):
+        cache_dir = os.path.join(self.td, "cache")
+        first = self.scratch("run1", ["3,x,y", "1,z", "1,x"])
+        self.assertEqual(
+            self.solve(first, SolverCache(cache_dir)), {"input": first, "level": 0}
+        )
+        self.assertEqual(len(self.started()), 1)
+        # The same component in a new scratch dir is not solved again.
+        second = self.scratch("run2", ["1,x", "3,y,x", "1,z"])
+        self.assertEqual(
+            self.solve(second, SolverCache(cache_dir)), {"input": first, "level": 0}
+        )
+        self.assertEqual(len(self.started()), 1)
+        with open(second[:-4] + ".level", "r") as inp:
+            self.assertEqual(inp.read().strip(), "0")
+        # A changed component misses the cache.
+        third = self.scratch("run3", ["3,x,y", "2,z", "1,x"])
+        self.assertEqual(
+            self.solve(third, SolverCache(cache_dir)), {"input": third, "level": 0}
+        )
+        self.assertEqual(len(self.started()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
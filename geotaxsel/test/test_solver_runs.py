@@ -0,0 +1,234 @@
+#! /usr/bin/env python3
+"""Runs the max-weight-partition scheduling against a stub solver on PATH.
+
+The stub writes {"input": ..., "level": ...} as its output, and logs its
+pid, input and num_greedy level to STUB_LOG when it starts. It sleeps for
+STUB_DELAY_L<level> (or STUB_DELAY) seconds first, and exits with status 1
+at once if STUB_FAIL is a substring of its input path.
+"""
+
+import json
+import os
+import stat
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from geotaxsel import SolverCache, set_verbose
+from geotaxsel.multi_tree_set_sel import (
+    _SolverProcs,
+    _run_solver,
+    _run_solver_on_all,
+    _run_solver_portfolio,
+)
+
+_STUB = """#!{python}
+import json, os, sys, time
+inp = sys.argv[1]
+level = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+with open(os.environ["STUB_LOG"], "a") as outp:
+    outp.write(f"{{os.getpid()}}\\t{{inp}}\\t{{level}}\\n")
+fail = os.environ.get("STUB_FAIL")
+if fail and fail in inp:
+    sys.exit(1)
+time.sleep(float(os.environ.get(f"STUB_DELAY_L{{level}}", os.environ.get("STUB_DELAY", "0"))))
+json.dump({{"input": inp, "level": level}}, sys.stdout)
+"""
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+class StubSolverTest(unittest.TestCase):
+    def setUp(self):
+        set_verbose(False)
+        self._td = tempfile.TemporaryDirectory()
+        self.td = self._td.name
+        bin_dir = os.path.join(self.td, "bin")
+        os.mkdir(bin_dir)
+        stub_fp = os.path.join(bin_dir, "max-weight-partition")
+        with open(stub_fp, "w") as outp:
+            outp.write(_STUB.format(python=os.path.realpath(sys.executable)))
+        os.chmod(stub_fp, os.stat(stub_fp).st_mode | stat.S_IEXEC)
+        self.log_fp = os.path.join(self.td, "stub.log")
+        env = {
+            k: v
+            for k, v in os.environ.items()
+            if not k.startswith("STUB_") and k != "PATH"
+        }
+        env["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+        env["STUB_LOG"] = self.log_fp
+        self._env = mock.patch.dict(os.environ, env, clear=True)
+        self._env.start()
+
+    def tearDown(self):
+        self._env.stop()
+        self._td.cleanup()
+
+    def set_env(self, **kwargs):
+        os.environ.update({k: str(v) for k, v in kwargs.items()})
+
+    def started(self):
+        """Returns the (pid, input, level) of each stub run, in start order."""
+        if not os.path.isfile(self.log_fp):
+            return []
+        with open(self.log_fp, "r") as inp:
+            rows = [i.rstrip("\n").split("\t") for i in inp]
+        return [(int(pid), inp_fp, int(level)) for pid, inp_fp, level in rows]
+
+    def assertNoneRunning(self):
+        for pid, inp_fp, level in self.started():
+            self.assertFalse(_alive(pid), (inp_fp, level))
+
+    def write_problems(self, sizes):
+        """Writes a component CSV with each number of subsets; returns the to-do list."""
+        to_do = []
+        for idx, num_subsets in enumerate(sizes):
+            inp_fp = os.path.join(self.td, f"comp-{idx + 1}.csv")
+            with open(inp_fp, "w") as outp:
+                outp.write(f"{num_subsets}\n")
+                for sub_idx in range(num_subsets):
+                    outp.write(f"1,a{sub_idx}\n")
+            to_do.append((inp_fp, inp_fp[:-4] + ".json", None))
+        return to_do
+
+    def read_output(self, out_fp):
+        with open(out_fp, "r") as inp:
+            return json.load(inp)
+
+
+class RunOnAllTest(StubSolverTest):
+    def check_outputs(self, to_do):
+        for inp_fp, out_fp, key in to_do:
+            self.assertEqual(self.read_output(out_fp), {"input": inp_fp, "level": 0})
+            self.assertFalse(os.path.exists(out_fp + ".HIDE"))
+
+    def test_largest_first(self):
+        to_do = self.write_problems([3, 9, 1, 5, 7])
+        _run_solver_on_all(to_do, max_secs_per_run=30)
+        self.check_outputs(to_do)
+        order = [os.path.basename(i[1]) for i in self.started()]
+        self.assertEqual(
+            order,
+            ["comp-2.csv", "comp-5.csv", "comp-4.csv", "comp-1.csv", "comp-3.csv"],
+        )
+
+    def test_parallel(self):
+        to_do = self.write_problems([3, 9, 1, 5, 7, 2, 8])
+        self.set_env(STUB_DELAY=0.3)
+        _run_solver_on_all(to_do, max_secs_per_run=30, num_procs=3)
+        self.check_outputs(to_do)
+        started = [os.path.basename(i[1]) for i in self.started()]
+        self.assertEqual(len(started), len(to_do))
+        self.assertEqual(set(started[:3]), {"comp-2.csv", "comp-7.csv", "comp-5.csv"})
+        self.assertNoneRunning()
+
+    def test_failure_is_reported(self):
+        to_do = self.write_problems([1, 2])
+        self.set_env(STUB_FAIL="comp-1.csv")
+        with self.assertRaises(RuntimeError):
+            _run_solver_on_all(to_do, max_secs_per_run=30)
+
+    def test_failure_stops_the_others(self):
+        to_do = self.write_problems([9, 8, 7, 1])
+        self.set_env(STUB_DELAY=60, STUB_FAIL="comp-4.csv")
+        start = time.monotonic()
+        with self.assertRaises(RuntimeError):
+            _run_solver_on_all(to_do, max_secs_per_run=120, num_procs=4)
+        self.assertLess(time.monotonic() - start, 30)
+        self.assertNoneRunning()
+        for inp_fp, out_fp, key in to_do:
+            self.assertFalse(os.path.exists(out_fp))
+
+
+class PortfolioTest(StubSolverTest):
+    def assertOnlyOutput(self, out_fp):
+        """Checks that the losers' outputs and error files were removed."""
+        left = [i for i in os.listdir(self.td) if i.startswith("comp-1")]
+        expected = ["comp-1.csv"]
+        if os.path.exists(out_fp):
+            expected += ["comp-1.json", "comp-1.json-err.txt"]
+        # The level reached, recorded by _run_solver
+        if os.path.exists(out_fp[:-5] + ".level"):
+            expected.append("comp-1.level")
+        self.assertEqual(sorted(left), sorted(expected))
+
+    def test_first_to_finish_wins(self):
+        inp_fp, out_fp, key = self.write_problems([4])[0]
+        self.set_env(STUB_DELAY=60, STUB_DELAY_L3=0.2)
+        start = time.monotonic()
+        level = _run_solver_portfolio(inp_fp, out_fp, 30, 2, 3, _SolverProcs())
+        self.assertLess(time.monotonic() - start, 20)
+        self.assertEqual(level, 3)
+        self.assertEqual(self.read_output(out_fp), {"input": inp_fp, "level": 3})
+        self.assertEqual(sorted(i[2] for i in self.started()), [2, 3, 4])
+        self.assertNoneRunning()
+        self.assertOnlyOutput(out_fp)
+
+    def test_all_time_out(self):
+        inp_fp, out_fp, key = self.write_problems([4])[0]
+        self.set_env(STUB_DELAY=60)
+        level = _run_solver_portfolio(inp_fp, out_fp, 1, 0, 3, _SolverProcs())
+        self.assertIsNone(level)
+        self.assertFalse(os.path.exists(out_fp))
+        self.assertNoneRunning()
+        self.assertOnlyOutput(out_fp)
+
+    def test_failing_member(self):
+        inp_fp, out_fp, key = self.write_problems([4])[0]
+        self.set_env(STUB_DELAY=60, STUB_FAIL="comp-1")
+        with self.assertRaises(RuntimeError):
+            _run_solver_portfolio(inp_fp, out_fp, 30, 0, 2, _SolverProcs())
+        self.assertNoneRunning()
+
+    def test_escalation(self):
+        inp_fp, out_fp, key = self.write_problems([4])[0]
+        cache = SolverCache(os.path.join(self.td, "cache"))
+        key = "k"
+        # Level 0 times out, level 1 finishes early and level 2 times out.
+        self.set_env(STUB_DELAY=60, STUB_DELAY_L1=0.2)
+        _run_solver(inp_fp, out_fp, 1, cache=cache, key=key)
+        self.assertEqual(self.read_output(out_fp), {"input": inp_fp, "level": 1})
+        self.assertEqual([i[2] for i in self.started()], [0, 1])
+        self.assertEqual(cache.get_level(key), 1)
+        with open(out_fp[:-5] + ".level", "r") as inp:
+            self.assertEqual(inp.read().strip(), "1")
+        self.assertNoneRunning()
+
+    def test_escalation_portfolio(self):
+        inp_fp, out_fp, key = self.write_problems([4])[0]
+        self.set_env(STUB_DELAY=60, STUB_DELAY_L3=0.2)
+        _run_solver(inp_fp, out_fp, 1, portfolio=2)
+        self.assertEqual(self.read_output(out_fp), {"input": inp_fp, "level": 3})
+        self.assertEqual(sorted(i[2] for i in self.started()), [0, 1, 2, 3])
+        self.assertNoneRunning()
+        self.assertOnlyOutput(out_fp)
+
+    def test_starts_at_recorded_level(self):
+        inp_fp, out_fp, key = self.write_problems([4])[0]
+        cache = SolverCache(os.path.join(self.td, "cache"))
+        cache.put_level("k", 5)
+        _run_solver(inp_fp, out_fp, 30, cache=cache, key="k")
+        self.assertEqual([i[2] for i in self.started()], [5])
+
+    def test_max_num_greedy(self):
+        inp_fp, out_fp, key = self.write_problems([4])[0]
+        self.set_env(STUB_DELAY=60)
+        with self.assertRaises(RuntimeError):
+            _run_solver(inp_fp, out_fp, 0.5, portfolio=2, max_num_greedy=2)
+        self.assertEqual(sorted(i[2] for i in self.started()), [0, 1, 2])
+        with open(out_fp[:-5] + ".level", "r") as inp:
+            self.assertEqual(inp.read().strip(), "2")
+        self.assertFalse(os.path.exists(out_fp))
+        self.assertNoneRunning()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,290 @@
+#! /usr/bin/env python3
+"""Checks the clade labelling against the set-based search it replaced,
+and the on-disk cache of compiled clade definitions.
+"""
+
+import json
+import os
+import random
+import tempfile
+import unittest
+
+import dendropy
+
+from geotaxsel import (
+    ArrayTree,
+    CladeDef,
+    CompiledClades,
+    Ranks,
+    compile_clades,
+    find_clades,
+    label_internals,
+    set_verbose,
+)
+from geotaxsel.taxonomy import parse_clade_defs
+
+_TIPS = [
+    "Aus a",
+    "Aus b",
+    "Aus c",
+    "Bus d",
+    "Bus e",
+    "Cus f",
+    "Cus g",
+    "Dus h",
+    "Eus i",
+    "Eus j",
+    "Fus k",
+]
+
+
+def _clades():
+    """Returns nested and overlapping clade definitions over _TIPS.
+
+    Includes an incertae sedis tip, a species missing from every tree, a
+    clade that spans two families, an order that names another order, and
+    a family with no tips in any tree.
+    """
+    g, f, sf, o, so = (
+        Ranks.GENUS,
+        Ranks.FAMILY,
+        Ranks.SUBFAMILY,
+        Ranks.ORDER,
+        Ranks.SUPERORDER,
+    )
+    return {
+        "Aus": CladeDef(["Aus a", "Aus b", "Aus c"], rank=g),
+        "Bus": CladeDef(["Bus d", "Bus e"], rank=g),
+        "Cus": CladeDef(["Cus f", "Cus g", "Cus y"], rank=g),
+        "Eus": CladeDef(["Eus i", "Eus j"], rank=g),
+        "Abinae": CladeDef(["Aus", "Bus"], rank=sf),
+        "Bcinae": CladeDef(["Bus", "Cus"], rank=sf),
+        "Abidae": CladeDef(["Abinae"], incertae_sedis=["Dus h"], rank=f),
+        "Cidae": CladeDef(["Cus", "Eus"], incertae_sedis=["Eus"], rank=f),
+        "Zidae": CladeDef(["Zus y", "Zus z"], rank=f),
+        "Secundiformes": CladeDef(["Primiformes", "Fus k"], rank=o),
+        "Primiformes": CladeDef(["Abidae", "Cidae"], rank=o),
+        "Magnia": CladeDef(["Aus a", "Eus j"], incertae_sedis=["Cidae"], rank=so),
+    }
+
+
+def _random_tree(rng, tips):
+    """Returns a random dendropy tree on `tips`, with some polytomies."""
+    nodes = [f"'{i}'" for i in tips]
+    while len(nodes) > 1:
+        rng.shuffle(nodes)
+        k = 3 if len(nodes) > 2 and rng.random() < 0.2 else 2
+        nodes[:k] = [f"({','.join(nodes[:k])})"]
+    return dendropy.Tree.get(data=nodes[0] + ";", schema="newick")
+
+
+def _reference_labels(tree, clades):
+    """Labels `tree` as the set-based search did.
+
+    Resolves the clades rank by rank, from the lowest rank up, with a
+    second strict pass for those that name a clade not yet seen. Then
+    walks up from the member tip with the lowest label, comparing sets
+    of leaf labels. Returns (found, not_found) as name -> dendropy node.
+    """
+    tip_nd = {nd.taxon.label: nd for nd in tree.leaf_node_iter()}
+    by_rank = sorted(clades.items(), key=lambda i: -i[1].rank.value)
+    must, might, seen = {}, {}, {}
+
+    def fill(labels, with_might, strict):
+        out, retry = set(), False
+        for label in labels:
+            if label in tip_nd:
+                out.add(label)
+            elif label in seen:
+                out.update(must[label])
+                if with_might:
+                    out.update(might[label])
+            elif len(label.split()) != 2:
+                if strict:
+                    raise RuntimeError(f"Higher taxon {label} not found")
+                retry = True
+        return out, retry
+
+    rank_groups = {}
+    for name, cdef in by_rank:
+        rank_groups.setdefault(cdef.rank, []).append((name, cdef))
+    for group in rank_groups.values():
+        retry_list = []
+        for name, cdef in group:
+            must[name], r1 = fill(cdef.must, False, False)
+            might[name], r2 = fill(cdef.might, True, False)
+            seen[name] = True
+            if r1 or r2:
+                retry_list.append((name, cdef))
+        for name, cdef in retry_list:
+            must[name] = fill(cdef.must, False, True)[0]
+            might[name] = fill(cdef.might, True, True)[0]
+    found, not_found = {}, {}
+    for name, cdef in by_rank:
+        if not must[name]:
+            not_found[name] = None
+            continue
+        nd = tip_nd[min(must[name])]
+        while True:
+            nls = {i.taxon.label for i in nd.leaf_iter()}
+            if not (nls - must[name]).issubset(might[name]):
+                not_found[name] = nd
+                break
+            if must[name].issubset(nls):
+                found[name] = nd
+                break
+            nd = nd.parent_node
+    return found, not_found
+
+
+class LabelInternalsTest(unittest.TestCase):
+    def setUp(self):
+        set_verbose(False)
+
+    def test_against_reference(self):
+        rng = random.Random(0)
+        num_found = num_broken = 0
+        for _ in range(200):
+            tips = [i for i in _TIPS if rng.random() < 0.9]
+            tree = _random_tree(rng, tips)
+            ref_found, ref_not_found = _reference_labels(tree, _clades())
+            clades = _clades()
+            label_internals(tree, clades)
+            self.assertEqual(
+                {n: c.node for n, c in clades.items() if hasattr(c, "node")},
+                ref_found,
+            )
+            self.assertEqual(
+                {
+                    n: c.conflicting
+                    for n, c in clades.items()
+                    if hasattr(c, "conflicting")
+                },
+                ref_not_found,
+            )
+            clade_names = {}
+            for name, nd in ref_found.items():
+                clade_names.setdefault(nd, []).append(name)
+            for nd in tree.preorder_node_iter():
+                self.assertEqual(
+                    sorted(getattr(nd, "clade_names", [])),
+                    sorted(clade_names.get(nd, [])),
+                )
+            num_found += len(ref_found)
+            num_broken += sum(1 for nd in ref_not_found.values() if nd is not None)
+        # The trees find and break clades often enough to compare both.
+        self.assertGreater(num_found, 200)
+        self.assertGreater(num_broken, 200)
+
+    def test_find_clades(self):
+        """find_clades on an ArrayTree gives the nodes that label_internals sets."""
+        rng = random.Random(1)
+        compiled = CompiledClades(_clades())
+        for _ in range(20):
+            tree = _random_tree(rng, _TIPS)
+            atree, nodes = ArrayTree.from_dendropy(tree)
+            found, not_found = find_clades(atree, compiled)
+            ref_found, ref_not_found = _reference_labels(tree, _clades())
+            self.assertEqual({n: nodes[i] for n, i in found.items()}, ref_found)
+            self.assertEqual(
+                {n: None if i is None else nodes[i] for n, i in not_found.items()},
+                ref_not_found,
+            )
+
+    def test_nested_clade(self):
+        tree = dendropy.Tree.get(
+            data="(((('Aus a','Aus b'),'Aus c'),('Bus d','Bus e')),'Dus h',('Cus f','Cus g'));",
+            schema="newick",
+        )
+        clades = _clades()
+        label_internals(tree, clades)
+        # Abidae may hold Dus h, but does not need it
+        nd = clades["Abinae"].node
+        self.assertIs(clades["Abidae"].node, nd)
+        self.assertEqual(sorted(nd.clade_names), ["Abidae", "Abinae"])
+        self.assertEqual(clades["Cidae"].node.clade_names, ["Cus", "Cidae"])
+        # Only the root holds both families, and Dus h is not in Primiformes
+        self.assertIs(clades["Primiformes"].conflicting, tree.seed_node)
+        self.assertIs(clades["Bcinae"].conflicting, nd)
+        self.assertIsNone(clades["Zidae"].conflicting)
+
+    def test_cycle(self):
+        clades = _clades()
+        clades["Abinae"] = CladeDef(["Aus", "Primiformes"], rank=Ranks.SUBFAMILY)
+        with self.assertRaisesRegex(RuntimeError, "defined in terms of itself"):
+            CompiledClades(clades)
+        clades = {"Aus": CladeDef(["Aus a", "Aus"], rank=Ranks.GENUS)}
+        with self.assertRaisesRegex(RuntimeError, "Aus is defined in terms of itself"):
+            CompiledClades(clades)
+
+    def test_undefined_reference(self):
+        clades = _clades()
+        clades["Abidae"] = CladeDef(["Abinae", "Dusidae"], rank=Ranks.FAMILY)
+        tree = _random_tree(random.Random(2), _TIPS)
+        with self.assertRaisesRegex(RuntimeError, "Higher taxon Dusidae not found"):
+            label_internals(tree, clades)
+
+
+class CompileCladesTest(unittest.TestCase):
+    def setUp(self):
+        set_verbose(False)
+        self._td = tempfile.TemporaryDirectory()
+        self.defs_fp = os.path.join(self._td.name, "clades.tsv")
+        self.cache_fp = self.defs_fp + ".compiled.json"
+
+    def tearDown(self):
+        self._td.cleanup()
+
+    def write_defs(self, clades):
+        with open(self.defs_fp, "w") as outp:
+            for name, cdef in clades.items():
+                outp.write(f"{name}\t{cdef!r}\n")
+
+    def read_sha256(self):
+        with open(self.cache_fp, "r") as inp:
+            return json.load(inp)["sha256"]
+
+    def assertSameCompiled(self, got, expected):
+        self.assertEqual(got.to_json_obj(), expected.to_json_obj())
+        self.assertEqual(got.all_tips, expected.all_tips)
+        self.assertEqual(got.taxon_index.bit_of, expected.taxon_index.bit_of)
+
+    def test_round_trip(self):
+        self.write_defs(_clades())
+        built = compile_clades(parse_clade_defs(self.defs_fp), self.defs_fp)
+        self.assertSameCompiled(built, CompiledClades(_clades()))
+        self.assertTrue(os.path.isfile(self.cache_fp))
+        self.assertFalse(os.path.exists(self.cache_fp + ".HIDE"))
+        # Read from the cache, so the clades themselves are not used.
+        cached = compile_clades(None, self.defs_fp)
+        self.assertSameCompiled(cached, built)
+        self.assertEqual(cached.unresolved, built.unresolved)
+        tree = _random_tree(random.Random(3), _TIPS)
+        atree = ArrayTree.from_dendropy(tree)[0]
+        self.assertEqual(find_clades(atree, cached), find_clades(atree, built))
+
+    def test_edited_defs(self):
+        self.write_defs(_clades())
+        first = compile_clades(parse_clade_defs(self.defs_fp), self.defs_fp)
+        first_sha256 = self.read_sha256()
+        clades = _clades()
+        clades["Abidae"] = CladeDef(["Abinae", "Dus h"], rank=Ranks.FAMILY)
+        self.write_defs(clades)
+        edited = compile_clades(parse_clade_defs(self.defs_fp), self.defs_fp)
+        self.assertSameCompiled(edited, CompiledClades(clades))
+        self.assertNotEqual(edited.to_json_obj(), first.to_json_obj())
+        self.assertNotEqual(self.read_sha256(), first_sha256)
+        # The rebuilt cache is the one read next time.
+        self.assertSameCompiled(compile_clades(None, self.defs_fp), edited)
+
+    def test_bad_cache(self):
+        self.write_defs(_clades())
+        with open(self.cache_fp, "w") as outp:
+            outp.write("{not json")
+        compiled = compile_clades(parse_clade_defs(self.defs_fp), self.defs_fp)
+        self.assertSameCompiled(compiled, CompiledClades(_clades()))
+        self.assertSameCompiled(compile_clades(None, self.defs_fp), compiled)
+
+
+if __name__ == "__main__":
+    unittest.main()
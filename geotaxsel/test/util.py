@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+"""Random subset collections and reference frontiers shared by the tests."""
+
+import random
+
+from geotaxsel import TaxonIndex
+from geotaxsel.label_graph import ConnectedComponent, LabelGraph
+
+# Solve every component in-process, so max-weight-partition is not needed.
+IN_PROCESS = 10**6
+
+
+def random_subsets(rng, labels, num_trees, num_groups, max_swaps):
+    """Returns {frozenset of labels: count} as from `num_trees` similar trees.
+
+    Each tree cuts `labels` into `num_groups` runs, after up to `max_swaps`
+    random swaps of two labels.
+    """
+    rep = {}
+    for _ in range(num_trees):
+        order = list(labels)
+        for _ in range(rng.randint(0, max_swaps)):
+            i, j = rng.randrange(len(order)), rng.randrange(len(order))
+            order[i], order[j] = order[j], order[i]
+        cuts = sorted(rng.sample(range(1, len(order)), num_groups - 1))
+        prev = 0
+        for cut in cuts + [len(order)]:
+            subset = frozenset(order[prev:cut])
+            rep[subset] = rep.get(subset, 0) + 1
+            prev = cut
+    return rep
+
+
+def random_rep_selections(seed):
+    """Returns (TaxonIndex mask -> count, taxon_index) for several disjoint
+    groups of labels. Some groups are relabelled copies of earlier ones.
+    """
+    rng = random.Random(seed)
+    groups = []
+    for gidx in range(rng.randint(2, 6)):
+        if groups and rng.random() < 0.3:
+            prev = rng.choice(groups)
+            rename = {}
+            for sub in prev:
+                for label in sub:
+                    rename[label] = f"G{gidx}{label[label.index('L'):]}"
+            groups.append({frozenset(rename[i] for i in k): v for k, v in prev.items()})
+            continue
+        labels = [f"G{gidx}L{i}" for i in range(rng.randint(2, 8))]
+        num_groups = rng.randint(1, min(4, len(labels)))
+        if num_groups == 1:
+            groups.append({frozenset(labels): rng.randint(1, 5)})
+        else:
+            groups.append(random_subsets(rng, labels, rng.randint(1, 6), num_groups, 2))
+    rep = {}
+    for group in groups:
+        rep.update(group)
+    taxon_index = TaxonIndex(set().union(*rep.keys()))
+    return {taxon_index.mask(k): v for k, v in rep.items()}, taxon_index
+
+
+def sequential_merge(score_dicts):
+    """Returns {total size: best score}, merging one component at a time."""
+    merged = {0: 0.0}
+    for scores in score_dicts:
+        nxt = {}
+        for size, score in merged.items():
+            for c_size, c_score in scores.items():
+                total = score + c_score
+                if total > nxt.get(size + c_size, float("-inf")):
+                    nxt[size + c_size] = total
+        merged = nxt
+    return merged
+
+
+def reference_frontier(rep_selections, taxon_index):
+    """Returns {size: best score}, from the frozenset search of each component
+    and a sequential merge.
+    """
+    lg = LabelGraph(taxon_index)
+    for mask, count in rep_selections.items():
+        lg.add_set(mask, count)
+    score_dicts = []
+    for comp in lg.components:
+        cc = comp.to_connected_component(taxon_index)
+        ref = ConnectedComponent(leaves=cc.leaves, subset_wts=cc.subset_wts)
+        ref.fill_resolutions(use_bitsets=False)
+        score_dicts.append({k: v.score for k, v in ref.resolutions.items()})
+    return sequential_merge(score_dicts)
+
+
+def read_frontier(frontier_fp):
+    with open(frontier_fp, "r") as inp:
+        assert next(inp) == "num-selected\tscore\n"
+        return {int(i.split("\t")[0]): float(i.split("\t")[1]) for i in inp}
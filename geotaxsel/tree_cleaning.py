@@ -1,7 +1,14 @@
 #! /usr/bin/env python3
+import hashlib
 import itertools
+import json
+import os
 
+import numpy as np
+
+from .array_tree import ArrayTree
 from .logs import info
+from .taxon_index import iter_bits, TaxonIndex
 from .taxonomy import Ranks
 
 
@@ -33,131 +40,88 @@ def alert_pruning(msg, to_prune):
         info(f'  "{el}"')
 
 
-def _fill_must_taxa(cdef, missing_from_tree, tip_label_2_nd, clade_name_to_def, strict):
-    reprocess = False
-    for label in cdef.must:
-        if label in missing_from_tree:
+def _named_clades(cdef, tip_bit, clade_name_to_def):
+    """Returns the CladeDefs named by the must and might labels of `cdef`."""
+    return [
+        clade_name_to_def[label]
+        for label in itertools.chain(cdef.must, cdef.might)
+        if label not in tip_bit and label in clade_name_to_def
+    ]
+
+
+def _resolution_order(cdefs, tip_bit, clade_name_to_def):
+    """Returns `cdefs` sorted so that each comes after the clades it names."""
+    order = []
+    state = {}  # name -> False while on the stack, True once in `order`
+    for root in cdefs:
+        if root.name in state:
             continue
-        nd = tip_label_2_nd.get(label)
-        if nd is None:
-            des_cdef = clade_name_to_def.get(label)
-            if des_cdef is None:
-                if len(label.split()) == 2:
-                    missing_from_tree.add(label)
-                elif strict:
-                    raise RuntimeError("Higher taxon {label} not found")
-                else:
-                    reprocess = True
+        state[root.name] = False
+        stack = [(root, iter(_named_clades(root, tip_bit, clade_name_to_def)))]
+        while stack:
+            cdef, des_iter = stack[-1]
+            for des_cdef in des_iter:
+                done = state.get(des_cdef.name)
+                if done is None:
+                    state[des_cdef.name] = False
+                    des_list = _named_clades(des_cdef, tip_bit, clade_name_to_def)
+                    stack.append((des_cdef, iter(des_list)))
+                    break
+                if not done:
+                    raise RuntimeError(
+                        f"Clade {des_cdef.name} is defined in terms of itself"
+                    )
             else:
-                cdef.must_taxa.update(des_cdef.must_taxa)
-        else:
-            cdef.must_taxa.add(nd.taxon)
-    return reprocess
+                stack.pop()
+                state[cdef.name] = True
+                order.append(cdef)
+    return order
 
 
-def _fill_might_taxa(
-    cdef, missing_from_tree, tip_label_2_nd, clade_name_to_def, strict
-):
-    reprocess = False
-    for label in cdef.might:
-        if label in missing_from_tree:
+def _labels_mask(labels, tip_bit, clade_name_to_def, missing, with_might):
+    mask = 0
+    for label in labels:
+        bit = tip_bit.get(label)
+        if bit is not None:
+            mask |= 1 << bit
             continue
-        nd = tip_label_2_nd.get(label)
-        if nd is None:
-            des_cdef = clade_name_to_def.get(label)
-            if des_cdef is None:
-                if len(label.split()) == 2:
-                    missing_from_tree.add(label)
-                elif strict:
-                    raise RuntimeError(f"Higher taxon {label} not found")
-                else:
-                    reprocess = True
-            else:
-                cdef.might_taxa.update(des_cdef.must_taxa)
-                cdef.might_taxa.update(des_cdef.might_taxa)
+        des_cdef = clade_name_to_def.get(label)
+        if des_cdef is not None:
+            mask |= des_cdef.must_mask
+            if with_might:
+                mask |= des_cdef.might_mask
+        elif len(label.split()) == 2:
+            missing.add(label)
         else:
-            cdef.might_taxa.add(nd.taxon)
-    return reprocess
+            raise RuntimeError(f"Higher taxon {label} not found")
+    return mask
 
 
-def link_cdef_to_taxa(cdefs_by_rank, tip_label_2_nd):
+def link_cdef_to_taxa(cdefs_by_rank, tip_bit):
+    """Sets the must_mask and might_mask of each CladeDef.
+
+    `tip_bit` maps a tip label to its bit. The clade definitions form a
+    DAG (a clade can name other clades), so they are resolved in one pass
+    in an order that puts each clade after the clades that it names, and
+    each clade's masks are built once and ORed into those of the clades
+    that name it. Returns the set of labels that are neither tips nor
+    clades.
+    """
+    cdefs = [cdef for cdef_list in cdefs_by_rank for cdef in cdef_list]
+    clade_name_to_def = {cdef.name: cdef for cdef in cdefs}
     missing_from_tree = set()
-    clade_name_to_def = {}
-    for cdef_list in cdefs_by_rank:
-        reprocess_list = []
-        for cdef in cdef_list:
-            cdef.must_taxa = set()
-            if _fill_must_taxa(
-                cdef, missing_from_tree, tip_label_2_nd, clade_name_to_def, strict=False
-            ):
-                reprocess_list.append(cdef)
-            cdef.might_taxa = set()
-            if _fill_might_taxa(
-                cdef, missing_from_tree, tip_label_2_nd, clade_name_to_def, strict=False
-            ):
-                reprocess_list.append(cdef)
-            clade_name_to_def[cdef.name] = cdef
-        for cdef in reprocess_list:
-            _fill_must_taxa(
-                cdef, missing_from_tree, tip_label_2_nd, clade_name_to_def, strict=True
-            )
-            _fill_might_taxa(
-                cdef, missing_from_tree, tip_label_2_nd, clade_name_to_def, strict=True
-            )
+    for cdef in _resolution_order(cdefs, tip_bit, clade_name_to_def):
+        cdef.must_mask = _labels_mask(
+            cdef.must, tip_bit, clade_name_to_def, missing_from_tree, False
+        )
+        cdef.might_mask = _labels_mask(
+            cdef.might, tip_bit, clade_name_to_def, missing_from_tree, True
+        )
     return missing_from_tree
 
 
-def _eval_one_clade(tree, cdef, clades, tip_label_2_nd):
-    if not cdef.must_taxa:
-        return False, None
-    one_taxon = next(iter(cdef.must_taxa))
-    one_leaf = tip_label_2_nd[one_taxon.label]
-    curr_nd = one_leaf
-    while True:
-        nls = set(curr_nd.bipartition.leafset_taxa(tree.taxon_namespace))
-        nld = nls.difference(cdef.must_taxa)
-        if not nld.issubset(cdef.might_taxa):
-            nldt = [i.label for i in nld]
-            if cdef.must_taxa.issubset(nls):
-                info(f"Clade {cdef.name} not found due to intrusion of {nldt}")
-            else:
-                lsd = nls.difference(cdef.must_taxa)
-                lsdt = [i.label for i in lsd]
-                lsi = nls.intersection(cdef.must_taxa)
-                lsit = [i.label for i in lsi]
-                info(
-                    f"Clade {cdef.name} not found due to intrusion of {nldt} as closer to {lsit} than the other members({lsdt}) are."
-                )
-            return False, curr_nd
-        if cdef.must_taxa.issubset(nls):
-            return True, curr_nd
-        curr_nd = curr_nd.parent_node
-        assert curr_nd is not None
-
-
-def _link_existing_clades(tree, cdefs_by_rank, clades, tip_label_2_nd):
-    found, not_found = {}, {}
-    for cdef_list in cdefs_by_rank:
-        for cdef in cdef_list:
-            is_in_tree, nd = _eval_one_clade(tree, cdef, clades, tip_label_2_nd)
-            if is_in_tree:
-                found[cdef.name] = nd
-                cdef.node = nd
-                if hasattr(nd, "clade_names"):
-                    nd.clade_names.append(cdef.name)
-                else:
-                    nd.clade_names = [cdef.name]
-            else:
-                not_found[cdef.name] = nd
-                cdef.conflicting = nd
-    return found, not_found
-
-
-def label_internals(tree, clades):
-    tip_label_2_nd = {}
-    for leaf in tree.leaf_node_iter():
-        assert leaf.taxon.label not in tip_label_2_nd
-        tip_label_2_nd[leaf.taxon.label] = leaf
+def _cdefs_by_rank(clades):
+    """Returns lists of CladeDefs, from the lowest rank to the highest."""
     max_rank_v = max([i.value for i in Ranks])
     cdefs_by_rank = [[] for i in range(1 + max_rank_v)]
     for name, cdef in clades.items():
@@ -165,20 +129,285 @@ def label_internals(tree, clades):
         assert cdef.rank  # May not always hold, but should for mammal taxonomy from MDD
         cdefs_by_rank[cdef.rank.value].append(cdef)
     cdefs_by_rank.reverse()
-    missing_from_tree = link_cdef_to_taxa(cdefs_by_rank, tip_label_2_nd)
+    return cdefs_by_rank
+
+
+class CompiledClades(object):
+    """Clade definitions compiled into masks over a TaxonIndex of their tips.
+
+    Built once and shared by every tree. `names`, `must` and `might` are in
+    the order that clades are looked for (from the lowest rank up);
+    `must[i]` and `might[i]` are the masks of the tips that clade `names[i]`
+    must and might hold, including those of the clades it names.
+    """
+
+    def __init__(self, clades):
+        self.taxon_index = TaxonIndex(tips_from_clades(clades))
+        cdefs_by_rank = _cdefs_by_rank(clades)
+        self.unresolved = link_cdef_to_taxa(cdefs_by_rank, self.taxon_index.bit_of)
+        cdefs = [cdef for cdef_list in cdefs_by_rank for cdef in cdef_list]
+        self.names = [cdef.name for cdef in cdefs]
+        self.must = [cdef.must_mask for cdef in cdefs]
+        self.might = [cdef.might_mask for cdef in cdefs]
+        self.all_tips = (1 << len(self.taxon_index)) - 1
+
+    def to_json_obj(self):
+        return {
+            "labels": self.taxon_index.labels,
+            "unresolved": sorted(self.unresolved),
+            "names": self.names,
+            "must": [format(i, "x") for i in self.must],
+            "might": [format(i, "x") for i in self.might],
+        }
+
+    @classmethod
+    def from_json_obj(cls, obj):
+        compiled = cls.__new__(cls)
+        compiled.taxon_index = TaxonIndex(obj["labels"])
+        compiled.unresolved = set(obj["unresolved"])
+        compiled.names = obj["names"]
+        compiled.must = [int(i, 16) for i in obj["must"]]
+        compiled.might = [int(i, 16) for i in obj["might"]]
+        compiled.all_tips = (1 << len(compiled.taxon_index)) - 1
+        return compiled
+
+
+# Bumped when the stored form of CompiledClades changes.
+_COMPILED_CLADES_VERSION = 1
+
+
+def compile_clades(clades, clade_defs_fp=None):
+    """Returns the CompiledClades for `clades`, read from `clade_defs_fp`.
+
+    If `clade_defs_fp` is given, the result is cached next to it in
+    `<clade_defs_fp>.compiled.json`, keyed by the sha256 of the file, and
+    reused by later runs on the same clade definitions.
+    """
+    if not clade_defs_fp:
+        return CompiledClades(clades)
+    with open(clade_defs_fp, "rb") as inp:
+        key = hashlib.sha256(inp.read()).hexdigest()
+    cache_fp = clade_defs_fp + ".compiled.json"
+    try:
+        with open(cache_fp, "r") as inp:
+            obj = json.load(inp)
+        if obj["version"] == _COMPILED_CLADES_VERSION and obj["sha256"] == key:
+            info(f"Read the compiled clade definitions from {cache_fp}")
+            return CompiledClades.from_json_obj(obj["compiled"])
+    except (OSError, ValueError, KeyError):
+        pass
+    compiled = CompiledClades(clades)
+    obj = {
+        "version": _COMPILED_CLADES_VERSION,
+        "sha256": key,
+        "compiled": compiled.to_json_obj(),
+    }
+    tmp_fp = cache_fp + ".HIDE"
+    try:
+        with open(tmp_fp, "w") as outp:
+            json.dump(obj, outp)
+        os.rename(tmp_fp, cache_fp)
+    except OSError as x:
+        info(f"Could not cache the compiled clade definitions in {cache_fp}: {x}")
+    return compiled
+
+
+def find_clades(atree, compiled):
+    """Looks for each clade of CompiledClades `compiled` in ArrayTree `atree`.
+
+    Returns (found, not_found). found maps a clade name to the node that is
+    the MRCA of its tips. not_found maps a clade name to the first node, on
+    the way up from one of its tips, with a tip below it that the clade
+    cannot hold (or to None if none of its tips are in the tree). Raises a
+    RuntimeError if a clade names a higher taxon that is not defined.
+    """
+    assert len(set(atree.leaf_labels)) == atree.num_leaves
+    bit_of = compiled.taxon_index.bit_of
+    # Tips in no clade get bits past the index; they can only intrude.
+    labels = list(compiled.taxon_index.labels)
+    node_mask = [0] * atree.num_nodes
+    leaf_of_bit = {}
+    tree_mask = 0
+    for nd, label in zip(atree.leaf_nodes.tolist(), atree.leaf_labels):
+        bit = bit_of.get(label)
+        if bit is None:
+            bit = len(labels)
+            labels.append(label)
+        else:
+            tree_mask |= 1 << bit
+        leaf_of_bit[bit] = nd
+        node_mask[nd] = 1 << bit
+    parent = atree.parent.tolist()
+    for nd in range(atree.num_nodes - 1, 0, -1):
+        node_mask[parent[nd]] |= node_mask[nd]
+    missing_from_tree = set(compiled.unresolved)
+    for label in compiled.taxon_index.labels_of(compiled.all_tips & ~tree_mask):
+        # Neither a tip of the tree nor a clade, nor a species name
+        if len(label.split()) != 2:
+            raise RuntimeError(f"Higher taxon {label} not found")
+        missing_from_tree.add(label)
     if missing_from_tree:
         info(
             f"{len(missing_from_tree)} taxa in clade definitions, but not in the tree:"
         )
         for el in missing_from_tree:
             info(f'  "{el}"')
-    found, not_found = _link_existing_clades(
-        tree, cdefs_by_rank, clades, tip_label_2_nd
-    )
+    found, not_found = {}, {}
+    for name, must, might in zip(compiled.names, compiled.must, compiled.might):
+        must &= tree_mask
+        if not must:
+            not_found[name] = None
+            continue
+        allowed = must | might
+        nd = leaf_of_bit[(must & -must).bit_length() - 1]
+        while True:
+            nls = node_mask[nd]
+            if nls & ~allowed:
+                nldt = [labels[i] for i in iter_bits(nls & ~must)]
+                if not must & ~nls:
+                    info(f"Clade {name} not found due to intrusion of {nldt}")
+                else:
+                    lsit = [labels[i] for i in iter_bits(nls & must)]
+                    info(
+                        f"Clade {name} not found due to intrusion of {nldt} as closer to {lsit} than the other members({nldt}) are."
+                    )
+                not_found[name] = nd
+                break
+            if not must & ~nls:
+                found[name] = nd
+                break
+            nd = parent[nd]
     info(f"{(len(not_found))} clades broken.")
     info(f"{(len(found))} clades found:")
     for c in found:
         info(f"  {c} found")
+    return found, not_found
+
+
+def label_internals(tree, clades, compiled=None):
+    """Adds the names of the clades found in dendropy `tree` to its nodes.
+
+    Each node that is the MRCA of a clade gets a `clade_names` list, and
+    each CladeDef gets a `node` or a `conflicting` node as in find_clades.
+    `compiled` is the CompiledClades for `clades`, if already built.
+    """
+    if compiled is None:
+        compiled = CompiledClades(clades)
+    atree, nodes = ArrayTree.from_dendropy(tree)
+    found, not_found = find_clades(atree, compiled)
+    for name, nd_idx in found.items():
+        nd = nodes[nd_idx]
+        clades[name].node = nd
+        if hasattr(nd, "clade_names"):
+            nd.clade_names.append(name)
+        else:
+            nd.clade_names = [name]
+    for name, nd_idx in not_found.items():
+        clades[name].conflicting = None if nd_idx is None else nodes[nd_idx]
+
+
+class PrunePlan(object):
+    """Which tree labels to prune, and what each kept label becomes.
+
+    Built from the set of leaf labels of a tree, so it can be reused for
+    every tree with the same labels (as in a posterior sample of trees).
+    `new_label` maps each kept label to its final name.
+    """
+
+    def __init__(
+        self,
+        labels,
+        sp_w_data,
+        upham_to_iucn=None,
+        name_mapping_fp="",
+        centroid_fp="",
+        clades=None,
+        new_names_for_leaves=None,
+        sp_pat_in_tree=None,
+    ):
+        clade_tips = tips_from_clades(clades) if clades else set()
+        if new_names_for_leaves is None:
+            new_names_for_leaves = {}
+        self.new_label = {}
+        self.to_prune = set()
+        bad_names = []
+        no_geo = []
+        null_name_mapped = []
+        not_in_clades = []
+        remapped = []
+        for label in labels:
+            m = sp_pat_in_tree.match(label)
+            if not m:
+                self.to_prune.add(label)
+                bad_names.append(label)
+                continue
+            sp_name = m.group(1)
+            if upham_to_iucn is not None:
+                next_name = upham_to_iucn.get(sp_name)
+            else:
+                next_name = sp_name
+            if next_name is None:
+                self.to_prune.add(label)
+                null_name_mapped.append(sp_name)
+                continue
+            final_name = new_names_for_leaves.get(next_name, next_name)
+            if final_name != next_name:
+                remapped.append((next_name, final_name))
+            if final_name not in sp_w_data:
+                self.to_prune.add(label)
+                no_geo.append(final_name)
+            elif clades and final_name not in clade_tips:
+                self.to_prune.add(label)
+                not_in_clades.append(final_name)
+            else:
+                self.new_label[label] = final_name
+        info(f"{len(remapped)} tip names updated to new taxonomy:")
+        for from_n, to_n in remapped:
+            info(f"  {from_n} --> {to_n}")
+        alert_pruning(f"not matching expected form of a species name", bad_names)
+        alert_pruning(f"not found in {name_mapping_fp}", null_name_mapped)
+        alert_pruning(f"not found in {centroid_fp}", no_geo)
+        alert_pruning(f"not found in any clade in clade definitions", not_in_clades)
+        final_name_set = set(self.new_label.values())
+        centroids_but_no_tips = set()
+        for sp_name in sp_w_data:
+            if sp_name not in final_name_set:
+                centroids_but_no_tips.add(sp_name)
+        self.centroids_but_no_tips = centroids_but_no_tips
+
+    def log_missing_tips(self):
+        info(
+            f"{len(self.centroids_but_no_tips)} species in centroid file but not in the tree."
+        )
+        for sp_name in self.centroids_but_no_tips:
+            info(f"  {sp_name}")
+
+    def apply(self, atree):
+        """Returns the pruned and relabelled copy of ArrayTree `atree`."""
+        new_label = self.new_label
+        keep_leaf = np.fromiter(
+            (label in new_label for label in atree.leaf_labels),
+            dtype=bool,
+            count=atree.num_leaves,
+        )
+        labels = [new_label[label] for label in atree.leaf_labels if label in new_label]
+        return atree.prune(keep_leaf, labels)
+
+
+def prune_plan_for(atree, plans, **kwargs):
+    """Returns the PrunePlan for the leaf labels of `atree`.
+
+    `plans` is a dict of frozenset of labels -> PrunePlan, used as a cache.
+    The other arguments are those of PrunePlan.
+    """
+    key = frozenset(atree.leaf_labels)
+    plan = plans.get(key)
+    if plan is None:
+        info(f"Building the prune plan for a tree with {len(key)} leaf labels")
+        plan = PrunePlan(atree.leaf_labels, **kwargs)
+        plan.log_missing_tips()
+        plans[key] = plan
+    return plan
 
 
 def prune_taxa_without_sp_data(
@@ -194,59 +423,25 @@ def prune_taxa_without_sp_data(
     info(
         f"prune_taxa_without_sp_data(tree, sp_w_data, upham_to_iucn={upham_to_iucn}...)"
     )
-    clade_tips = tips_from_clades(clades) if clades else set()
-    if new_names_for_leaves is None:
-        new_names_for_leaves = {}
     taxa_list = [i for i in tree.taxon_namespace]
+    plan = PrunePlan(
+        [i.label for i in taxa_list],
+        sp_w_data,
+        upham_to_iucn=upham_to_iucn,
+        name_mapping_fp=name_mapping_fp,
+        centroid_fp=centroid_fp,
+        clades=clades,
+        new_names_for_leaves=new_names_for_leaves,
+        sp_pat_in_tree=sp_pat_in_tree,
+    )
     to_prune = []
-    bad_names = []
-    no_geo = []
-    null_name_mapped = []
-    not_in_clades = []
-    remapped = []
-    final_name_set = set()
-    for n, i in enumerate(taxa_list):
-        m = sp_pat_in_tree.match(i.label)
-        if not m:
-            to_prune.append(i)
-            bad_names.append(i.label)
-            continue
-        sp_name = m.group(1)
-        if upham_to_iucn is not None:
-            next_name = upham_to_iucn.get(sp_name)
-        else:
-            next_name = sp_name
-        if next_name is None:
-            to_prune.append(i)
-            null_name_mapped.append(sp_name)
-            continue
-        final_name = new_names_for_leaves.get(next_name, next_name)
-        if final_name != next_name:
-            remapped.append((next_name, final_name))
-        if final_name not in sp_w_data:
-            to_prune.append(i)
-            no_geo.append(final_name)
-        elif clades and final_name not in clade_tips:
+    for i in taxa_list:
+        if i.label in plan.to_prune:
             to_prune.append(i)
-            not_in_clades.append(final_name)
         else:
-            final_name_set.add(final_name)
-            i.label = final_name
-    info(f"{len(remapped)} tip names updated to new taxonomy:")
-    for from_n, to_n in remapped:
-        info(f"  {from_n} --> {to_n}")
-    alert_pruning(f"not matching expected form of a species name", bad_names)
-    alert_pruning(f"not found in {name_mapping_fp}", null_name_mapped)
-    alert_pruning(f"not found in {centroid_fp}", no_geo)
-    alert_pruning(f"not found in any clade in clade definitions", not_in_clades)
+            i.label = plan.new_label[i.label]
     tree.prune_taxa(to_prune)
     if clades:
         tree.encode_bipartitions()
         label_internals(tree, clades)
-    centroids_but_no_tips = set()
-    for sp_name in sp_w_data:
-        if sp_name not in final_name_set:
-            centroids_but_no_tips.add(sp_name)
-    info(f"{len(centroids_but_no_tips)} species in centroid file but not in the tree.")
-    for sp_name in centroids_but_no_tips:
-        info(f"  {sp_name}")
+    plan.log_missing_tips()
@@ -65,7 +65,7 @@ setup(
     license="BSD",
     author="Mark T. Holder",
     py_modules=["geotaxsel"],
-    install_requires=["setuptools", "DendroPy>=4.4.0", "geopy>=2.4.0"],
+    install_requires=["setuptools", "DendroPy>=4.4.0", "geopy>=2.4.0", "numpy"],
     # download_url='https://github.com/mtholder/taxon-selection/archive/v_0.0.1.tar.gz',
     packages=PACKAGES,
     entry_points=ENTRY_POINTS,
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import argparse
+import multiprocessing
 import sys
 import os
 import re
@@ -9,14 +10,26 @@ from geotaxsel import (
     output_chosen_anc,
     parse_geo_and_tree,
     parse_geo,
-    prune_taxa_without_sp_data,
+    compile_clades,
+    find_clades,
+    prune_plan_for,
+    read_newick,
     ultrametric_greedy_mmd,
+    ultrametric_split_order,
+    write_split_order,
     serialize_problems_for_most_common_choice,
     choose_most_common,
     PROB_FN,
-    calc_dist,
+    DEFAULT_IN_PROCESS_MAX_SUBSETS,
+    DEFAULT_MAX_NUM_GREEDY,
+    coords_array,
+    dists_from,
+    pairwise_dists,
+    SolverCache,
+    TaxonIndex,
+    info,
 )
-import dendropy
+import numpy as np
 
 
 class RunSettings(object):
@@ -35,6 +48,16 @@ class RunSettings(object):
         ultrametric_tol=5e-5,
         scratch_dir=None,
         max_solver_seconds=6000,
+        split_order_fp=None,
+        jobs=1,
+        solver_jobs=1,
+        solver_portfolio=1,
+        solver_cache_dir=None,
+        solver_cache_max_mb=None,
+        frontier_fp=None,
+        in_process_max_subsets=DEFAULT_IN_PROCESS_MAX_SUBSETS,
+        solver_max_num_greedy=DEFAULT_MAX_NUM_GREEDY,
+        in_process_memo_max_mb=None,
     ):
         self.country_name_fp = country_name_fp
         self.centroid_fp = centroid_fp
@@ -49,16 +72,98 @@ class RunSettings(object):
         self.ultrametric_tol = ultrametric_tol
         self.scratch_dir = scratch_dir
         self.max_solver_seconds = max_solver_seconds
+        self.split_order_fp = split_order_fp
+        self.jobs = jobs
+        self.solver_jobs = solver_jobs
+        self.solver_portfolio = solver_portfolio
+        self.solver_cache_dir = solver_cache_dir
+        self.solver_cache_max_mb = solver_cache_max_mb
+        self.frontier_fp = frontier_fp
+        self.in_process_max_subsets = in_process_max_subsets
+        self.solver_max_num_greedy = solver_max_num_greedy
+        self.in_process_memo_max_mb = in_process_memo_max_mb
 
 
-def record_clade_sel(sel, rep_selections):
+def record_clade_sel(sel, rep_selections, taxon_index, atree=None):
+    """Counts the clades in `sel`: dendropy nodes, or nodes of `atree`."""
     for anc in sel:
-        leaves_below = list(anc.leaf_nodes())
-        labels_below = frozenset([i.taxon.label for i in leaves_below])
+        if atree is None:
+            labels = [i.taxon.label for i in anc.leaf_nodes()]
+        else:
+            labels = atree.leaf_labels_below(anc)
+        labels_below = taxon_index.mask(labels)
         pn = rep_selections.get(labels_below, 0)
         rep_selections[labels_below] = 1 + pn
 
 
+def _select_on_tree_file(
+    tree_fp,
+    rep_selections,
+    geo_ret,
+    centroid_fp,
+    name_mapping_fp,
+    num_to_select,
+    use_ultrametricity,
+    ultrametric_tol,
+    sp_pat,
+    taxon_index,
+    prune_plans,
+    compiled_clades,
+):
+    sp_by_name, clades, upham_to_iucn, new_names_for_leaves = geo_ret
+    atree = read_newick(tree_fp)
+    info(f"Reading {tree_fp}")
+    # Trees of a posterior share their labels, so the plan is built once.
+    plan = prune_plan_for(
+        atree,
+        prune_plans,
+        sp_w_data=sp_by_name,
+        upham_to_iucn=upham_to_iucn,
+        name_mapping_fp=name_mapping_fp,
+        centroid_fp=centroid_fp,
+        clades=clades,
+        new_names_for_leaves=new_names_for_leaves,
+        sp_pat_in_tree=sp_pat,
+    )
+    atree = plan.apply(atree)
+    if compiled_clades is not None:
+        # As encode_bipartitions did when the clades were found on dendropy
+        #   trees, a tree that is not marked [&R] loses its basal bifurcation.
+        if not atree.is_rooted:
+            atree = atree.collapse_basal_bifurcation()
+        find_clades(atree, compiled_clades)
+    if use_ultrametricity:
+        sel = ultrametric_greedy_mmd(
+            atree, num_to_select, sp_by_name, ultrametric_tol=ultrametric_tol
+        )
+        record_clade_sel(sel, rep_selections, taxon_index, atree)
+    else:
+        sel = greedy_mmd(atree.to_dendropy(), num_to_select, sp_by_name)
+        record_clade_sel(sel, rep_selections, taxon_index)
+
+
+# Set once per worker process by _init_tree_phase_worker, so that the parsed
+#   geo. and clade data are not re-sent with every tree.
+_tree_phase_kwargs = None
+
+
+def _init_tree_phase_worker(kwargs):
+    global _tree_phase_kwargs
+    _tree_phase_kwargs = kwargs
+
+
+def _tree_phase_worker(tree_fps):
+    rep_selections = {}
+    for tree_fp in tree_fps:
+        _select_on_tree_file(tree_fp, rep_selections, **_tree_phase_kwargs)
+    return rep_selections
+
+
+def _merge_rep_selections(rep_selections, partial):
+    for labels_below, count in partial.items():
+        rep_selections[labels_below] = count + rep_selections.get(labels_below, 0)
+
+
 def create_most_common_groups_probs(
     geo_ret,
     centroid_fp=None,
@@ -67,45 +172,52 @@ def create_most_common_groups_probs(
     use_ultrametricity=True,
     tree_dir=None,
     ultrametric_tol=5e-5,
+    jobs=1,
+    taxon_index=None,
+    clade_defs_fp=None,
 ):
-    sp_by_name, clades, upham_to_iucn, new_names_for_leaves = geo_ret
+    """Returns a dict of TaxonIndex mask -> the number of trees selecting that clade.
+
+    `clade_defs_fp` is the file that the clades of `geo_ret` were read from,
+    if any; their compiled form is cached next to it.
+    """
+    if taxon_index is None:
+        taxon_index = TaxonIndex(geo_ret[0].keys())
     file_names = os.listdir(tree_dir)
     file_names.sort()
+    tree_fps = [os.path.join(tree_dir, el) for el in file_names]
     sp_pat = re.compile(r"^([A-Z][a-z]+ +[-a-z0-9]+)$")
+    clades = geo_ret[1]
+    kwargs = dict(
+        geo_ret=geo_ret,
+        centroid_fp=centroid_fp,
+        name_mapping_fp=name_mapping_fp,
+        num_to_select=num_to_select,
+        use_ultrametricity=use_ultrametricity,
+        ultrametric_tol=ultrametric_tol,
+        sp_pat=sp_pat,
+        taxon_index=taxon_index,
+        prune_plans={},
+        compiled_clades=compile_clades(clades, clade_defs_fp) if clades else None,
+    )
     rep_selections = {}
-    for tree_n, el in enumerate(file_names):
-        tree_fp = os.path.join(tree_dir, el)
-        tree = dendropy.Tree.get(path=tree_fp, schema="newick")
-        print(tree_fp)
-        prune_taxa_without_sp_data(
-            tree,
-            frozenset(sp_by_name.keys()),
-            upham_to_iucn=upham_to_iucn,
-            name_mapping_fp=name_mapping_fp,
-            centroid_fp=centroid_fp,
-            clades=clades,
-            new_names_for_leaves=new_names_for_leaves,
-            sp_pat_in_tree=sp_pat,
-        )
-        if use_ultrametricity:
-            sel = ultrametric_greedy_mmd(
-                tree, num_to_select, sp_by_name, ultrametric_tol=ultrametric_tol
-            )
-        else:
-            sel = greedy_mmd(tree, num_to_select, sp_by_name)
-        record_clade_sel(sel, rep_selections)
+    if jobs <= 1 or len(tree_fps) < 2:
+        for tree_fp in tree_fps:
+            _select_on_tree_file(tree_fp, rep_selections, **kwargs)
+        return rep_selections
+    # Each worker returns the counts for a contiguous chunk of the trees,
+    #   and the counts are summed, so the result matches the serial loop.
+    num_chunks = min(len(tree_fps), 4 * jobs)
+    chunk_size = (len(tree_fps) + num_chunks - 1) // num_chunks
+    chunks = [tree_fps[i : i + chunk_size] for i in range(0, len(tree_fps), chunk_size)]
+    with multiprocessing.Pool(
+        processes=jobs, initializer=_init_tree_phase_worker, initargs=(kwargs,)
+    ) as pool:
+        for partial in pool.imap(_tree_phase_worker, chunks):
+            _merge_rep_selections(rep_selections, partial)
     return rep_selections
 
 
-def min_dist_to_member(loc, loc_set):
-    min_d = float("inf")
-    for i in loc_set:
-        d = calc_dist(i, loc)
-        if d < min_d:
-            min_d = d
-    return min_d
-
-
 def choose_exemplars_by_geo_divergence(settings, geo_ret, final_subsets):
     chosen_labels = set()
     labels_to_check = set()
@@ -145,20 +257,18 @@ def choose_exemplars_by_geo_divergence(settings, geo_ret, final_subsets):
             sys.stderr.write(
                 f"taxon {label} in sp_by_name, but omitted from sp_2_loc due to absence in tree.\n"
             )
-    label_2_min_dist = {}
-    max_min_d = float("-inf")
-    next_chosen_label, next_chosen_loc = None, None
-    for md_idx, pair in enumerate(sp_2_loc.items()):
-        sp, loc = pair
-        d = min_dist_to_member(loc, locs_chosen)
-        label_2_min_dist[sp] = d
-        if (md_idx + 1) % 100 == 0:
-            sys.stderr.write(f" ... {sp} ==> min_dist {d}\n")
-        if d > max_min_d:
-            max_min_d = d
-            next_chosen_label = sp
-            next_chosen_loc = loc
-    assert next_chosen_label is not None
+    cand_labels = list(sp_2_loc.keys())
+    cand_locs = [sp_2_loc[i] for i in cand_labels]
+    cand_coords = coords_array(cand_locs)
+    if locs_chosen:
+        min_d_arr = pairwise_dists(cand_coords, list(locs_chosen)).min(axis=1)
+    else:
+        min_d_arr = np.full(len(cand_labels), float("inf"))
+    label_2_idx = {label: idx for idx, label in enumerate(cand_labels)}
+    still_avail = np.ones(len(cand_labels), dtype=bool)
+    best = int(np.argmax(min_d_arr))
+    max_min_d = float(min_d_arr[best])
+    next_chosen_label, next_chosen_loc = cand_labels[best], cand_locs[best]
     while True:
         m = f"Adding {next_chosen_label} with a min_dist of {max_min_d} from a previously chosen taxon\n"
         sys.stderr.write(m)
@@ -169,23 +279,16 @@ def choose_exemplars_by_geo_divergence(settings, geo_ret, final_subsets):
         last_added_loc = next_chosen_loc
         group = label_to_group[next_chosen_label]
         for el in group:
-            del label_2_min_dist[el]
+            still_avail[label_2_idx[el]] = False
         # update next_chosen...
-        next_chosen_label, next_chosen_loc = None, None
-        to_do = list(label_2_min_dist.keys())
-        max_min_d = float("-inf")
-        for sp in to_do:
-            md = label_2_min_dist[sp]
-            dist_to_most_recent = calc_dist(last_added_loc, sp_2_loc[sp])
-            if dist_to_most_recent < md:
-                label_2_min_dist[sp] = dist_to_most_recent
-                md = dist_to_most_recent
-            if md > max_min_d:
-                max_min_d = md
-                next_chosen_label = sp
-                next_chosen_loc = loc
+        avail_idx = np.nonzero(still_avail)[0]
+        dist_to_most_recent = dists_from(last_added_loc, cand_coords[avail_idx])
+        min_d_arr[avail_idx] = np.minimum(min_d_arr[avail_idx], dist_to_most_recent)
+        best = int(avail_idx[np.argmax(min_d_arr[avail_idx])])
+        max_min_d = float(min_d_arr[best])
+        next_chosen_label, next_chosen_loc = cand_labels[best], cand_locs[best]
     group = label_to_group[next_chosen_label]
-    assert len(group) == len(label_2_min_dist)
+    assert len(group) == int(still_avail.sum())
 
     for group in final_subsets:
         sg = set(group)
@@ -198,6 +301,10 @@ def choose_exemplars_by_geo_divergence(settings, geo_ret, final_subsets):
 
 
 def run_tree_dir(settings):
+    if settings.split_order_fp:
+        # Each tree of the directory has its own sweep, and the selection is
+        #   made from the consensus, not from any one of them.
+        raise RuntimeError("split_order_fp cannot be used with tree_dir.")
     geo_ret = parse_geo(
         country_name_fp=settings.country_name_fp,
         centroid_fp=settings.centroid_fp,
@@ -212,6 +319,8 @@ def run_tree_dir(settings):
         need_most_common_prob = not os.path.isfile(one_comp_py_fp)
     else:
         need_most_common_prob = True
+    # Clades are stored as bitmasks over the species with geo. data.
+    taxon_index = TaxonIndex(geo_ret[0].keys())
     if need_most_common_prob:
         rep_selections = create_most_common_groups_probs(
             geo_ret,
@@ -221,14 +330,35 @@ def run_tree_dir(settings):
             use_ultrametricity=settings.use_ultrametricity,
             tree_dir=settings.tree_dir,
             ultrametric_tol=settings.ultrametric_tol,
+            jobs=settings.jobs,
+            taxon_index=taxon_index,
+            clade_defs_fp=settings.clade_defs_fp,
         )
-        td = serialize_problems_for_most_common_choice(rep_selections)
+        td = serialize_problems_for_most_common_choice(rep_selections, taxon_index)
     else:
         td = settings.scratch_dir
+    solver_cache = None
+    if settings.solver_cache_dir is not None:
+        max_mb = settings.solver_cache_max_mb
+        solver_cache = SolverCache(
+            settings.solver_cache_dir,
+            max_bytes=None if max_mb is None else int(max_mb * 1024 * 1024),
+        )
+    memo_max_bytes = None
+    if settings.in_process_memo_max_mb is not None:
+        memo_max_bytes = int(settings.in_process_memo_max_mb * 1024 * 1024)
     final_sc, final_subsets = choose_most_common(
         num_to_select=settings.num_to_select,
         scratch_dir=td,
         max_secs_per_run=settings.max_solver_seconds,
+        solver_procs=settings.solver_jobs,
+        solver_portfolio=settings.solver_portfolio,
+        solver_cache=solver_cache,
+        taxon_index=taxon_index,
+        frontier_fp=settings.frontier_fp,
+        in_process_max_subsets=settings.in_process_max_subsets,
+        solver_max_num_greedy=settings.solver_max_num_greedy,
+        in_process_memo_max_bytes=memo_max_bytes,
     )
     output_chosen_anc(
         tree=None,
@@ -247,7 +377,7 @@ def run(settings):
     if settings.tree_dir is not None:
         return run_tree_dir(settings)
     sp_pat = re.compile("^([A-Z][a-z]+ +[-a-z0-9]+) [A-Z][A-Za-z]+ [A-Z]+$")
-    assert tree_fp is not None
+    assert settings.tree_fp is not None
     tree, sp_by_name = parse_geo_and_tree(
         settings.country_name_fp,
         settings.centroid_fp,
@@ -255,15 +385,17 @@ def run(settings):
         settings.tree_fp,
         clade_defs_fp=settings.clade_defs_fp,
         name_updating_fp=settings.name_updating_fp,
-        sp_pat_in_tree=settings.sp_pat,
+        sp_pat_in_tree=sp_pat,
     )
     if settings.use_ultrametricity:
-        sel = ultrametric_greedy_mmd(
+        split_order = ultrametric_split_order(
             tree,
             settings.num_to_select,
-            sp_by_name,
             ultrametric_tol=settings.ultrametric_tol,
         )
+        if settings.split_order_fp:
+            write_split_order(split_order, settings.split_order_fp)
+        sel = split_order.cut(settings.num_to_select)
     else:
         sel = greedy_mmd(tree, settings.num_to_select, sp_by_name)
     output_chosen_anc(tree, settings.cut_branches_fp, sel)
@@ -312,7 +444,8 @@ def main():
         required=False,
         help="Filepath to tab-separated file no header that is the output of "
         "taxonomy-to-clades.py. Each line should contain a name in the first "
-        "column and clade definition in the second row.",
+        "column and clade definition in the second row. In --tree-dir mode, "
+        "the resolved clades are cached next to it in a .compiled.json file.",
     )
     parser.add_argument(
         "--cut-branches-file",
@@ -356,6 +489,89 @@ def main():
         type=float,
         help="Number of seconds that the solver is allowed to work on a single problem of maximizing the groupings over different trees (tree-dir mode only)",
     )
+    parser.add_argument(
+        "--jobs",
+        default=1,
+        type=int,
+        help="Number of processes used to parse and select on the trees in --tree-dir",
+    )
+    parser.add_argument(
+        "--solver-jobs",
+        default=1,
+        type=int,
+        help="Number of max-weight-partition processes to run at the same time "
+        "(tree-dir mode only). The largest components are started first.",
+    )
+    parser.add_argument(
+        "--solver-portfolio",
+        default=1,
+        type=int,
+        help="Number of num_greedy levels of max-weight-partition to run at the "
+        "same time on each component (tree-dir mode only). The first to finish "
+        "is kept. Up to --solver-jobs times this many solver processes may be "
+        "running.",
+    )
+    parser.add_argument(
+        "--solver-max-num-greedy",
+        default=DEFAULT_MAX_NUM_GREEDY,
+        type=int,
+        help="Highest num_greedy level to retry max-weight-partition at after it "
+        "times out on a component (tree-dir mode only). The level reached is "
+        "recorded in the scratch dir and in --solver-cache-dir, and later solves "
+        f"of the same component start there (default: {DEFAULT_MAX_NUM_GREEDY}).",
+    )
+    parser.add_argument(
+        "--in-process-max-subsets",
+        default=DEFAULT_IN_PROCESS_MAX_SUBSETS,
+        type=int,
+        help="Components are solved without max-weight-partition if each of their "
+        "blocks of crossing subsets (subsets that overlap without either holding "
+        "the other), together with the subsets nested in the block, has at most "
+        "this many subsets (tree-dir mode only). 0 sends "
+        f"every component to the solver (default: {DEFAULT_IN_PROCESS_MAX_SUBSETS}).",
+    )
+    parser.add_argument(
+        "--in-process-memo-max-mb",
+        default=None,
+        type=float,
+        help="Memory budget for the memo of each in-process search (tree-dir mode "
+        "only). When it is exceeded, entries that were cheap to compute are "
+        "dropped first, and are recomputed if they are needed again (default: "
+        "no limit).",
+    )
+    parser.add_argument(
+        "--solver-cache-dir",
+        default=None,
+        required=False,
+        help="Optional directory of max-weight-partition results shared between "
+        "runs (tree-dir mode only). Components identical to ones solved in an "
+        "earlier run are not solved again.",
+    )
+    parser.add_argument(
+        "--solver-cache-max-mb",
+        default=None,
+        type=float,
+        help="Size limit for --solver-cache-dir. The least recently used results "
+        "are removed when it is exceeded (default: no limit).",
+    )
+    parser.add_argument(
+        "--frontier-file",
+        default=None,
+        required=False,
+        help="Optional filepath for the best consensus score for every number of "
+        "taxa that could be selected (tree-dir mode only). The merged solutions "
+        "are also saved in the scratch dir, so that rerunning with --scratch-dir "
+        "and a different --num-to-select does not solve or merge them again.",
+    )
+    parser.add_argument(
+        "--split-order-file",
+        default=None,
+        required=False,
+        help="Optional filepath for the order in which branches are split by the "
+        "descending-age sweep (--tree-file mode only). The cut for any number of "
+        "taxa up to --num-to-select is the set of lineages left after the rows "
+        "with num-lineages <= that number.",
+    )
     parser.add_argument(
         "--scratch-dir",
         default=None,
@@ -373,6 +589,36 @@ def main():
         sys.exit("Either --tree-file or --tree-dir must be supplied.\n")
     if (args.tree_file is not None) and (args.tree_dir is not None):
         sys.exit("Only 1 of --tree-file or --tree-dir can be supplied.\n")
+    if args.split_order_file is not None:
+        if args.tree_file is None:
+            sys.exit(
+                "--split-order-file can only be used with --tree-file: in --tree-dir "
+                "mode the selection comes from the consensus of the trees, not from "
+                "one descending-age sweep.\n"
+            )
+        if args.use_patristic_distance_matrices:
+            sys.exit(
+                "--split-order-file cannot be used with --use-patristic-distance-matrices.\n"
+            )
+    if args.frontier_file is not None and args.tree_dir is None:
+        sys.exit("--frontier-file can only be used with --tree-dir.\n")
+    if args.jobs < 1:
+        sys.exit("--jobs must be at least 1")
+    if args.solver_jobs < 1:
+        sys.exit("--solver-jobs must be at least 1")
+    if args.solver_portfolio < 1:
+        sys.exit("--solver-portfolio must be at least 1")
+    if args.solver_max_num_greedy < 0:
+        sys.exit("--solver-max-num-greedy cannot be negative")
+    if args.in_process_max_subsets < 0:
+        sys.exit("--in-process-max-subsets cannot be negative")
+    if args.in_process_memo_max_mb is not None and args.in_process_memo_max_mb < 0.0:
+        sys.exit("--in-process-memo-max-mb cannot be negative")
+    if args.solver_cache_max_mb is not None:
+        if args.solver_cache_dir is None:
+            sys.exit("--solver-cache-max-mb requires --solver-cache-dir")
+        if args.solver_cache_max_mb < 0.0:
+            sys.exit("--solver-cache-max-mb cannot be negative")
     if args.ultrametricity_tol < 0.0:
         sys.exit("--ultrametricity-tol cannot be negative")
     rs = RunSettings(
@@ -389,6 +635,16 @@ def main():
         ultrametric_tol=args.ultrametricity_tol,
         scratch_dir=args.scratch_dir,
         max_solver_seconds=args.max_solver_seconds,
+        split_order_fp=args.split_order_file,
+        jobs=args.jobs,
+        solver_jobs=args.solver_jobs,
+        solver_portfolio=args.solver_portfolio,
+        solver_cache_dir=args.solver_cache_dir,
+        solver_cache_max_mb=args.solver_cache_max_mb,
+        frontier_fp=args.frontier_file,
+        in_process_max_subsets=args.in_process_max_subsets,
+        solver_max_num_greedy=args.solver_max_num_greedy,
+        in_process_memo_max_mb=args.in_process_memo_max_mb,
     )
     return run(rs)
 